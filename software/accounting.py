@@ -0,0 +1,187 @@
+import time
+import sqlite3
+import logging
+import threading
+
+
+class TokenBucket:
+    """Token bucket a debito: chi preleva paga subito e aspetta il tempo necessario a ripianare."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def lease(self, amount):
+        # Restituisce quanti secondi il chiamante deve attendere prima di usare i token
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class TunnelMeter:
+    """Contatori e credito di banda di un singolo tunnel.
+
+    Lo scrive solo il thread che trasporta il tunnel, quindi l'aggiornamento per
+    pacchetto e' una somma senza lock; il flusher di Accounting legge i totali e
+    calcola le differenze. Il bucket condiviso dell'utente viene toccato solo
+    quando il credito preso in prestito (lease_size byte) e' esaurito.
+    """
+
+    def __init__(self, accounting, kind, name, bucket=None, lease_size=65536):
+        self.accounting = accounting
+        self.kind = kind
+        self.name = name
+        self.bucket = bucket
+        self.lease_size = lease_size
+        self.bytes_up = 0  # dal lato che ha aperto il tunnel verso la destinazione
+        self.bytes_down = 0
+        self.reported_up = 0
+        self.reported_down = 0
+        self.credit = 0
+        self.closed = False
+
+    def account(self, upstream, n):
+        if upstream:
+            self.bytes_up += n
+        else:
+            self.bytes_down += n
+        if self.bucket is None:
+            return 0
+        self.credit -= n
+        if self.credit > 0:
+            return 0
+        # Si paga il debito e si prende un nuovo blocco di credito in una sola operazione
+        delay = self.bucket.lease(self.lease_size - self.credit)
+        self.credit = self.lease_size
+        return delay
+
+    def close(self):
+        self.accounting.close(self)
+
+
+class SqliteUsageStore:
+
+    def __init__(self, path):
+        # Usato solo dal thread di flush, ma creato dal thread che costruisce Accounting
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS usage (kind TEXT, name TEXT, bytes_up INTEGER, "
+                            "bytes_down INTEGER, updated REAL, PRIMARY KEY (kind, name))")
+
+    def add(self, rows):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO usage VALUES (?, ?, ?, ?, ?) ON CONFLICT (kind, name) DO UPDATE SET "
+                "bytes_up = bytes_up + excluded.bytes_up, bytes_down = bytes_down + excluded.bytes_down, "
+                "updated = excluded.updated",
+                [(kind, name, up, down, now) for (kind, name), (up, down) in rows.items()])
+
+
+class Accounting:
+    """Conteggio dei byte per username o API key e shaping della banda.
+
+    I contatori vivono nei TunnelMeter e vengono aggregati e scritti sullo store a
+    blocchi ogni flush_interval secondi. Con rate (byte/s) ogni nome ha un proprio
+    token bucket; con total_rate la banda totale viene divisa in parti uguali tra i
+    nomi attivi, cosi' pochi utenti pesanti non affamano gli altri.
+    """
+
+    def __init__(self, store=None, flush_interval=5, rate=None, total_rate=None, lease_size=65536):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.rate = rate
+        self.total_rate = total_rate
+        self.lease_size = lease_size
+        self.meters = set()
+        self.buckets = {}  # (kind, name) -> [TokenBucket, tunnel attivi]
+        self.totals = {}  # (kind, name) -> [byte up, byte down] dall'avvio
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.flush_loop, name="Accounting", daemon=True)
+            self.thread.start()
+
+    def open(self, kind, name):
+        self.start()
+        with self.lock:
+            bucket = None
+            if self.rate or self.total_rate:
+                entry = self.buckets.get((kind, name))
+                if entry is None:
+                    entry = self.buckets[(kind, name)] = [TokenBucket(self.rate or self.total_rate), 0]
+                    self.rebalance()
+                entry[1] += 1
+                bucket = entry[0]
+            meter = TunnelMeter(self, kind, name, bucket, self.lease_size)
+            self.meters.add(meter)
+        return meter
+
+    def close(self, meter):
+        with self.lock:
+            meter.closed = True
+            entry = self.buckets.get((meter.kind, meter.name))
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.buckets[(meter.kind, meter.name)]
+                    self.rebalance()
+
+    def rebalance(self):
+        # Quota equa della banda totale tra i nomi attivi, senza superare il limite per nome
+        if not self.total_rate or not self.buckets:
+            return
+        share = self.total_rate / len(self.buckets)
+        rate = min(share, self.rate) if self.rate else share
+        for bucket, _ in self.buckets.values():
+            bucket.rate = rate
+            bucket.burst = rate
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.warning("Error flushing usage counters: %s", e)
+
+    def flush(self):
+        with self.lock:
+            meters = list(self.meters)
+
+        rows = {}
+        finished = []
+        for meter in meters:
+            closed = meter.closed  # letto prima dei contatori: dopo la chiusura non cambiano piu'
+            up, down = meter.bytes_up, meter.bytes_down
+            delta_up, delta_down = up - meter.reported_up, down - meter.reported_down
+            meter.reported_up, meter.reported_down = up, down
+            if delta_up or delta_down:
+                row = rows.setdefault((meter.kind, meter.name), [0, 0])
+                row[0] += delta_up
+                row[1] += delta_down
+            if closed:
+                finished.append(meter)
+
+        with self.lock:
+            self.meters.difference_update(finished)
+            for key, (up, down) in rows.items():
+                total = self.totals.setdefault(key, [0, 0])
+                total[0] += up
+                total[1] += down
+
+        if rows and self.store is not None:
+            self.store.add(rows)
+        return rows
+
+    def usage(self, kind, name):
+        with self.lock:
+            return tuple(self.totals.get((kind, name), (0, 0)))
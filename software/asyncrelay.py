@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import threading
+from metrics import TUNNEL_BYTES_UP, TUNNEL_BYTES_DOWN, TUNNELS_IDLE_CLOSED
+from liveness import TimerWheel
+
+
+class AsyncRelayEngine:
+    """Event loop condiviso che trasporta i tunnel al posto di un thread per connessione."""
+
+    def __init__(self, buffer_size=4096, idle_timeout=None):
+        self.buffer_size = buffer_size
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel() if idle_timeout else None
+        self.activity = {}  # task del tunnel -> [istante dell'ultimo traffico]
+        self.loop = None
+        self.thread = None
+        self.active_tunnels = 0
+        self.tasks = set()
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run_loop, name="AsyncRelayEngine", daemon=True)
+            self.thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        if self.wheel is not None:
+            self.loop.create_task(self.reap_idle())
+        self._ready.set()
+        self.loop.run_forever()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def submit(self, sock_a, sock_b, on_close=None, meter=None):
+        # Il thread chiamante cede i due socket all'event loop e ritorna subito
+        self.start()
+        self.loop.call_soon_threadsafe(self._spawn, self.tunnel(sock_a, sock_b, on_close, meter))
+
+    def _spawn(self, coro):
+        # L'event loop tiene solo riferimenti deboli ai task
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def reap_idle(self):
+        # I timer scaduti si riprogrammano per il tempo restante finche' il tunnel ha traffico
+        while True:
+            await asyncio.sleep(self.wheel.next_timeout())
+            now = self.loop.time()
+            for task in self.wheel.advance():
+                activity = self.activity.get(task)
+                if activity is None:
+                    continue
+                idle = now - activity[0]
+                if idle >= self.idle_timeout:
+                    TUNNELS_IDLE_CLOSED.inc()
+                    logging.debug("Async tunnel closed after %d idle seconds", idle)
+                    task.cancel()
+                else:
+                    self.wheel.schedule(task, self.idle_timeout - idle)
+
+    async def tunnel(self, sock_a, sock_b, on_close=None, meter=None):
+        self.active_tunnels += 1
+        writers = []
+        task = asyncio.current_task()
+        activity = self.activity[task] = [self.loop.time()]
+        if self.wheel is not None:
+            self.wheel.schedule(task, self.idle_timeout)
+        try:
+            sock_a.setblocking(False)
+            sock_b.setblocking(False)
+            reader_a, writer_a = await asyncio.open_connection(sock=sock_a, limit=self.buffer_size)
+            writers.append(writer_a)
+            reader_b, writer_b = await asyncio.open_connection(sock=sock_b, limit=self.buffer_size)
+            writers.append(writer_b)
+            await self.exchange_data(reader_a, writer_a, reader_b, writer_b, meter, activity)
+        except Exception as e:
+            logging.warning("Async tunnel terminated: %s", e)
+        finally:
+            self.active_tunnels -= 1
+            del self.activity[task]
+            if self.wheel is not None:
+                self.wheel.cancel(task)
+            for writer in writers:
+                writer.close()
+            # Il socket va chiuso dal transport prima che on_close liberi il file descriptor
+            await asyncio.gather(*(writer.wait_closed() for writer in writers), return_exceptions=True)
+            if on_close:
+                try:
+                    on_close()
+                except Exception as e:
+                    logging.warning("Error in tunnel close callback: %s", e)
+
+    async def exchange_data(self, reader_a, writer_a, reader_b, writer_b, meter=None, activity=None):
+        pipes = [
+            asyncio.ensure_future(self._pipe(reader_a, writer_b, meter, True, activity)),
+            asyncio.ensure_future(self._pipe(reader_b, writer_a, meter, False, activity)),
+        ]
+        try:
+            # Come DataExchanger: il tunnel termina alla prima chiusura di una delle due parti
+            done, pending = await asyncio.wait(pipes, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            for task in pipes:
+                task.cancel()
+            raise
+        for task in done:
+            if task.exception():
+                logging.warning("Async tunnel pipe error: %s", task.exception())
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _pipe(self, reader, writer, meter=None, upstream=True, activity=None):
+        transferred = (TUNNEL_BYTES_UP if upstream else TUNNEL_BYTES_DOWN).shard()
+        while True:
+            data = await reader.read(self.buffer_size)
+            if len(data) == 0:  # Verifica se la connessione è stata chiusa
+                return
+            writer.write(data)
+            await writer.drain()
+            transferred[0] += len(data)
+            if activity is not None:
+                activity[0] = self.loop.time()
+            if meter is not None:
+                delay = meter.account(upstream, len(data))
+                if delay:
+                    await asyncio.sleep(delay)
+
@@ -1,13 +1,153 @@
+import os
+import hmac
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class AllowAllBackend:
+    # Comportamento storico: ogni credenziale e' valida
+
+    def check_client(self, username, password):
+        return True
+
+    def check_producer(self, api_key):
+        return True
+
+
+class SqliteBackend:
+    """Utenti e API key dei Producer in un database SQLite, per i test in locale.
+
+    Le password sono salvate con PBKDF2 (volutamente lento: e' il costo che la cache
+    di AuthService evita di pagare a ogni handshake), le API key con SHA-256.
+    """
+
+    def __init__(self, path, iterations=100000):
+        self.path = path
+        self.iterations = iterations
+        self.local = threading.local()
+        with self.connection() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, salt BLOB, password_hash BLOB)")
+            db.execute("CREATE TABLE IF NOT EXISTS producers (api_key_hash BLOB PRIMARY KEY)")
+
+    def connection(self):
+        # Una connessione per thread: sqlite3 non condivide le connessioni tra thread
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path)
+            self.local.db = db
+        return db
+
+    def hash_password(self, password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password.encode('utf-8'), salt, self.iterations)
+
+    def add_user(self, username, password):
+        salt = os.urandom(16)
+        with self.connection() as db:
+            db.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?)",
+                       (username, salt, self.hash_password(password, salt)))
+
+    def add_producer(self, api_key):
+        with self.connection() as db:
+            db.execute("INSERT OR IGNORE INTO producers VALUES (?)",
+                       (hashlib.sha256(api_key.encode('utf-8')).digest(),))
+
+    def check_client(self, username, password):
+        row = self.connection().execute("SELECT salt, password_hash FROM users WHERE username = ?",
+                                        (username,)).fetchone()
+        if row is None:
+            return False
+        salt, password_hash = row
+        return hmac.compare_digest(self.hash_password(password, salt), password_hash)
+
+    def check_producer(self, api_key):
+        row = self.connection().execute("SELECT 1 FROM producers WHERE api_key_hash = ?",
+                                        (hashlib.sha256(api_key.encode('utf-8')).digest(),)).fetchone()
+        return row is not None
 
 
 class AuthService:
+    """Autenticazione di Client e Producer con cache dei login riusciti.
+
+    Va creata una sola istanza per componente e condivisa tra le connessioni. La
+    cache e' un LRU con TTL indicizzato da un hash con chiave segreta delle
+    credenziali, cosi' in memoria non restano password in chiaro. Le verifiche
+    concorrenti delle stesse credenziali aspettano un'unica interrogazione al backend.
+    """
 
-    def __init__(self):
-        pass
+    def __init__(self, backend=None, cache_ttl=300, max_entries=10000):
+        self.backend = backend or AllowAllBackend()
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.cache = OrderedDict()  # hash delle credenziali -> scadenza
+        self.inflight = {}  # hash delle credenziali -> (Event, risultato)
+        self.cache_key = os.urandom(32)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
-    
     def login_client(self, username, password):
-        return True
-    
+        return self.login(self.backend.check_client, "client", username, password)
+
     def login_producer(self, api_key):
-        return True
\ No newline at end of file
+        return self.login(self.backend.check_producer, "producer", api_key)
+
+    async def login_client_async(self, username, password):
+        return await asyncio.get_running_loop().run_in_executor(None, self.login_client, username, password)
+
+    async def login_producer_async(self, api_key):
+        return await asyncio.get_running_loop().run_in_executor(None, self.login_producer, api_key)
+
+    def credentials_key(self, kind, *credentials):
+        digest = hashlib.blake2b(key=self.cache_key, digest_size=32)
+        for value in (kind,) + credentials:
+            encoded = value.encode('utf-8')
+            digest.update(len(encoded).to_bytes(4, "big") + encoded)
+        return digest.digest()
+
+    def login(self, check, kind, *credentials):
+        key = self.credentials_key(kind, *credentials)
+
+        with self.lock:
+            expires = self.cache.get(key)
+            if expires is not None and expires > time.monotonic():
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+
+            inflight = self.inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = (threading.Event(), [])
+                self.inflight[key] = inflight
+
+        event, result = inflight
+        if not leader:
+            # La stessa verifica e' gia' in corso in un altro thread
+            event.wait()
+            return bool(result and result[0])
+
+        try:
+            status = bool(check(*credentials))
+            if status:
+                with self.lock:
+                    self.cache[key] = time.monotonic() + self.cache_ttl
+                    self.cache.move_to_end(key)
+                    while len(self.cache) > self.max_entries:
+                        self.cache.popitem(last=False)
+            result.append(status)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            event.set()
+
+        return status
+
+    def clear(self):
+        # Da chiamare quando cambiano le credenziali nel backend
+        with self.lock:
+            self.cache.clear()
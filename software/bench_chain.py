@@ -0,0 +1,302 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import threading
+import multiprocessing
+from socks5 import AsyncSocks5Client
+
+# Benchmark della catena completa su loopback: Client SOCKS5 -> ClientGateway -> GeoTcpRelay
+# -> Producer -> sink (echo o HTTP). Ogni componente gira nel proprio processo, cosi' la
+# memoria per tunnel si misura sul processo giusto. Il risultato e' un documento JSON.
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def run_sinks(echo_port, http_port, http_size):
+    body = b"x" * http_size
+    header = (f"HTTP/1.1 200 OK\r\nContent-Length: {http_size}\r\nConnection: close\r\n\r\n").encode()
+
+    async def echo(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def http(reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(header + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        writer.close()
+
+    async def main():
+        await asyncio.start_server(echo, "127.0.0.1", echo_port, backlog=4096)
+        await asyncio.start_server(http, "127.0.0.1", http_port, backlog=4096)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+def run_relay(args, ports):
+    from geotcprelay import GeoTcpRelay
+    relay = GeoTcpRelay(args.mode, args.buffer_size, args.backlog, scheduling_policy=args.policy)
+    relay.start_server("127.0.0.1", ports["producers"], ports["clients"], ports["links"], ports["status"])
+    threading.Event().wait()
+
+
+def run_gateway(args, ports):
+    from clientgateway import ClientGateway
+    from relaydirectory import RelayDirectory
+    relay_directory = RelayDirectory([("it", "127.0.0.1")], ports["status"], probe_interval=1)
+    relay_directory.start()
+    link_pool = None
+    if args.links:
+        from relaylinks import RelayLinkPool
+        link_pool = RelayLinkPool(ports["links"])
+        link_pool.start(relay_directory.hosts())
+    gateway = ClientGateway(args.mode, args.buffer_size, args.backlog, link_pool=link_pool,
+                            relay_directory=relay_directory, relay_port=ports["clients"],
+                            optimistic_connect=args.optimistic)
+    gateway.start_server("127.0.0.1", ports["gateway"])
+    threading.Event().wait()
+
+
+def run_producer(args, ports):
+    from producer import ConnectionPool
+    pool = ConnectionPool("127.0.0.1", ports["producers"], args.pool_size, args.mode, args.buffer_size,
+                          max_size=max(1024, args.pool_size * 4), connect_rate=args.connect_rate,
+                          transport=args.transport)
+    pool.start()
+    threading.Event().wait()
+
+
+def wait_for(predicate, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if predicate():
+                return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.2)
+    raise TimeoutError("Components did not become ready")
+
+
+def relay_status(ports):
+    with socket.create_connection(("127.0.0.1", ports["status"]), timeout=1) as sock:
+        return json.loads(sock.makefile().readline())
+
+
+def gateway_listening(ports):
+    with socket.create_connection(("127.0.0.1", ports["gateway"]), timeout=1) as sock:
+        # Chiusura pulita con un metodo non supportato, per non sporcare i log con handshake troncati
+        sock.sendall(b"\x05\x00")
+    return True
+
+
+async def session(args, ports, sink, payload, release=None, established=None):
+    """Un Client SOCKS5: restituisce (time to first byte, byte ricevuti)."""
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection("127.0.0.1", ports["gateway"])
+    try:
+        client = AsyncSocks5Client(reader, writer)
+        request = b"GET / HTTP/1.1\r\nHost: sink\r\n\r\n" if sink == "http" else b""
+        ok, _, _ = await client.connect(USERNAME, PASSWORD, 1, 1, "127.0.0.1", ports[sink], request)
+        if not ok:
+            raise ConnectionError("SOCKS5 CONNECT refused")
+
+        sender = None
+        if sink == "echo":
+            writer.write(payload)
+            sender = asyncio.ensure_future(writer.drain())
+
+        first = client.take_buffered() or await reader.read(65536)
+        if not first:
+            raise ConnectionError("Tunnel closed before the first byte")
+        ttfb = time.perf_counter() - started
+        received = len(first)
+
+        if release is not None:
+            # Tunnel aperto e verificato: resta fermo finche' non finisce la misura della memoria
+            established.append(ttfb)
+            await release.wait()
+        while sink == "http" or received < len(payload):
+            data = await reader.read(65536)
+            if not data:
+                break
+            received += len(data)
+        if sender is not None:
+            await sender
+        if sink == "echo" and received < len(payload):
+            raise ConnectionError("Echo response truncated")
+        return ttfb, received + len(payload)
+    finally:
+        writer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run_load(args, ports):
+    payload = os.urandom(args.payload_size)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    ttfbs = []
+    errors = []
+    transferred = 0
+
+    async def worker():
+        nonlocal transferred
+        async with semaphore:
+            try:
+                ttfb, size = await asyncio.wait_for(session(args, ports, args.sink, payload), args.timeout)
+                ttfbs.append(ttfb)
+                transferred += size
+            except (OSError, asyncio.TimeoutError) as e:
+                errors.append(type(e).__name__)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.connections)))
+    elapsed = time.perf_counter() - started
+
+    error_counts = {}
+    for error in errors:
+        error_counts[error] = error_counts.get(error, 0) + 1
+    return {
+        "connections": args.connections,
+        "completed": len(ttfbs),
+        "errors": error_counts,
+        "duration_s": round(elapsed, 3),
+        "connections_per_s": round(len(ttfbs) / elapsed, 1),
+        "ttfb_ms": {name: round(percentile(ttfbs, fraction) * 1000, 3) if ttfbs else None
+                    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "throughput_bytes_per_s": round(transferred / elapsed),
+    }
+
+
+async def run_hold(args, ports, pids):
+    # Tiene aperti args.hold tunnel e misura la memoria residente dei componenti
+    baseline = {name: rss_kb(pid) for name, pid in pids.items()}
+    release = asyncio.Event()
+    established = []
+    tasks = [asyncio.ensure_future(session(args, ports, "echo", b"x", release, established))
+             for _ in range(args.hold)]
+
+    deadline = time.monotonic() + args.timeout
+    while len(established) + sum(task.done() for task in tasks) < args.hold and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(1)  # lascia terminare l'allocazione dei buffer nei componenti
+    held = {name: rss_kb(pid) for name, pid in pids.items()}
+    release.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    growth = sum(held.values()) - sum(baseline.values())
+    return {
+        "tunnels": len(established),
+        "baseline_rss_kb": baseline,
+        "held_rss_kb": held,
+        "kb_per_tunnel": round(growth / len(established), 2) if established else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the proxy chain on loopback")
+    parser.add_argument("--mode", default="thread", choices=("thread", "splice", "buffered", "asyncio", "epoll"))
+    parser.add_argument("--transport", default="tcp", choices=("tcp", "mux"))
+    parser.add_argument("--links", action="store_true", help="persistent multiplexed gateway-relay links")
+    parser.add_argument("--optimistic", action="store_true", help="pipeline the gateway-relay handshake with CONNECT")
+    parser.add_argument("--policy", default="power_of_two")
+    parser.add_argument("--sink", default="echo", choices=("echo", "http"))
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--payload-size", type=int, default=16384, help="bytes echoed per session")
+    parser.add_argument("--http-size", type=int, default=16384, help="body size served by the HTTP sink")
+    parser.add_argument("--hold", type=int, default=500, help="tunnels held open for the memory measurement")
+    parser.add_argument("--pool-size", type=int, default=None)
+    parser.add_argument("--connect-rate", type=int, default=5000)
+    parser.add_argument("--buffer-size", type=int, default=65536)
+    parser.add_argument("--backlog", type=int, default=4096)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    args = parser.parse_args()
+    args.pool_size = args.pool_size or max(args.concurrency, args.hold)
+
+    fd_limit = raise_fd_limit()
+    ports = {name: free_port() for name in ("gateway", "producers", "clients", "links", "status", "echo", "http")}
+
+    context = multiprocessing.get_context("fork")
+    processes = {}
+
+    def start(name, target, *target_args):
+        processes[name] = context.Process(target=target, args=target_args, daemon=True)
+        processes[name].start()
+
+    try:
+        # In ordine di dipendenza: il primo probe del Gateway deve gia' trovare il relay
+        start("sink", run_sinks, ports["echo"], ports["http"], args.http_size)
+        start("relay", run_relay, args, ports)
+        wait_for(lambda: relay_status(ports))
+        start("producer", run_producer, args, ports)
+        wait_for(lambda: relay_status(ports)["free_producers"] >= args.pool_size)
+        start("gateway", run_gateway, args, ports)
+        wait_for(lambda: gateway_listening(ports))
+        pids = {name: process.pid for name, process in processes.items() if name != "sink"}
+        result = {
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "python": sys.version.split()[0],
+            "fd_limit": fd_limit,
+            "load": asyncio.run(run_load(args, ports)),
+        }
+        if args.hold:
+            result["memory"] = asyncio.run(run_hold(args, ports, pids))
+    finally:
+        for process in processes.values():
+            process.kill()
+
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
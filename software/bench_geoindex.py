@@ -0,0 +1,153 @@
+import os
+import time
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import ipaddress
+import threading
+from geoindex import PrefixIndexBuilder, PrefixIndex, parse_address
+
+# Benchmark dell'indice GeoIP e del ProducerGateway su una tabella di prefissi sintetica:
+# costruzione, avvio (mmap), lookup al secondo confrontati con un longest prefix match di
+# riferimento, e registrazioni di Producer al secondo su loopback.
+
+# Distribuzione delle lunghezze simile a quella delle tabelle BGP reali: soprattutto /24 e /48
+IPV4_LENGTHS = [(24, 60), (22, 10), (23, 8), (21, 5), (20, 5), (19, 3), (18, 2), (16, 4), (17, 2), (12, 1)]
+IPV6_LENGTHS = [(48, 50), (32, 20), (40, 10), (44, 10), (36, 5), (29, 5)]
+COUNTRIES = ["it", "us", "de", "fr", "es", "gb", "nl", "br", "in", "jp", "cn", "ru"]
+
+
+def synthetic_rows(count, ipv6_share, seed):
+    rng = random.Random(seed)
+    v4_lengths, v4_weights = zip(*IPV4_LENGTHS)
+    v6_lengths, v6_weights = zip(*IPV6_LENGTHS)
+    rows = []
+    for _ in range(count):
+        if rng.random() < ipv6_share:
+            length = rng.choices(v6_lengths, v6_weights)[0]
+            address = (0x2000 << 112) | rng.getrandbits(125)
+            network = ipaddress.IPv6Network((address >> (128 - length) << (128 - length), length))
+        else:
+            length = rng.choices(v4_lengths, v4_weights)[0]
+            address = rng.randrange(1 << 24, 224 << 24)
+            network = ipaddress.IPv4Network((address >> (32 - length) << (32 - length), length))
+        rows.append((str(network), rng.choice(COUNTRIES), rng.randrange(1, 400000)))
+    return rows
+
+
+class ReferenceMatcher:
+    # Longest prefix match con un dizionario per lunghezza: lento ma ovviamente corretto
+
+    def __init__(self, rows):
+        self.tables = {}
+        for cidr, country, asn in rows:
+            network = ipaddress.ip_network(cidr)
+            bits = network.max_prefixlen
+            key = int(network.network_address) >> (bits - network.prefixlen)
+            self.tables.setdefault((network.version, network.prefixlen), {})[key] = (country, asn)
+
+    def lookup(self, address):
+        version, value = parse_address(address)
+        bits = 32 if version == 4 else 128
+        for length in range(bits, -1, -1):
+            table = self.tables.get((version, length))
+            if table is not None:
+                match = table.get(value >> (bits - length))
+                if match is not None:
+                    return match
+        return None
+
+
+def sample_addresses(rows, count, seed):
+    # Meta' dentro i prefissi della tabella, meta' a caso (molti senza corrispondenza)
+    rng = random.Random(seed + 1)
+    addresses = []
+    for _ in range(count // 2):
+        network = ipaddress.ip_network(rng.choice(rows)[0])
+        addresses.append(str(network.network_address + rng.randrange(network.num_addresses)))
+    for _ in range(count - len(addresses)):
+        addresses.append(str(ipaddress.IPv4Address(rng.getrandbits(32))))
+    return addresses
+
+
+def bench_registrations(index, count, concurrency):
+    # Nessun handler sul root logger prima dell'import: setup_logging diventerebbe il logging del benchmark
+    logging.basicConfig(level=logging.WARNING)
+    from relaydirectory import RelayDirectory
+    from producergateway import ProducerGateway
+    from producer import discover_relay
+
+    # Directory senza probe: i relay restano sani come all'avvio
+    directory = RelayDirectory([(country, f"{country}.relay.test") for country in COUNTRIES])
+    gateway = ProducerGateway(index, directory, backlog=1024)
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    threading.Thread(target=gateway.start_server, args=("127.0.0.1", port), daemon=True).start()
+    for _ in range(100):
+        try:
+            discover_relay("127.0.0.1", port)
+            break
+        except OSError:
+            time.sleep(0.05)
+
+    per_thread = count // concurrency
+    errors = []
+
+    def register():
+        for _ in range(per_thread):
+            try:
+                discover_relay("127.0.0.1", port)
+            except OSError as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=register) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return per_thread * concurrency, time.perf_counter() - started, len(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GeoIP prefix index and ProducerGateway benchmark")
+    parser.add_argument("--prefixes", type=int, default=300000)
+    parser.add_argument("--ipv6-share", type=float, default=0.2)
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--registrations", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rows = synthetic_rows(args.prefixes, args.ipv6_share, args.seed)
+    path = os.path.join(tempfile.mkdtemp(), "geoip.idx")
+
+    started = time.perf_counter()
+    builder = PrefixIndexBuilder().build(rows)
+    builder.save(path)
+    print(f"build          {len(rows):>8} prefixes  {time.perf_counter() - started:8.3f} s  "
+          f"{builder.node_count} nodes  {os.path.getsize(path) / 2 ** 20:.1f} MiB")
+    del builder
+
+    started = time.perf_counter()
+    index = PrefixIndex(path)
+    print(f"load (mmap)    {(time.perf_counter() - started) * 1000:8.3f} ms")
+
+    addresses = sample_addresses(rows, args.lookups, args.seed)
+    reference = ReferenceMatcher(rows)
+    mismatches = sum(1 for address in addresses[:5000] if index.lookup(address) != reference.lookup(address))
+
+    lookup = index.lookup
+    started = time.perf_counter()
+    for address in addresses:
+        lookup(address)
+    elapsed = time.perf_counter() - started
+    print(f"lookup         {len(addresses):>8} lookups   {elapsed:8.3f} s  "
+          f"{elapsed / len(addresses) * 1e6:6.2f} us/lookup  {mismatches} mismatches on 5000")
+
+    registrations, elapsed, errors = bench_registrations(index, args.registrations, args.concurrency)
+    print(f"registrations  {registrations:>8} producers {elapsed:8.3f} s  "
+          f"{registrations / elapsed:8.0f} registrations/s  {errors} errors")
@@ -0,0 +1,134 @@
+import time
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+from socks5 import (Socks5Client, Socks5Server, AsyncSocks5Client, AsyncSocks5Server,
+                    build_credentials, build_request)
+
+# Microbenchmark dell'handshake SOCKS5 (metodo + auth + CONNECT) su loopback.
+# Il server risponde alla richiesta senza aprire la connessione remota, quindi si misura
+# solo il costo di parsing, syscall e round trip dell'handshake.
+
+USERNAME = "bench"
+PASSWORD = "bench"
+TARGET = ("127.0.0.1", 80)
+
+
+def serve_sync(listener, count):
+    for _ in range(count):
+        sock, _ = listener.accept()
+        with sock:
+            server = Socks5Server(sock)
+            status, username, password = server.auth_handshake()
+            server.complete_auth_handshake()
+            cmd, address, port = server.get_request()
+            server.send_status(0, ("0.0.0.0", 0))
+
+
+def client_sequential(sock):
+    # Un messaggio per round trip, come faceva il vecchio Socks5Client
+    client = Socks5Client(sock)
+    client.send_version_nmethods_methods()
+    client.get_version_method_response()
+    client.send_auth(USERNAME, PASSWORD)
+    client.get_auth_response()
+    client.send_request(1, 1, *TARGET)
+    client.get_response()
+
+
+def client_pipelined(sock):
+    client = Socks5Client(sock)
+    client.send_version_nmethods_methods()
+    client.send_auth(USERNAME, PASSWORD)
+    client.send_request(1, 1, *TARGET)
+    client.get_version_method_response()
+    client.get_auth_response()
+    client.get_response()
+
+
+def bench_sync(client, count):
+    listener = socket.create_server(("127.0.0.1", 0))
+    server_thread = threading.Thread(target=serve_sync, args=(listener, count), daemon=True)
+    server_thread.start()
+    address = listener.getsockname()
+
+    started = time.perf_counter()
+    for _ in range(count):
+        with socket.create_connection(address) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client(sock)
+    elapsed = time.perf_counter() - started
+    server_thread.join()
+    listener.close()
+    return elapsed
+
+
+def bench_parser(count):
+    # Solo parsing e costruzione delle risposte, senza socket
+    request = struct.pack("!BBB", 5, 1, 2) + build_credentials(USERNAME, PASSWORD) + build_request(1, 1, *TARGET)
+
+    class Loopback:
+        def __init__(self, data):
+            self.data = data
+
+        def recv(self, size):
+            data, self.data = self.data, b""
+            return data
+
+        def sendall(self, data):
+            pass
+
+    started = time.perf_counter()
+    for _ in range(count):
+        server = Socks5Server(Loopback(request))
+        server.auth_handshake()
+        server.complete_auth_handshake()
+        server.get_request()
+        server.send_status(0)
+    return time.perf_counter() - started
+
+
+async def bench_async(count, concurrency):
+    async def handle(reader, writer):
+        server = AsyncSocks5Server(reader, writer)
+        await server.auth_handshake()
+        server.complete_auth_handshake()
+        await server.get_request()
+        await server.send_status(0, ("0.0.0.0", 0))
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    address = server.sockets[0].getsockname()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def client():
+        async with semaphore:
+            reader, writer = await asyncio.open_connection(*address)
+            await AsyncSocks5Client(reader, writer).connect(USERNAME, PASSWORD, 1, 1, *TARGET)
+            writer.close()
+            await writer.wait_closed()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(count)))
+    elapsed = time.perf_counter() - started
+    server.close()
+    await server.wait_closed()
+    return elapsed
+
+
+def report(name, count, elapsed):
+    print(f"{name:<22} {count:>7} handshakes  {elapsed:8.3f} s  {count / elapsed:10.0f} handshakes/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SOCKS5 handshake microbenchmark")
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    args = parser.parse_args()
+
+    report("parser only", args.count * 10, bench_parser(args.count * 10))
+    report("sync sequential", args.count, bench_sync(client_sequential, args.count))
+    report("sync pipelined", args.count, bench_sync(client_pipelined, args.count))
+    report("asyncio pipelined", args.count, asyncio.run(bench_async(args.count, args.concurrency)))
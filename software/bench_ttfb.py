@@ -0,0 +1,125 @@
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+from bench_chain import (free_port, raise_fd_limit, run_sinks, run_relay, run_gateway, run_producer, wait_for,
+                         relay_status, gateway_listening, session, percentile)
+
+# Time to first byte di una sessione nuova: Client SOCKS5 -> ClientGateway -> GeoTcpRelay -> Producer
+# -> sink HTTP, con e senza CONNECT ottimistico. Le sessioni sono una alla volta, quindi si misura
+# la latenza e non il throughput. Su loopback un round trip costa decine di microsecondi: con
+# --delay-ms un proxy aggiunge un ritardo per direzione sulle tratte Gateway -> relay e
+# Producer -> relay, come tra macchine in data center diversi.
+
+
+def run_delay_proxy(listen_port, target_port, delay):
+    loop = None
+
+    async def pump(reader, writer):
+        # Ogni blocco parte delay secondi dopo il suo arrivo; l'ordine resta quello di lettura
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                loop.call_later(delay, writer.write, data)
+        except ConnectionError:
+            pass
+        loop.call_later(delay, writer.close)
+
+    async def handle(reader, writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(pump(reader, upstream_writer), pump(upstream_reader, writer))
+
+    async def main():
+        nonlocal loop
+        loop = asyncio.get_running_loop()
+        await asyncio.start_server(handle, "127.0.0.1", listen_port, backlog=4096)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
+
+
+async def measure(args, ports):
+    ttfbs = []
+    errors = 0
+    for _ in range(args.sessions):
+        try:
+            ttfb, _ = await asyncio.wait_for(session(args, ports, "http", b""), args.timeout)
+            ttfbs.append(ttfb)
+        except (OSError, asyncio.TimeoutError):
+            errors += 1
+    return {
+        "sessions": args.sessions,
+        "errors": errors,
+        "ttfb_ms": {name: round(percentile(ttfbs, fraction) * 1000, 3) if ttfbs else None
+                    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))},
+    }
+
+
+def run_chain(args, optimistic):
+    args.optimistic = optimistic
+    ports = {name: free_port() for name in ("gateway", "producers", "clients", "links", "status", "echo", "http",
+                                            "delayed_producers", "delayed_clients", "delayed_links")}
+    # Gateway e Producer vedono il relay attraverso i proxy con ritardo; il probe di stato no
+    gateway_ports = dict(ports, clients=ports["delayed_clients"], links=ports["delayed_links"])
+    producer_ports = dict(ports, producers=ports["delayed_producers"])
+
+    context = multiprocessing.get_context("fork")
+    processes = []
+
+    def start(target, *target_args):
+        process = context.Process(target=target, args=target_args, daemon=True)
+        process.start()
+        processes.append(process)
+
+    try:
+        start(run_sinks, ports["echo"], ports["http"], args.http_size)
+        start(run_relay, args, ports)
+        wait_for(lambda: relay_status(ports))
+        for name in ("producers", "clients", "links"):
+            start(run_delay_proxy, ports["delayed_" + name], ports[name], args.delay_ms / 1000)
+        start(run_producer, args, producer_ports)
+        wait_for(lambda: relay_status(ports)["free_producers"] >= args.pool_size)
+        start(run_gateway, args, gateway_ports)
+        wait_for(lambda: gateway_listening(ports))
+        time.sleep(1)  # primo probe del Gateway verso il relay
+        return asyncio.run(measure(args, ports))
+    finally:
+        for process in processes:
+            process.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first byte of new sessions, with and without optimistic CONNECT")
+    parser.add_argument("--mode", default="thread", choices=("thread", "splice", "buffered", "asyncio", "epoll"))
+    parser.add_argument("--transport", default="tcp", choices=("tcp", "mux"))
+    parser.add_argument("--links", action="store_true", help="persistent multiplexed gateway-relay links")
+    parser.add_argument("--policy", default="power_of_two")
+    parser.add_argument("--sessions", type=int, default=300)
+    parser.add_argument("--delay-ms", type=float, default=0, help="one-way delay on the gateway-relay and producer-relay hops")
+    parser.add_argument("--http-size", type=int, default=1024, help="body size served by the HTTP sink")
+    parser.add_argument("--pool-size", type=int, default=16)
+    parser.add_argument("--connect-rate", type=int, default=5000)
+    parser.add_argument("--buffer-size", type=int, default=65536)
+    parser.add_argument("--backlog", type=int, default=4096)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    result = {"config": vars(args).copy()}
+    result["sequential"] = run_chain(args, optimistic=False)
+    result["optimistic"] = run_chain(args, optimistic=True)
+    baseline, optimistic = result["sequential"]["ttfb_ms"]["p50"], result["optimistic"]["ttfb_ms"]["p50"]
+    if baseline and optimistic:
+        result["p50_saved_ms"] = round(baseline - optimistic, 3)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
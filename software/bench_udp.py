@@ -0,0 +1,147 @@
+import json
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+from socks5 import Socks5Client
+from udprelay import CMD_UDP_ASSOCIATE, build_datagram_header, parse_datagram
+from bench_chain import (free_port, raise_fd_limit, run_relay, run_gateway, run_producer, wait_for, relay_status,
+                         gateway_listening)
+
+# Benchmark di UDP ASSOCIATE su loopback: Client -> ClientGateway -> GeoTcpRelay -> Producer -> echo UDP.
+# Ogni associazione invia finestre di datagrammi e aspetta gli echi; si misurano datagrammi al
+# secondo, throughput e perdite. I componenti sono gli stessi processi di bench_chain.
+
+USERNAME = "bench"
+PASSWORD = "bench"
+
+
+def run_udp_echo(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(("127.0.0.1", port))
+    while True:
+        data, source = sock.recvfrom(65535)
+        sock.sendto(data, source)
+
+
+def udp_associate(ports, timeout):
+    control = socket.create_connection(("127.0.0.1", ports["gateway"]), timeout=timeout)
+    client = Socks5Client(control)
+    client.send_version_nmethods_methods()
+    client.send_auth(USERNAME, PASSWORD)
+    client.send_request(CMD_UDP_ASSOCIATE, 1, "0.0.0.0", 0)
+    if not (client.get_version_method_response() and client.get_auth_response()):
+        raise ConnectionError("SOCKS5 authentication failed")
+    ok, address, port = client.get_response()
+    if not ok:
+        raise ConnectionError("UDP ASSOCIATE refused")
+    return control, (address, port)
+
+
+def association(args, ports, results):
+    sent = received = 0
+    try:
+        control, relay_address = udp_associate(ports, args.timeout)
+    except OSError as e:
+        results.append({"error": str(e)})
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.settimeout(args.window_timeout)
+    header = build_datagram_header("127.0.0.1", ports["udp_echo"])
+    payload = b"x" * args.datagram_size
+    try:
+        while sent < args.datagrams:
+            window = min(args.window, args.datagrams - sent)
+            for _ in range(window):
+                sock.sendto(header + payload, relay_address)
+            sent += window
+            for _ in range(window):
+                try:
+                    data = sock.recv(65535)
+                except socket.timeout:
+                    break  # il resto della finestra e' andato perso
+                if parse_datagram(data) is not None:
+                    received += 1
+    finally:
+        sock.close()
+        control.close()
+    results.append({"sent": sent, "received": received})
+
+
+def run_load(args, ports):
+    results = []
+    threads = [threading.Thread(target=association, args=(args, ports, results)) for _ in range(args.associations)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    sent = sum(result.get("sent", 0) for result in results)
+    received = sum(result.get("received", 0) for result in results)
+    return {
+        "associations": args.associations,
+        "errors": sum(1 for result in results if "error" in result),
+        "datagrams_sent": sent,
+        "datagrams_echoed": received,
+        "loss": round(1 - received / sent, 4) if sent else None,
+        "seconds": round(elapsed, 3),
+        "datagrams_per_second": round(received / elapsed),
+        "mbit_per_second": round(received * args.datagram_size * 8 / elapsed / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UDP ASSOCIATE throughput benchmark on loopback")
+    parser.add_argument("--mode", default="thread", choices=("thread", "splice", "buffered", "asyncio", "epoll"))
+    parser.add_argument("--transport", default="tcp", choices=("tcp", "mux"))
+    parser.add_argument("--links", action="store_true", help="persistent multiplexed gateway-relay links")
+    parser.add_argument("--optimistic", action="store_true", help="pipeline the gateway-relay handshake with CONNECT")
+    parser.add_argument("--policy", default="power_of_two")
+    parser.add_argument("--associations", type=int, default=8)
+    parser.add_argument("--datagrams", type=int, default=20000, help="datagrams sent per association")
+    parser.add_argument("--datagram-size", type=int, default=512)
+    parser.add_argument("--window", type=int, default=32, help="datagrams in flight per association")
+    parser.add_argument("--window-timeout", type=float, default=0.5)
+    parser.add_argument("--connect-rate", type=int, default=5000)
+    parser.add_argument("--buffer-size", type=int, default=65536)
+    parser.add_argument("--backlog", type=int, default=4096)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+    args.pool_size = args.associations
+
+    raise_fd_limit()
+    ports = {name: free_port() for name in ("gateway", "producers", "clients", "links", "status", "udp_echo")}
+
+    context = multiprocessing.get_context("fork")
+    processes = {}
+
+    def start(name, target, *target_args):
+        processes[name] = context.Process(target=target, args=target_args, daemon=True)
+        processes[name].start()
+
+    try:
+        start("sink", run_udp_echo, ports["udp_echo"])
+        start("relay", run_relay, args, ports)
+        wait_for(lambda: relay_status(ports))
+        start("producer", run_producer, args, ports)
+        wait_for(lambda: relay_status(ports)["free_producers"] >= args.pool_size)
+        start("gateway", run_gateway, args, ports)
+        wait_for(lambda: gateway_listening(ports))
+        result = {
+            "config": vars(args),
+            "load": run_load(args, ports),
+        }
+    finally:
+        for process in processes.values():
+            process.kill()
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,56 @@
+import time
 import socket
 import threading
 import random
 import logging
 import struct
 import select
-from socks5 import Socks5Server, Socks5Client, DataExchanger
+import argparse
+from socks5 import Socks5Server, Socks5Client, DataExchanger, parse_request, build_request
+from connector import REPLY_GENERAL_FAILURE
+from udprelay import CMD_UDP_ASSOCIATE, ClientUdpAssociation
 from authservice import AuthService
+from forwarding import Forwarder
+from relaydirectory import parse_username
+from metrics import REGISTRY, start_http_server
+from logpipeline import setup_logging
+
+# Configurazione del logging: JSON su file scritto da un thread dedicato
+setup_logging('clientgateway.log')
+
+ACCEPTED = REGISTRY.counter("gateway_accepted_total", "Client connections accepted")
+HANDSHAKE_FAILURES = REGISTRY.counter("gateway_handshake_failures_total", "Client handshakes that did not reach a relay")
+METHOD_LATENCY = REGISTRY.histogram("gateway_handshake_seconds", "Client handshake latency per phase", {"phase": "method"})
+AUTH_LATENCY = REGISTRY.histogram("gateway_handshake_seconds", "Client handshake latency per phase", {"phase": "auth"})
+RELAY_CONNECT_LATENCY = REGISTRY.histogram("gateway_handshake_seconds", "Client handshake latency per phase",
+                                           {"phase": "relay_connect"})
+
+def header_length(message):
+    # Richiesta o risposta SOCKS5 come restituita da peek(parse_request): (versione, cmd, atyp, indirizzo, porta)
+    if message[3] is None:
+        return 4  # tipo di indirizzo sconosciuto: solo l'intestazione fissa
+    return len(build_request(*message[1:]))
 
-# Configurazione del logging
-logging.basicConfig(filename='clientgateway.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s', filemode='w')
 
 class ClientGateway:
-    def __init__(self):
+    def __init__(self, exchange_mode="thread", buffer_size=4096, backlog=5, reuse_port=False, link_pool=None,
+                 relay_directory=None, relay_attempts=3, auth_service=None, accounting=None, relay_port=60000,
+                 udp_idle_timeout=120, optimistic_connect=False):
         self.client_socks5server_mappings = {}  # Connessioni Socks5 dei dispositivi A
         self.lock = threading.Lock()
+        self.forwarder = Forwarder(exchange_mode, buffer_size)
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.link_pool = link_pool  # RelayLinkPool: link persistenti e multiplexati verso i relay
+        self.relay_directory = relay_directory  # RelayDirectory: relay per paese con stato di salute
+        self.relay_attempts = relay_attempts
+        self.relay_port = relay_port  # porta dei Client sui relay di paese
+        self.auth_service = auth_service or AuthService()  # condivisa: la cache dei login vale per tutti i Client
+        self.accounting = accounting  # Accounting: byte per username e shaping della banda
+        self.udp_idle_timeout = udp_idle_timeout  # secondi senza datagrammi dopo i quali un'associazione UDP termina
+        # Metodo e credenziali verso il relay partono insieme alla richiesta del Client e al primo payload,
+        # senza attendere le risposte; la risposta alla richiesta e' sempre quella del Producer
+        self.optimistic_connect = optimistic_connect
 
     def start_server(self, host, port):
         threading.Thread(target=self.listen_on_port, args=(host, port)).start()  # Ascolta i dispositivi A
@@ -23,13 +59,16 @@ class ClientGateway:
     def listen_on_port(self, host, port):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((host, port))
-        server_socket.listen(5)
+        server_socket.listen(self.backlog)
         logging.info("Listening for Client on port %d", port)
 
         while True:
             client_sock, addr = server_socket.accept()
             client_sock.settimeout(5)
+            ACCEPTED.inc()
             logging.info("Accepted connection from %s:%d", *addr)
             threading.Thread(target=self.handle_client, args=(client_sock,)).start()
 
@@ -37,7 +76,7 @@ class ClientGateway:
         with self.lock:
             if client_socket in self.client_socks5server_mappings:
                 del self.client_socks5server_mappings[client_socket]
-                logging.info("Client with socket %s unregistered", client_socket)
+                logging.debug("Client with socket %s unregistered", client_socket)
         
         if close_socket:
             client_socket.close()
@@ -53,47 +92,215 @@ class ClientGateway:
 
     def handle_client(self, client_socket):
 
+        started = time.monotonic()
         socks5server_for_client = Socks5Server(client_socket)
 
         try:
 
             status, username, password = socks5server_for_client.auth_handshake()
+            if socks5server_for_client.greeted_at:
+                METHOD_LATENCY.observe(socks5server_for_client.greeted_at - started)
             if not status:
                 raise Exception("Invalid authentication handshake")
         
-            status = AuthService().login_client(username, password)
+            # Il paese richiesto puo' essere indicato nello username: "mario-country-us"
+            username, country = parse_username(username)
+
+            status = self.auth_service.login_client(username, password)
             if not status:
                 raise Exception("Invalid username or password")
             
             logging.info("Client authenticated with username: %s", username)
 
             socks5server_for_client.complete_auth_handshake()
+            socks5server_for_client.flush()
+            authenticated = time.monotonic()
+            AUTH_LATENCY.observe(authenticated - socks5server_for_client.greeted_at)
 
             self.client_socks5server_mappings[client_socket] = socks5server_for_client
 
         except Exception as e:
+            HANDSHAKE_FAILURES.inc()
             logging.warning("Closing connection to Client with socket: %s", client_socket)
             logging.warning(e)
             self.unregister_client(client_socket,close_socket=True)
             return
         
 
+        relay_socket = None
+        failed_relays = set()
+        while relay_socket is None:
+
+            selected_country_relay = None
+            try:
+
+                selected_country_relay = self.select_country_relay(country, exclude=failed_relays)
+                if selected_country_relay:
+                    logging.info("Client connected and mapped to Country Relay: %s", selected_country_relay)
+                else:
+                    raise Exception("No Country Relay available")
+
+                if self.link_pool is not None:
+                    # Il link e' gia' autenticato: lo stream parte direttamente dalla fase CONNECT
+                    relay_socket = self.link_pool.open_stream(selected_country_relay, username)
+                elif self.optimistic_connect:
+                    # L'handshake verso il relay parte piu' avanti, nella stessa write della richiesta
+                    relay_socket = self.open_socket_relay_connection(selected_country_relay)
+                else:
+                    relay_socket = self.open_relay_session(selected_country_relay)
+
+            except Exception as e:
+                logging.warning(e)
+                if selected_country_relay and self.relay_directory is not None:
+                    # Failover: il relay viene segnalato e si prova il successivo dello stesso paese
+                    self.relay_directory.report_failure(selected_country_relay)
+                    failed_relays.add(selected_country_relay)
+                    if len(failed_relays) < self.relay_attempts:
+                        continue
+                HANDSHAKE_FAILURES.inc()
+                logging.warning("Closing connection to Client with socket: %s", client_socket)
+                self.reject_client(socks5server_for_client, REPLY_GENERAL_FAILURE)
+                self.unregister_client(client_socket,close_socket=True)
+                return
+
+        RELAY_CONNECT_LATENCY.observe(time.monotonic() - authenticated)
+        meter = self.accounting.open("user", username) if self.accounting is not None else None
+
+        # Per UDP ASSOCIATE il Gateway deve vedere la richiesta: il socket UDP annunciato al Client e' il suo
         try:
+            request = socks5server_for_client.peek(parse_request)
+        except Exception as e:
+            logging.warning(e)
+            self.close_tunnel(client_socket, relay_socket)
+            if meter is not None:
+                meter.close()
+            return
+        relay_handshake = self.optimistic_connect and self.link_pool is None
+        if request[1] == CMD_UDP_ASSOCIATE:
+            self.relay_udp(client_socket, relay_socket, socks5server_for_client, request, meter, relay_handshake)
+            return
+        if self.optimistic_connect:
+            self.relay_connect(client_socket, relay_socket, socks5server_for_client, request, meter, relay_handshake)
+            return
+
+        # Byte che il Client ha inviato in pipeline dopo le credenziali (richiesta CONNECT, payload)
+        pipelined = socks5server_for_client.take_buffered()
+        if pipelined:
+            try:
+                relay_socket.sendall(pipelined)
+                self.account_payload(meter, True, len(pipelined) - header_length(request))
+            except OSError as e:
+                logging.warning(e)
+                self.close_tunnel(client_socket, relay_socket)
+                if meter is not None:
+                    meter.close()
+                return
 
-            selected_country_relay = self.select_country_relay()
-            if selected_country_relay:
-                logging.info("Client connected and mapped to Country Relay: %s", selected_country_relay)
-            else:
-                logging.warning("No Country Relay available. Closing connection to Client with socket: %s", client_socket)
+        self.forwarder.forward(client_socket, relay_socket,
+                               on_close=lambda: self.close_tunnel(client_socket, relay_socket), meter=meter)
+
+    def send_request_to_relay(self, relay_socket, socks5server, handshake):
+        # Richiesta del Client (e payload gia' arrivato) cosi' com'e'; con handshake davanti metodo e
+        # credenziali del Gateway: una sola write, le risposte del Producer si leggono dopo
+        relay_socks5client = Socks5Client(relay_socket)
+        if handshake:
+            relay_socks5client.send_version_nmethods_methods()
+            relay_socks5client.send_auth("gateway", "gateway")
+        pipelined = socks5server.take_buffered()
+        relay_socks5client.write(pipelined)
+        relay_socks5client.flush()
+        if handshake and not (relay_socks5client.get_version_method_response() and
+                              relay_socks5client.get_auth_response()):
+            raise ConnectionError("Relay refused the gateway credentials")
+        return relay_socks5client, len(pipelined)
 
+    def relay_connect(self, client_socket, relay_socket, socks5server, request, meter, handshake):
+        try:
+            relay_socks5client, sent = self.send_request_to_relay(relay_socket, socks5server, handshake)
+            self.account_payload(meter, True, sent - header_length(request))
+            reply = relay_socks5client.peek(parse_request)
+            status = reply[1]
+            # Risposta del Producer con il suo codice di errore, e i primi byte della destinazione se gia' arrivati
+            buffered = relay_socks5client.take_buffered()
+            client_socket.sendall(buffered)
+            self.account_payload(meter, False, len(buffered) - header_length(reply))
+            if status != 0:
+                raise Exception(f"CONNECT refused with status {status}")
         except Exception as e:
-            logging.warning("Closing connection to Client with socket: %s", client_socket)
+            HANDSHAKE_FAILURES.inc()
             logging.warning(e)
-            self.unregister_client(client_socket,close_socket=True)
+            if isinstance(e, OSError):
+                # Il relay ha chiuso prima di rispondere (nessun Producer libero, Producer caduto)
+                self.reject_client(socks5server, REPLY_GENERAL_FAILURE)
+            self.close_tunnel(client_socket, relay_socket)
+            if meter is not None:
+                meter.close()
             return
-        
 
-        
+        self.forwarder.forward(client_socket, relay_socket,
+                               on_close=lambda: self.close_tunnel(client_socket, relay_socket), meter=meter)
+
+    @staticmethod
+    def account_payload(meter, upstream, n):
+        # Solo i byte della destinazione, senza richiesta e risposta SOCKS5. Sopra la banda
+        # concessa il thread aspetta qui, come il DataExchanger, prima di cedere il tunnel
+        if meter is None or n <= 0:
+            return
+        delay = meter.account(upstream, n)
+        if delay:
+            time.sleep(delay)
+
+    def reject_client(self, socks5server, status):
+        # Risposta d'errore alla richiesta del Client, anche se non e' ancora stata letta
+        try:
+            socks5server.send_status(status)
+        except OSError:
+            pass
+
+    def relay_udp(self, client_socket, relay_socket, socks5server, request, meter, handshake=False):
+        _, _, _, address, port = request
+        udp_socket = None
+        try:
+            # La richiesta arriva al Producer cosi' com'e'; la risposta viene riscritta con il socket UDP del Gateway
+            relay_socks5client, _ = self.send_request_to_relay(relay_socket, socks5server, handshake)
+            _, status, _, _, _ = relay_socks5client.read(parse_request)
+            if status != 0:
+                socks5server.send_status(status)
+                raise Exception(f"UDP ASSOCIATE refused with status {status}")
+
+            udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            udp_socket.bind((client_socket.getsockname()[0], 0))
+            socks5server.send_status(0, udp_socket.getsockname())
+
+            # DST.ADDR/DST.PORT della richiesta: la porta vale solo se l'indirizzo e' quello visto dal Gateway
+            client_ip = client_socket.getpeername()[0]
+            client_port = port if address in (client_ip, "0.0.0.0", "::") else 0
+            association = ClientUdpAssociation(client_socket, relay_socket, udp_socket, (client_ip, client_port),
+                                               idle_timeout=self.udp_idle_timeout, meter=meter,
+                                               initial_data=relay_socks5client.take_buffered())
+        except Exception as e:
+            HANDSHAKE_FAILURES.inc()
+            logging.warning(e)
+            if udp_socket is not None:
+                udp_socket.close()
+            self.close_tunnel(client_socket, relay_socket)
+            if meter is not None:
+                meter.close()
+            return
+
+        logging.info("UDP association for %s on %s:%d", client_ip, *udp_socket.getsockname())
+        try:
+            association.run()
+        except Exception as e:
+            logging.warning("UDP association terminated: %s", e)
+        finally:
+            association.close()
+            self.close_tunnel(client_socket, relay_socket)
+            if meter is not None:
+                meter.close()
+
+    def open_relay_session(self, selected_country_relay):
+        relay_socket = None
         try:
 
             logging.info("Opening connection to Country Relay: %s", selected_country_relay)
@@ -105,27 +312,25 @@ class ClientGateway:
             
             relay_socks5client = Socks5Client(relay_socket)
 
+            # Metodo e credenziali partono insieme: un solo round trip verso il relay
             relay_socks5client.send_version_nmethods_methods()
+            relay_socks5client.send_auth("gateway","gateway")
 
             status = relay_socks5client.get_version_method_response()
             if not status:
                 raise Exception("Invalid version/method response")
             
-            relay_socks5client.send_auth("gateway","gateway")
             status = relay_socks5client.get_auth_response()
             if not status:
                 raise Exception("Invalid authentication response")
 
-
-        except Exception as e:
-            logging.warning("Closing connection to Client with socket: %s", client_socket)
-            logging.warning(e)
-            self.unregister_client(client_socket,close_socket=True)
+        except Exception:
             self.destroy_relay_socket(relay_socket)
-            return
+            raise
 
-        DataExchanger(client_socket, relay_socket).exchange_data()
+        return relay_socket
 
+    def close_tunnel(self, client_socket, relay_socket):
         self.unregister_client(client_socket,close_socket=True)
         self.destroy_relay_socket(relay_socket)
 
@@ -133,17 +338,84 @@ class ClientGateway:
 
     def open_socket_relay_connection(self, selected_country_relay):
         relay_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        relay_socket.connect((selected_country_relay, 60000))
+        relay_socket.connect((selected_country_relay, self.relay_port))
+        # Handshake a messaggi piccoli: nessuna attesa dell'ACK per la richiesta dopo le credenziali
+        relay_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         return relay_socket
 
-    def select_country_relay(self):
-        return "it.skynetproxy.com"
+    def select_country_relay(self, country=None, exclude=()):
+        if self.relay_directory is None:
+            return "it.skynetproxy.com"
+        return self.relay_directory.select(country, exclude)
 
     def notify_disconnection_to_device_a(self, disconnected_device_b):
             pass
 
 if __name__ == "__main__":
-    server = ClientGateway()
     HOST = "0.0.0.0"
     PORT = 10000  # Porta per i dispositivi B
-    server.start_server(HOST, PORT)
+    EXCHANGE_MODE = "thread"  # "thread", "splice", "buffered", "asyncio" oppure "epoll"
+    BUFFER_SIZE = 4096
+    USE_RELAY_LINKS = False  # link persistenti e multiplexati verso i relay
+    RELAY_LINK_PORT = 60001
+    RELAY_LINKS_PER_RELAY = 2
+    RELAYS = [("it", "it.skynetproxy.com"), ("us", "us.skynetproxy.com"), ("de", "de.skynetproxy.com")]
+    RELAY_STATUS_PORT = 60002
+    DEFAULT_COUNTRY = "it"
+    AUTH_DB = None  # database SQLite degli utenti (authservice.SqliteBackend); None accetta tutti
+    ACCOUNTING_DB = None  # database SQLite dei byte per utente; None li tiene solo in memoria
+    USER_RATE = None  # byte/s massimi per utente
+    TOTAL_RATE = None  # byte/s totali del Gateway, divisi in parti uguali tra gli utenti attivi
+    METRICS_PORT = 9100  # endpoint HTTP locale delle metriche (un worker per porta a partire da questa)
+    UDP_IDLE_TIMEOUT = 120  # secondi senza datagrammi prima di chiudere un'associazione UDP ASSOCIATE
+    OPTIMISTIC_CONNECT = True  # handshake verso il relay in pipeline con la richiesta del Client e il primo payload
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="numero di processi che condividono la porta")
+    parser.add_argument("--backlog", type=int, default=5, help="backlog del socket in ascolto")
+    args = parser.parse_args()
+
+    def create_auth_service():
+        from authservice import SqliteBackend
+        return AuthService(SqliteBackend(AUTH_DB) if AUTH_DB else None)
+
+    def create_accounting():
+        from accounting import Accounting, SqliteUsageStore
+        store = SqliteUsageStore(ACCOUNTING_DB) if ACCOUNTING_DB else None
+        return Accounting(store, rate=USER_RATE, total_rate=TOTAL_RATE)
+
+    def create_relay_directory():
+        from relaydirectory import RelayDirectory
+        relay_directory = RelayDirectory(RELAYS, RELAY_STATUS_PORT, DEFAULT_COUNTRY)
+        relay_directory.start()
+        return relay_directory
+
+    def create_link_pool(relay_directory):
+        if not USE_RELAY_LINKS:
+            return None
+        from relaylinks import RelayLinkPool
+        link_pool = RelayLinkPool(RELAY_LINK_PORT, RELAY_LINKS_PER_RELAY)
+        link_pool.start(relay_directory.hosts())
+        return link_pool
+
+    if args.workers > 1:
+        from workers import run_workers
+
+        def start_worker(index):
+            relay_directory = create_relay_directory()
+            server = ClientGateway(EXCHANGE_MODE, BUFFER_SIZE, args.backlog, reuse_port=True,
+                                   link_pool=create_link_pool(relay_directory), relay_directory=relay_directory,
+                                   auth_service=create_auth_service(), accounting=create_accounting(),
+                                   udp_idle_timeout=UDP_IDLE_TIMEOUT, optimistic_connect=OPTIMISTIC_CONNECT)
+            start_http_server(METRICS_PORT + index)
+            server.start_server(HOST, PORT)
+
+        run_workers(args.workers, start_worker)
+    else:
+        relay_directory = create_relay_directory()
+        server = ClientGateway(EXCHANGE_MODE, BUFFER_SIZE, args.backlog,
+                               link_pool=create_link_pool(relay_directory), relay_directory=relay_directory,
+                               auth_service=create_auth_service(), accounting=create_accounting(),
+                               udp_idle_timeout=UDP_IDLE_TIMEOUT, optimistic_connect=OPTIMISTIC_CONNECT)
+        start_http_server(METRICS_PORT)
+        server.start_server(HOST, PORT)
@@ -0,0 +1,182 @@
+import time
+import errno
+import select
+import socket
+import threading
+from collections import OrderedDict
+
+# Codici di risposta SOCKS5 (RFC 1928, campo REP)
+REPLY_SUCCEEDED = 0
+REPLY_GENERAL_FAILURE = 1
+REPLY_NOT_ALLOWED = 2
+REPLY_NETWORK_UNREACHABLE = 3
+REPLY_HOST_UNREACHABLE = 4
+REPLY_CONNECTION_REFUSED = 5
+REPLY_TTL_EXPIRED = 6
+REPLY_COMMAND_NOT_SUPPORTED = 7
+REPLY_ADDRESS_TYPE_NOT_SUPPORTED = 8
+
+ERRNO_REPLIES = {
+    errno.ECONNREFUSED: REPLY_CONNECTION_REFUSED,
+    errno.ENETUNREACH: REPLY_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: REPLY_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: REPLY_HOST_UNREACHABLE,
+    errno.EADDRNOTAVAIL: REPLY_NETWORK_UNREACHABLE,
+    errno.EAFNOSUPPORT: REPLY_NETWORK_UNREACHABLE,
+    errno.EACCES: REPLY_NOT_ALLOWED,
+    errno.EPERM: REPLY_NOT_ALLOWED,
+}
+
+# Quando falliscono tutti gli indirizzi si risponde con l'errore piu' specifico
+REPLY_PRIORITY = (REPLY_CONNECTION_REFUSED, REPLY_NOT_ALLOWED, REPLY_HOST_UNREACHABLE,
+                  REPLY_NETWORK_UNREACHABLE, REPLY_GENERAL_FAILURE)
+
+# Errori lenti da scoprire: vale la pena ricordarli per non ripagare il timeout
+CACHED_ERRORS = {errno.ETIMEDOUT, errno.ENETUNREACH, errno.EHOSTUNREACH}
+
+
+class ConnectError(OSError):
+    """Connessione in uscita fallita; reply e' il codice da restituire al Client SOCKS5."""
+
+    def __init__(self, reply, message):
+        super().__init__(message)
+        self.reply = reply
+
+
+def interleave(addresses, prefer_ipv6=False):
+    # RFC 8305, sezione 4: si alternano le famiglie partendo da quella preferita
+    ipv6 = [a for a in addresses if ":" in a]
+    ipv4 = [a for a in addresses if ":" not in a]
+    first, second = (ipv6, ipv4) if prefer_ipv6 else (ipv4, ipv6)
+    ordered = []
+    for index in range(max(len(first), len(second))):
+        ordered.extend(family[index] for family in (first, second) if index < len(family))
+    return ordered
+
+
+class Connector:
+    """Connessioni in uscita in stile Happy Eyeballs (RFC 8305) con scadenza.
+
+    I candidati partono a connection_attempt_delay secondi l'uno dall'altro (subito se
+    il precedente fallisce) e vince il primo che completa il three-way handshake; gli
+    altri vengono chiusi. Tutto il tentativo e' limitato da timeout secondi. Le
+    destinazioni che vanno in timeout o risultano irraggiungibili restano in cache per
+    unreachable_ttl secondi e vengono rifiutate subito (0 disabilita la cache).
+    """
+
+    def __init__(self, timeout=10, connection_attempt_delay=0.25, prefer_ipv6=False,
+                 unreachable_ttl=30, max_entries=10000):
+        self.timeout = timeout
+        self.connection_attempt_delay = connection_attempt_delay
+        self.prefer_ipv6 = prefer_ipv6
+        self.unreachable_ttl = unreachable_ttl
+        self.max_entries = max_entries
+        self.unreachable = OrderedDict()  # (indirizzo, porta) -> (scadenza, reply)
+        self.lock = threading.Lock()
+
+    def connect(self, addresses, port, timeout=None):
+        """Socket bloccante connesso al primo indirizzo raggiungibile; ConnectError altrimenti."""
+        deadline = time.monotonic() + (timeout or self.timeout)
+        replies = []
+        candidates = []
+        for address in interleave(addresses, self.prefer_ipv6):
+            reply = self.cached_failure(address, port)
+            if reply is None:
+                candidates.append(address)
+            else:
+                replies.append(reply)
+        if not candidates:
+            raise ConnectError(self.best_reply(replies), f"{addresses}:{port} recently unreachable")
+
+        poller = select.poll()
+        pending = {}  # fd -> (socket, indirizzo)
+        next_attempt = 0
+        try:
+            while candidates or pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+
+                if candidates and (not pending or now >= next_attempt):
+                    address = candidates.pop(0)
+                    try:
+                        sock = socket.socket(socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM)
+                    except OSError as e:  # famiglia non supportata dall'host
+                        replies.append(self.failed(address, port, e.errno))
+                        continue
+                    sock.setblocking(False)
+                    error = sock.connect_ex((address, port))
+                    if error == 0:
+                        return self.established(sock)
+                    if error == errno.EINPROGRESS:
+                        pending[sock.fileno()] = (sock, address)
+                        poller.register(sock, select.POLLOUT)
+                        next_attempt = now + self.connection_attempt_delay
+                    else:
+                        sock.close()
+                        replies.append(self.failed(address, port, error))
+                    continue
+
+                wait = deadline - now
+                if candidates:
+                    wait = min(wait, next_attempt - now)
+                for fd, _ in poller.poll(max(0, wait) * 1000):
+                    sock, address = pending.pop(fd)
+                    poller.unregister(fd)
+                    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if error == 0:
+                        return self.established(sock)
+                    sock.close()
+                    replies.append(self.failed(address, port, error))
+                    next_attempt = 0  # un fallimento fa partire subito il candidato successivo
+
+            for sock, address in pending.values():
+                replies.append(self.failed(address, port, errno.ETIMEDOUT))
+            raise ConnectError(self.best_reply(replies), f"Connection to {addresses}:{port} failed")
+        finally:
+            for sock, _ in pending.values():
+                sock.close()
+
+    def established(self, sock):
+        sock.setblocking(True)
+        return sock
+
+    def failed(self, address, port, error):
+        reply = ERRNO_REPLIES.get(error, REPLY_GENERAL_FAILURE)
+        if error in CACHED_ERRORS and self.unreachable_ttl:
+            with self.lock:
+                self.unreachable[(address, port)] = (time.monotonic() + self.unreachable_ttl, reply)
+                self.unreachable.move_to_end((address, port))
+                while len(self.unreachable) > self.max_entries:
+                    self.unreachable.popitem(last=False)
+        return reply
+
+    def cached_failure(self, address, port):
+        if not self.unreachable_ttl:
+            return None
+        with self.lock:
+            cached = self.unreachable.get((address, port))
+            if cached is None:
+                return None
+            if cached[0] <= time.monotonic():
+                del self.unreachable[(address, port)]
+                return None
+            return cached[1]
+
+    def best_reply(self, replies):
+        for reply in REPLY_PRIORITY:
+            if reply in replies:
+                return reply
+        return REPLY_GENERAL_FAILURE
+
+
+_default_connector = None
+_default_connector_lock = threading.Lock()
+
+
+def get_default_connector():
+    global _default_connector
+    with _default_connector_lock:
+        if _default_connector is None:
+            _default_connector = Connector()
+        return _default_connector
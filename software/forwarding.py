@@ -0,0 +1,75 @@
+import logging
+from functools import partial
+from socks5 import DataExchanger, TunnelIdleTimeout
+from metrics import TUNNELS_OPENED, TUNNELS_CLOSED, TUNNELS_IDLE_CLOSED
+
+
+class Forwarder:
+    """Sceglie come trasportare i dati di un tunnel una volta completato l'handshake.
+
+    - "thread": DataExchanger bloccante nel thread chiamante
+    - "splice": come "thread" ma senza copie (os.splice su Linux, recv_into su memoryview altrove)
+    - "buffered": come "thread" ma con socket non bloccanti, un buffer limitato per direzione
+      (high_watermark/low_watermark) e half-close: un lato lento non ferma l'altra direzione
+    - "asyncio": il tunnel viene ceduto a un AsyncRelayEngine condiviso e la chiamata ritorna subito
+    - "epoll": il tunnel viene ceduto a un TunnelMultiplexer (un selector per core) e la chiamata ritorna subito
+
+    Con idle_timeout un tunnel senza traffico per quei secondi viene chiuso, in tutte le modalita'.
+    """
+
+    MODES = ("thread", "splice", "buffered", "asyncio", "epoll")
+
+    def __init__(self, mode="thread", buffer_size=4096, high_watermark=None, low_watermark=None, idle_timeout=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown forwarding mode: {mode}")
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.high_watermark = high_watermark or 4 * buffer_size
+        self.low_watermark = low_watermark
+        self.idle_timeout = idle_timeout
+        self.engine = None
+
+        if mode == "asyncio":
+            from asyncrelay import AsyncRelayEngine
+            self.engine = AsyncRelayEngine(buffer_size, idle_timeout)
+            self.engine.start()
+        elif mode == "epoll":
+            from multiplexer import TunnelMultiplexer
+            self.engine = TunnelMultiplexer(buffer_size=buffer_size, idle_timeout=idle_timeout)
+            self.engine.start()
+
+    def forward(self, sock_a, sock_b, on_close=None, meter=None):
+        # meter (accounting.TunnelMeter): i byte letti da sock_a contano come upload
+        TUNNELS_OPENED.inc()
+        on_close = partial(self.tunnel_closed, on_close, meter)
+
+        if self.engine is not None:
+            self.engine.submit(sock_a, sock_b, on_close, meter)
+            return
+
+        try:
+            if self.mode == "buffered":
+                exchanger = DataExchanger(sock_a, sock_b, self.buffer_size, meter=meter,
+                                          high_watermark=self.high_watermark, low_watermark=self.low_watermark,
+                                          idle_timeout=self.idle_timeout)
+            else:
+                exchanger = DataExchanger(sock_a, sock_b, self.buffer_size, zero_copy=(self.mode == "splice"),
+                                          meter=meter, idle_timeout=self.idle_timeout)
+            exchanger.exchange_data()
+        except TunnelIdleTimeout:
+            TUNNELS_IDLE_CLOSED.inc()
+            logging.debug("Tunnel closed after %s idle seconds", self.idle_timeout)
+        except Exception as e:
+            logging.warning("Data exchange terminated: %s", e)
+        finally:
+            on_close()
+
+    @staticmethod
+    def tunnel_closed(on_close, meter):
+        TUNNELS_CLOSED.inc()
+        try:
+            if on_close:
+                on_close()
+        finally:
+            if meter is not None:
+                meter.close()
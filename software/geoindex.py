@@ -0,0 +1,179 @@
+import os
+import sys
+import mmap
+import struct
+import socket
+import ipaddress
+from array import array
+
+# Intestazione del file: magic, ordine dei byte, bit per livello, numero di nodi, numero di valori
+HEADER = struct.Struct("<8sBBxxII")
+VALUE = struct.Struct("<2sxxI")  # paese ISO a due lettere e ASN (0 se sconosciuto), letti dal file a ogni lookup
+MAGIC = b"GEOTRIE1"
+BYTEORDERS = {"little": 0, "big": 1}
+STRIDE = 4  # bit consumati a ogni livello: 16 entry (64 byte) per nodo, 8 passi per un indirizzo IPv4
+LEAF = 0x80000000  # entry foglia: indice del valore; altrimenti indice del nodo figlio (0 = nessun dato)
+ROOTS = {4: 0, 6: 1}  # radice IPv4 e IPv6: mai figli di altri nodi
+
+
+def parse_address(address):
+    """(versione, intero) di un indirizzo testuale; gli IPv4 mappati in IPv6 tornano IPv4."""
+    if ":" in address:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, address.split("%", 1)[0]), "big")
+        if value >> 32 == 0xFFFF:
+            return 4, value & 0xFFFFFFFF
+        return 6, value
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, address), "big")
+
+
+class PrefixIndexBuilder:
+    """Costruisce il trie multibit dei prefissi CIDR e lo salva nel formato di PrefixIndex.
+
+    I prefissi vanno inseriti dal piu' corto al piu' lungo (build() li ordina): un
+    prefisso che non cade sul confine di un livello viene espanso sulle entry che
+    copre, e un prefisso piu' lungo che scende sotto una foglia crea un nodo figlio
+    che eredita il valore della foglia. Cosi' ogni entry e' o una foglia o un figlio
+    e il lookup si ferma alla prima foglia (longest prefix match).
+    """
+
+    def __init__(self, stride=STRIDE):
+        if 32 % stride:
+            raise ValueError("stride must divide 32")
+        self.stride = stride
+        self.fanout = 1 << stride
+        self.nodes = array("I", bytes(4 * self.fanout * len(ROOTS)))
+        self.values = []
+        self.value_ids = {}
+
+    @property
+    def node_count(self):
+        return len(self.nodes) // self.fanout
+
+    def value_id(self, value):
+        value_id = self.value_ids.get(value)
+        if value_id is None:
+            value_id = self.value_ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+    def new_node(self, fill):
+        node = self.node_count
+        self.nodes.extend([fill] * self.fanout)
+        return node
+
+    def insert(self, network, value):
+        bits = network.max_prefixlen
+        prefix = int(network.network_address)
+        length = network.prefixlen
+        entry_value = LEAF | self.value_id(value)
+
+        node = ROOTS[network.version]
+        depth = 0
+        while length - depth > self.stride:
+            index = node * self.fanout + ((prefix >> (bits - depth - self.stride)) & (self.fanout - 1))
+            entry = self.nodes[index]
+            if entry == 0 or entry & LEAF:
+                entry = self.nodes[index] = self.new_node(entry)
+            node = entry
+            depth += self.stride
+
+        # Ultimo livello: il prefisso copre 2^(stride - bit restanti) entry consecutive
+        first = (prefix >> (bits - depth - self.stride)) & (self.fanout - 1)
+        base = node * self.fanout
+        for index in range(base + first, base + first + (1 << (depth + self.stride - length))):
+            self.nodes[index] = entry_value
+
+    def build(self, rows):
+        # rows: (cidr, paese, asn)
+        networks = []
+        for cidr, country, asn in rows:
+            if len(country) != 2:
+                raise ValueError(f"Invalid country code {country!r} for {cidr}")
+            networks.append((ipaddress.ip_network(cidr, strict=False), (country.lower(), asn)))
+        networks.sort(key=lambda item: item[0].prefixlen)
+        for network, value in networks:
+            self.insert(network, value)
+        return self
+
+    def save(self, path):
+        # Scrittura atomica: un gateway in esecuzione continua a usare il vecchio file mappato
+        header = HEADER.pack(MAGIC, BYTEORDERS[sys.byteorder], self.stride, self.node_count, len(self.values))
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            self.nodes.tofile(f)
+            f.write(b"".join(VALUE.pack(country.encode("ascii"), asn or 0) for country, asn in self.values))
+        os.replace(tmp_path, path)
+
+
+def read_csv(path):
+    # Righe "rete,paese,asn"; si saltano commenti e intestazione
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("network"):
+                continue
+            cidr, country, asn = line.split(",")[:3]
+            yield cidr, country, int(asn) if asn else None
+
+
+class PrefixIndex:
+    """Indice CIDR -> (paese, ASN) letto direttamente dal file mappato in memoria.
+
+    All'avvio si mappa il file senza leggerlo: nodi e valori restano nella page cache
+    e sono condivisi tra i worker. lookup() fa al piu' bits / stride accessi all'array
+    dei nodi e decodifica solo il valore trovato.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, byteorder, self.stride, node_count, value_count = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a prefix index")
+        if byteorder != BYTEORDERS[sys.byteorder]:
+            raise ValueError(f"{path} was built on a machine with a different byte order")
+        self.fanout = 1 << self.stride
+        self.values_offset = HEADER.size + node_count * self.fanout * 4
+        if len(self.map) < self.values_offset + value_count * VALUE.size:
+            raise ValueError(f"{path} is truncated")
+        self.nodes = memoryview(self.map)[HEADER.size:self.values_offset].cast("I")
+
+    def close(self):
+        self.nodes.release()
+        self.map.close()
+
+    def lookup(self, address):
+        """(paese, asn) del prefisso piu' specifico che contiene address, None se assente."""
+        try:
+            version, value = parse_address(address)
+        except OSError:
+            return None
+        stride = self.stride
+        mask = self.fanout - 1
+        nodes = self.nodes
+        node = ROOTS[version]
+        shift = (32 if version == 4 else 128) - stride
+        while True:
+            entry = nodes[(node << stride) | ((value >> shift) & mask)]
+            if entry & LEAF:
+                country, asn = VALUE.unpack_from(self.map, self.values_offset + (entry & ~LEAF) * VALUE.size)
+                return country.decode("ascii"), asn or None
+            if not entry:
+                return None
+            node = entry
+            shift -= stride
+
+
+def build_index(csv_path, index_path, stride=STRIDE):
+    builder = PrefixIndexBuilder(stride).build(read_csv(csv_path))
+    builder.save(index_path)
+    return builder
+
+
+def load_index(csv_path, index_path):
+    # Ricostruisce l'indice solo se manca o e' piu' vecchio del dataset
+    if csv_path and os.path.exists(csv_path):
+        if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(csv_path):
+            build_index(csv_path, index_path)
+    return PrefixIndex(index_path)
@@ -1,73 +1,211 @@
+import time
 import socket
 import threading
-import random
 import logging
 import struct
-from socks5 import Socks5Server, Socks5Client, DataExchanger
+from socks5 import Socks5Server, Socks5Client, Socks5Connection, DataExchanger, parse_request
 from authservice import AuthService
+from forwarding import Forwarder
+from mux import MuxSession, HANDSHAKE_MUX_FLAG
+from scheduler import ShardedScheduler, measure_rtt
+from liveness import HeartbeatMonitor
+from metrics import REGISTRY, start_http_server
+from logpipeline import setup_logging
 import select
+import argparse
+import json
+import hashlib
 
-# Configurazione del logging
-logging.basicConfig(filename='geotcprelay.log', level=logging.INFO, 
-                    format='%(asctime)s - %(levelname)s - %(message)s', filemode='w')
+# Configurazione del logging: JSON su file scritto da un thread dedicato
+setup_logging('geotcprelay.log')
+
+PRODUCERS_ACCEPTED = REGISTRY.counter("relay_accepted_total", "Connections accepted", {"role": "producer"})
+CLIENTS_ACCEPTED = REGISTRY.counter("relay_accepted_total", "Connections accepted", {"role": "client"})
+NO_PRODUCER = REGISTRY.counter("relay_no_producer_total", "Clients rejected because no Producer was free")
+PRODUCER_HANDSHAKE_LATENCY = REGISTRY.histogram("relay_handshake_seconds", "Relay handshake latency per phase",
+                                                {"phase": "producer"})
+PRODUCERS_EVICTED = REGISTRY.counter("relay_producers_evicted_total", "Parked Producers found dead by the heartbeat monitor")
+PRODUCER_AUTH_LATENCY = REGISTRY.histogram("relay_handshake_seconds", "Relay handshake latency per phase",
+                                           {"phase": "producer_session_auth"})
 
 class GeoTcpRelay:
-    def __init__(self):
-        self.producers = []
+    def __init__(self, exchange_mode="thread", buffer_size=4096, backlog=5, reuse_port=False, registry=None,
+                 scheduling_policy="random", sticky_sessions=False, auth_service=None, accounting=None,
+                 heartbeat_interval=15, heartbeat_timeout=45, idle_timeout=None, scheduler_shards=None):
+        # Producer liberi: socket singoli e MuxSession che trasportano piu' stream su una connessione.
+        # Niente lock globale: lo scheduler ha un lock per shard e i dizionari qui sotto vengono
+        # toccati solo con singole operazioni (atomiche) da chi possiede il socket
+        self.scheduler = ShardedScheduler(scheduling_policy, sticky_sessions, shards=scheduler_shards)
+        self.mux_streams = {}  # stream socket -> MuxSession da cui e' stato aperto
         self.client_producer_mappings = {}  # Mappatura tra dispositivi A e B
-        self.lock = threading.Lock()
+        self.forwarder = Forwarder(exchange_mode, buffer_size, idle_timeout=idle_timeout)
+        # Heartbeat sui Producer parcheggiati: quelli morti escono dallo scheduler prima di essere scelti
+        self.liveness = HeartbeatMonitor(self.evict_producer, heartbeat_interval, heartbeat_timeout)
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.registry = registry  # ProducerRegistryClient quando si gira con piu' worker
+        self.auth_service = auth_service or AuthService()  # condivisa tra tutte le connessioni
+        self.accounting = accounting  # Accounting: byte trasportati per API key dei Producer
+        self.producer_api_keys = {}  # socket del Producer -> API key
+        self.listeners = {}  # nome -> socket in ascolto, da cedere al relay successivo con l'hot restart
+        self.accept_threads = []
+        self.gateway_links = set()  # MuxSession dei link dei ClientGateway
+        self.draining = False  # hot restart: non si accettano nuove connessioni
+        REGISTRY.gauge("relay_producers", "Registered Producers (sockets and mux sessions)", lambda: len(self.scheduler))
+        REGISTRY.gauge("relay_producer_free_slots", "Free Producer capacity in this process",
+                       lambda: self.scheduler.free_slots)
+        REGISTRY.gauge("relay_clients", "Clients mapped to a Producer", lambda: len(self.client_producer_mappings))
 
-    def start_server(self, host, port_b, port_a):
-        threading.Thread(target=self.listen_on_port, args=(host, port_b, True)).start()  # Ascolta i dispositivi B
-        threading.Thread(target=self.listen_on_port, args=(host, port_a, False)).start()  # Ascolta i dispositivi A
+    def start_server(self, host, port_b, port_a, port_links=None, port_status=None, listeners=None):
+        # listeners: socket in ascolto ceduti dal relay precedente (hot restart), per nome
+        listeners = listeners or {}
+        self.liveness.start()
+        self.listen("producers", host, port_b, True, listeners)  # Ascolta i dispositivi B
+        self.listen("clients", host, port_a, False, listeners)  # Ascolta i dispositivi A
+        if port_links:
+            # Link persistenti e multiplexati dai ClientGateway
+            self.listen("links", host, port_links, False, listeners, self.handle_gateway_link)
+        if port_status:
+            # Probe di salute e capacita' dei ClientGateway
+            self.listen("status", host, port_status, False, listeners, self.handle_status_probe)
         logging.info("Server started and listening on ports %d and %d", port_b, port_a)
 
-    def listen_on_port(self, host, port, is_device_b):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server_socket.bind((host, port))
-        server_socket.listen(5)
-        logging.info("Listening for %s on port %d", 'Producer' if is_device_b else 'Client', port)
+    def listen(self, name, host, port, is_device_b, listeners, handler=None):
+        server_socket = listeners.get(name)
+        if server_socket is None:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            server_socket.bind((host, port))
+            server_socket.listen(self.backlog)
+        self.listeners[name] = server_socket
+        thread = threading.Thread(target=self.listen_on_port, args=(server_socket, is_device_b, handler))
+        self.accept_threads.append(thread)
+        thread.start()
 
-        while True:
-            client_sock, addr = server_socket.accept()
+    def listen_on_port(self, server_socket, is_device_b, handler=None):
+        # Non bloccante: durante l'hot restart lo stesso socket e' in ascolto in due processi
+        server_socket.setblocking(False)
+        poller = select.poll()
+        poller.register(server_socket, select.POLLIN)
+        logging.info("Listening for %s on port %d", 'Producer' if is_device_b else 'Client',
+                     server_socket.getsockname()[1])
+
+        while not self.draining:
+            if not poller.poll(1000):
+                continue
+            try:
+                client_sock, addr = server_socket.accept()
+            except BlockingIOError:
+                continue  # connessione presa dall'altro processo
             logging.info("Accepted connection from %s:%d", *addr)
-            if is_device_b:
+            (PRODUCERS_ACCEPTED if is_device_b else CLIENTS_ACCEPTED).inc()
+            if handler:
+                threading.Thread(target=handler, args=(client_sock,)).start()
+            elif is_device_b:
                 threading.Thread(target=self.handle_producer, args=(client_sock,)).start()
             else:
                 threading.Thread(target=self.handle_client, args=(client_sock,)).start()
         
     def unregister_producer(self, producer_socket, close_socket=False):
-        with self.lock:
-            if producer_socket in self.producers:
-                self.producers.remove(producer_socket)
-                logging.info("Producer with socket %s unregistered", producer_socket)
+        session = self.mux_streams.pop(producer_socket, None)
+        if session is not None:
+            # Fine di uno stream: la sessione multiplexata torna disponibile
+            self.scheduler.release(session, measure_rtt(session.sock))
+        else:
+            self.liveness.remove(producer_socket)
+            if self.scheduler.remove(producer_socket):
+                logging.debug("Producer with socket %s unregistered", producer_socket)
+        self.producer_api_keys.pop(producer_socket, None)
         
         if close_socket:
             producer_socket.close()
-            logging.info("Connection closed with Producer with socket: %s", producer_socket)
+            logging.debug("Connection closed with Producer with socket: %s", producer_socket)
+
+    def unregister_mux_session(self, session):
+        self.liveness.remove(session)
+        if self.scheduler.remove(session):
+            logging.info("Multiplexed Producer unregistered")
+
+    def evict_producer(self, producer):
+        # Chiamato dal HeartbeatMonitor
+        PRODUCERS_EVICTED.inc()
+        if isinstance(producer, MuxSession):
+            producer.close()  # la sessione si deregistra da sola in unregister_mux_session
+            logging.info("Multiplexed Producer evicted: no traffic for %d seconds", self.liveness.timeout)
+            return
+        # Se nel frattempo e' stato assegnato a un Client, ci pensa la chiusura del tunnel
+        if self.scheduler.remove_idle(producer):
+            self.producer_api_keys.pop(producer, None)
+            producer.close()
+            logging.info("Dead parked Producer evicted")
+
+    def stop_accepting(self):
+        # Hot restart: i socket in ascolto sono passati al nuovo relay
+        self.draining = True
+        for thread in self.accept_threads:
+            thread.join()
+        # I ClientGateway spostano i link sul nuovo relay appena quelli vecchi non hanno piu' stream
+        for link in list(self.gateway_links):
+            link.go_away()
+
+    def take_idle_producers(self):
+        # Hot restart: i Producer parcheggiati escono da scheduler e monitor per essere ceduti
+        producers = []
+        for producer in self.scheduler.take_idle():
+            if isinstance(producer, MuxSession):
+                producer.close()  # lo stato della sessione non si puo' cedere: il Producer si riconnette
+                continue
+            self.liveness.remove(producer)
+            producers.append((producer, self.producer_api_keys.pop(producer, None)))
+        return producers
+
+    def registered_too_late(self, producer):
+        # Hot restart: l'handshake e' finito dopo take_idle_producers, quindi il Producer non
+        # verrebbe ne' ceduto ne' servito. draining si legge dopo scheduler.add: o take_idle lo
+        # ha gia' preso, o lo toglie qui (remove_idle e take_idle passano dallo stesso lock)
+        if self.draining and self.scheduler.remove_idle(producer):
+            logging.info("Producer registered during hot restart, closing it so it reconnects to the new relay")
+            return True
+        return False
+
+    def adopt_producer(self, producer_socket, api_key):
+        # Producer parcheggiato ceduto dal relay precedente, gia' autenticato
+        if api_key is not None:
+            self.producer_api_keys[producer_socket] = api_key
+        self.liveness.add(producer_socket)
+        self.scheduler.add(producer_socket, rtt=measure_rtt(producer_socket))
+
+    def drain(self, timeout):
+        # Attende la fine dei tunnel attivi; False se allo scadere ce ne sono ancora
+        deadline = time.monotonic() + timeout
+        while self.client_producer_mappings and time.monotonic() < deadline:
+            time.sleep(0.5)
+        return not self.client_producer_mappings
 
     def unregister_client(self, client_socket,close_socket=False):
-        with self.lock:
-            if client_socket in self.client_producer_mappings:
-                del self.client_producer_mappings[client_socket]
-                logging.info("Client with socket %s unregistered", client_socket)
+        if self.client_producer_mappings.pop(client_socket, None) is not None:
+            logging.debug("Client with socket %s unregistered", client_socket)
         
         if close_socket:
             client_socket.close()
-            logging.info("Connection closed with Client with socket: %s", client_socket)
+            logging.debug("Connection closed with Client with socket: %s", client_socket)
 
 
     def handle_producer(self, producer_socket):
 
+        started = time.monotonic()
         try:
 
             packed_data = producer_socket.recv(128)  # Ricevi il messaggio di handshake
             api_key_length = struct.unpack('!I', packed_data[:4])[0]
+            mux = bool(api_key_length & HANDSHAKE_MUX_FLAG)
+            api_key_length &= ~HANDSHAKE_MUX_FLAG
             api_key = struct.unpack(f"!{api_key_length}s", packed_data[4:])[0].decode('utf-8')
 
 
-            status = AuthService().login_producer(api_key)
+            status = self.auth_service.login_producer(api_key)
             if not status:
                 packet = struct.pack("!B", 0)  # Invia un messaggio di errore al dispositivo B
                 producer_socket.sendall(packet)
@@ -75,10 +213,34 @@ class GeoTcpRelay:
             
             packet = struct.pack("!B", 1)
             producer_socket.sendall(packet)
+            PRODUCER_HANDSHAKE_LATENCY.observe(time.monotonic() - started)
+
+            if mux:
+                session = MuxSession(producer_socket, initiator=True, on_close=self.unregister_mux_session)
+                session.api_key = api_key
+                self.scheduler.add(session, capacity=session.max_streams, rtt=measure_rtt(producer_socket))
+                self.liveness.add(session)
+                if self.registered_too_late(session):
+                    session.close()  # eseguito da run(), che poi deregistra la sessione
+                logging.info("Multiplexed Producer connected with socket: %s", producer_socket)
+                session.run()
+                return
 
-            with self.lock:
-                self.producers.append(producer_socket)
-                logging.info("Producer connected with socket: %s", producer_socket)
+            if self.registry is not None:
+                # Il registro condiviso tiene una copia del file descriptor
+                self.registry.put(producer_socket)
+                producer_socket.close()
+                logging.info("Producer handed to the shared registry")
+                return
+
+            # L'API key deve esserci prima che un Client possa scegliere il Producer
+            self.producer_api_keys[producer_socket] = api_key
+            self.liveness.add(producer_socket)
+            self.scheduler.add(producer_socket, rtt=measure_rtt(producer_socket))
+            if self.registered_too_late(producer_socket):
+                self.unregister_producer(producer_socket, close_socket=True)
+                return
+            logging.debug("Producer connected with socket: %s", producer_socket)
         
         except Exception as e:
             logging.error("Error during handshake with Producer: %s", e)
@@ -86,50 +248,236 @@ class GeoTcpRelay:
             self.unregister_producer(producer_socket, close_socket=True)
             return
 
-    def handle_client(self, client_socket):
+    def handle_status_probe(self, probe_socket):
+        try:
+            status = {
+                "free_producers": self.scheduler.free_slots,
+                "producers": len(self.scheduler),
+                "clients": len(self.client_producer_mappings),
+            }
+            if self.registry is not None:
+                status["free_producers"] += self.registry.count()
+            probe_socket.sendall(json.dumps(status).encode('utf-8') + b"\n")
+        except Exception as e:
+            logging.warning("Error answering status probe: %s", e)
+        finally:
+            probe_socket.close()
+
+    def handle_gateway_link(self, link_socket):
 
         try:
 
-            with self.lock:
-                selected_producer = self.select_producer_for_client()
-                if selected_producer:
-                    self.client_producer_mappings[client_socket] = selected_producer
-                    logging.info("Client connected and mapped to Producer with socket: %s", selected_producer)
-                else:
-                    raise Exception("No Producer available")
-        
+            socks5server = Socks5Server(link_socket)
+            status, username, password = socks5server.auth_handshake()
+            if not status:
+                raise Exception("Invalid authentication handshake")
+
+            status = self.auth_service.login_client(username, password)
+            if not status:
+                raise Exception("Invalid username or password")
+
+            socks5server.complete_auth_handshake()
+            socks5server.flush()
+            link_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         except Exception as e:
-            logging.warning("Closing connection to Client with socket: %s", client_socket)
+            logging.warning("Closing Gateway link with socket: %s", link_socket)
             logging.warning(e)
-            self.unregister_client(client_socket,close_socket=True)
+            link_socket.close()
             return
 
-        self.exchange_data(client_socket, self.client_producer_mappings[client_socket])
+        logging.info("Gateway link established with socket: %s", link_socket)
+        link = MuxSession(link_socket, initiator=False, on_stream=self.handle_link_stream,
+                          initial_data=socks5server.take_buffered())
+        self.gateway_links.add(link)
+        try:
+            link.run()
+        finally:
+            self.gateway_links.discard(link)
+        logging.info("Gateway link closed")
 
-    def select_producer_for_client(self):
-        random_producer = random.choice(self.producers) if len(self.producers) > 0 else None
-        #remove producer from list
-        if random_producer:
-            self.producers.remove(random_producer)
-        return random_producer
+    def handle_link_stream(self, stream_socket, metadata=b""):
+        # Chiamato dal thread del link: l'abbinamento al Producer avviene altrove
+        session_key = metadata.decode('utf-8') or None
+        threading.Thread(target=self.handle_client, args=(stream_socket, True, session_key), daemon=True).start()
 
-    def exchange_data(self, client_socket, producer_socket):
+    def handle_client(self, client_socket, preauthenticated=False, session_key=None):
+
+        selected_producer = None
         try:
-            DataExchanger(client_socket, producer_socket).exchange_data()
+
+            pipelined = b""
+            if preauthenticated:
+                # La richiesta arriva sullo stream subito dopo l'apertura: la si attende prima di scegliere
+                # il Producer, per inviarla insieme a metodo e credenziali
+                link_request = Socks5Connection(client_socket)
+                link_request.peek(parse_request)
+                pipelined = link_request.take_buffered()
+
+            selected_producer = self.select_producer_for_client(session_key)
+            if selected_producer:
+                self.client_producer_mappings[client_socket] = selected_producer
+                logging.debug("Client connected and mapped to Producer with socket: %s", selected_producer)
+            else:
+                NO_PRODUCER.inc()
+                raise Exception("No Producer available")
+
+            if preauthenticated:
+                started = time.monotonic()
+                self.authenticate_producer_session(selected_producer, client_socket, pipelined)
+                PRODUCER_AUTH_LATENCY.observe(time.monotonic() - started)
+        
         except Exception as e:
             logging.warning("Closing connection to Client with socket: %s", client_socket)
             logging.warning(e)
-        finally:
+            self.unregister_client(client_socket,close_socket=True)
+            if preauthenticated and selected_producer:
+                self.unregister_producer(selected_producer, close_socket=True)
+            return
 
-            self.unregister_client(client_socket, close_socket=True)
-            self.unregister_producer(producer_socket, close_socket=True)
+        self.exchange_data(client_socket, selected_producer)
+
+    def authenticate_producer_session(self, producer_socket, client_socket, pipelined=b""):
+        # Il Gateway si e' autenticato una volta sul link: metodo e auth verso il Producer li fa il relay,
+        # inviati nella stessa write della richiesta del Client e del payload gia' arrivato
+        socks5client = Socks5Client(producer_socket)
+        socks5client.send_version_nmethods_methods()
+        socks5client.send_auth("gateway", "gateway")
+        socks5client.write(pipelined)
+        if not socks5client.get_version_method_response():
+            raise Exception("Invalid version/method response from Producer")
+        if not socks5client.get_auth_response():
+            raise Exception("Invalid authentication response from Producer")
+        # Risposta alla richiesta arrivata insieme a quella dell'auth: e' gia' del Client
+        reply = socks5client.take_buffered()
+        if reply:
+            client_socket.sendall(reply)
+
+    def select_producer_for_client(self, session_key=None):
+        while True:
+            producer = self.scheduler.acquire(session_key)
+            if producer is None:
+                break
+            if not isinstance(producer, MuxSession):
+                # Fuori dal monitor prima di scrivere i dati del Client: nessun heartbeat dopo di loro
+                self.liveness.remove(producer)
+                return producer
+            # Un Producer multiplexato costa un frame OPEN invece di una connessione
+            try:
+                stream_socket = producer.open_stream()
+            except ConnectionError:
+                self.scheduler.remove(producer)
+                continue
+            self.mux_streams[stream_socket] = producer
+            return stream_socket
+
+        if self.registry is not None:
+            return self.registry.take()
+        return None
+
+    def exchange_data(self, client_socket, producer_socket):
+        meter = None
+        if self.accounting is not None:
+            api_key = self.producer_api_key(producer_socket)
+            if api_key:
+                # Nello store finisce l'hash, come in authservice.SqliteBackend, non la chiave
+                meter = self.accounting.open("api_key", hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+        self.forwarder.forward(client_socket, producer_socket,
+                               on_close=lambda: self.close_tunnel(client_socket, producer_socket), meter=meter)
+
+    def producer_api_key(self, producer_socket):
+        # I Producer passati dal registro condiviso arrivano senza API key e non vengono conteggiati
+        session = self.mux_streams.get(producer_socket)
+        if session is not None:
+            return getattr(session, "api_key", None)
+        return self.producer_api_keys.get(producer_socket)
+
+    def close_tunnel(self, client_socket, producer_socket):
+        logging.debug("Closing connection to Client with socket: %s", client_socket)
+        self.unregister_client(client_socket, close_socket=True)
+        self.unregister_producer(producer_socket, close_socket=True)
 
-            
-            
 
 if __name__ == "__main__":
-    server = GeoTcpRelay()
     HOST = "0.0.0.0"
     PORT_B = 30000  # Porta per i dispositivi B
     PORT_A = 60000  # Porta per i dispositivi A
-    server.start_server(HOST, PORT_B, PORT_A)
\ No newline at end of file
+    PORT_LINKS = 60001  # Porta per i link persistenti dei ClientGateway
+    PORT_STATUS = 60002  # Porta per i probe di salute dei ClientGateway
+    EXCHANGE_MODE = "epoll"  # "thread", "splice", "buffered", "asyncio" oppure "epoll"
+    BUFFER_SIZE = 4096
+    SCHEDULING_POLICY = "power_of_two"  # "random", "least_loaded", "lowest_rtt" oppure "power_of_two"
+    STICKY_SESSIONS = False  # stesso Producer per lo stesso username finche' ha capacita'
+    REGISTRY_PATH = "/tmp/geotcprelay_registry.sock"
+    AUTH_DB = None  # database SQLite di API key e utenti dei link (authservice.SqliteBackend); None accetta tutti
+    ACCOUNTING_DB = None  # database SQLite dei byte per API key; None li tiene solo in memoria
+    METRICS_PORT = 9101  # endpoint HTTP locale delle metriche (un worker per porta a partire da questa)
+    HEARTBEAT_INTERVAL = 15  # secondi tra due heartbeat verso un Producer parcheggiato
+    HEARTBEAT_TIMEOUT = 45  # secondi senza conferma dopo i quali un Producer parcheggiato e' morto
+    TUNNEL_IDLE_TIMEOUT = 600  # secondi senza traffico dopo i quali un tunnel attivo viene chiuso
+    HOT_RESTART_PATH = "/tmp/geotcprelay_handoff.sock"  # il relay avviato dopo eredita porte e Producer parcheggiati; None lo disattiva
+    DRAIN_TIMEOUT = 300  # secondi concessi ai tunnel attivi del vecchio relay prima che termini
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="numero di processi che condividono le porte")
+    parser.add_argument("--backlog", type=int, default=5, help="backlog dei socket in ascolto")
+    args = parser.parse_args()
+
+    def create_auth_service():
+        from authservice import SqliteBackend
+        return AuthService(SqliteBackend(AUTH_DB) if AUTH_DB else None)
+
+    def create_accounting():
+        from accounting import Accounting, SqliteUsageStore
+        return Accounting(SqliteUsageStore(ACCOUNTING_DB) if ACCOUNTING_DB else None)
+
+    if args.workers > 1:
+        from workers import run_workers
+        from producerregistry import ProducerRegistryServer, ProducerRegistryClient
+
+        registry_server = ProducerRegistryServer(REGISTRY_PATH, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+
+        def start_worker(index):
+            server = GeoTcpRelay(EXCHANGE_MODE, BUFFER_SIZE, args.backlog, reuse_port=True,
+                                 registry=ProducerRegistryClient(REGISTRY_PATH),
+                                 scheduling_policy=SCHEDULING_POLICY, sticky_sessions=STICKY_SESSIONS,
+                                 auth_service=create_auth_service(), accounting=create_accounting(),
+                                 heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                                 idle_timeout=TUNNEL_IDLE_TIMEOUT)
+            start_http_server(METRICS_PORT + index)
+            server.start_server(HOST, PORT_B, PORT_A, PORT_LINKS, PORT_STATUS)
+
+        run_workers(args.workers, start_worker, on_started=registry_server.start)
+    else:
+        server = GeoTcpRelay(EXCHANGE_MODE, BUFFER_SIZE, args.backlog,
+                             scheduling_policy=SCHEDULING_POLICY, sticky_sessions=STICKY_SESSIONS,
+                             auth_service=create_auth_service(), accounting=create_accounting(),
+                             heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                             idle_timeout=TUNNEL_IDLE_TIMEOUT)
+        if not HOT_RESTART_PATH:
+            start_http_server(METRICS_PORT)
+            server.start_server(HOST, PORT_B, PORT_A, PORT_LINKS, PORT_STATUS)
+        else:
+            from hotrestart import HandoffServer, take_over, receive_producers
+
+            # Se un relay e' gia' in esecuzione si ereditano i suoi socket in ascolto e i Producer parcheggiati
+            handoff = take_over(HOT_RESTART_PATH)
+            if handoff is None:
+                server.start_server(HOST, PORT_B, PORT_A, PORT_LINKS, PORT_STATUS)
+            else:
+                listeners, handoff_socket = handoff
+                server.start_server(HOST, PORT_B, PORT_A, PORT_LINKS, PORT_STATUS, listeners=listeners)
+                adopted = 0
+                with handoff_socket:
+                    for producer_socket, api_key in receive_producers(handoff_socket):
+                        server.adopt_producer(producer_socket, api_key)
+                        adopted += 1
+                logging.info("Hot restart: adopted %d parked Producers", adopted)
+            # Dopo END: il vecchio relay ha gia' liberato la porta delle metriche
+            metrics_server = start_http_server(METRICS_PORT)
+
+            def close_metrics():
+                metrics_server.shutdown()
+                metrics_server.server_close()
+
+            HandoffServer(HOT_RESTART_PATH, server, DRAIN_TIMEOUT, on_handoff=close_metrics).start()
@@ -0,0 +1,109 @@
+import os
+import json
+import socket
+import logging
+import threading
+from logpipeline import stop_logging
+
+HANDOFF_BATCH = 200  # file descriptor per messaggio: il kernel ne accetta al massimo 253 (SCM_MAX_FD)
+MAX_MESSAGE = 1 << 20
+TAKEOVER = b"TAKEOVER"
+END = b"END"
+
+
+class HandoffServer(threading.Thread):
+    """Lato del relay in esecuzione: alla richiesta del processo che lo sostituisce gli cede tutto.
+
+    Sul socket unix (SOCK_SEQPACKET, un messaggio per invio) partono prima i socket in
+    ascolto, poi i Producer parcheggiati a blocchi di HANDOFF_BATCH con le loro API key,
+    passati con SCM_RIGHTS. Il vecchio relay smette di accettare, chiede ai ClientGateway
+    di spostare i link (GOAWAY), attende fino a drain_timeout secondi la fine dei tunnel
+    attivi e termina. Le MuxSession dei Producer non si possono cedere: quelle libere
+    vengono chiuse e i Producer si riconnettono al nuovo relay.
+    """
+
+    def __init__(self, path, relay, drain_timeout=300, on_handoff=None):
+        super().__init__(name="HandoffServer")  # non daemon: tiene vivo il processo durante il drain
+        self.path = path
+        self.relay = relay
+        self.drain_timeout = drain_timeout
+        self.on_handoff = on_handoff  # es. chiusura dell'endpoint delle metriche, riaperto dal nuovo relay
+        if os.path.exists(path):
+            os.unlink(path)  # del relay precedente, che ha gia' ceduto tutto
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.server_socket.bind(path)
+        self.server_socket.listen(1)
+
+    def run(self):
+        handed_over = False
+        while not handed_over:
+            conn, _ = self.server_socket.accept()
+            with conn:
+                try:
+                    if conn.recv(64) != TAKEOVER:
+                        continue
+                    logging.info("Hot restart requested, handing over to the new relay")
+                    handed_over = self.handoff(conn)
+                except OSError as e:
+                    logging.error("Hot restart handoff failed: %s", e)
+                    # Socket in ascolto gia' ceduti: il vecchio relay termina comunque
+                    handed_over = self.relay.draining
+        # Il path resta: ora appartiene al nuovo relay
+        self.server_socket.close()
+        drained = self.relay.drain(self.drain_timeout)
+        logging.info("Old relay exiting: %s", "tunnels drained" if drained else "drain timeout expired")
+        stop_logging()
+        os._exit(0)
+
+    def handoff(self, conn):
+        names = list(self.relay.listeners)
+        socket.send_fds(conn, [json.dumps(names).encode('utf-8')],
+                        [self.relay.listeners[name].fileno() for name in names])
+        # Da qui il nuovo relay accetta sugli stessi socket: non si torna indietro
+        self.relay.stop_accepting()
+
+        producers = self.relay.take_idle_producers()
+        try:
+            for start in range(0, len(producers), HANDOFF_BATCH):
+                batch = producers[start:start + HANDOFF_BATCH]
+                socket.send_fds(conn, [json.dumps([api_key for _, api_key in batch]).encode('utf-8')],
+                                [producer.fileno() for producer, _ in batch])
+        finally:
+            # Il nuovo relay ha le sue copie; se la cessione e' fallita i Producer si riconnettono
+            for producer, _ in producers:
+                producer.close()
+
+        if self.on_handoff:
+            self.on_handoff()
+        conn.send(END)
+        logging.info("Handed over %d listeners and %d parked Producers", len(names), len(producers))
+        return True
+
+
+def take_over(path, timeout=30):
+    """Chiede il subentro al relay in esecuzione su path.
+
+    Restituisce (socket in ascolto per nome, connessione di handoff), oppure None se
+    nessun relay risponde. I Producer parcheggiati si ricevono poi con receive_producers().
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    conn.settimeout(timeout)
+    conn.send(TAKEOVER)
+    message, fds, _, _ = socket.recv_fds(conn, MAX_MESSAGE, HANDOFF_BATCH)
+    names = json.loads(message)
+    return {name: socket.socket(fileno=fd) for name, fd in zip(names, fds)}, conn
+
+
+def receive_producers(conn):
+    # (socket, API key) dei Producer parcheggiati ceduti dal vecchio relay, fino a END
+    while True:
+        message, fds, _, _ = socket.recv_fds(conn, MAX_MESSAGE, HANDOFF_BATCH)
+        if not message or message == END:
+            return
+        for api_key, fd in zip(json.loads(message), fds):
+            yield socket.socket(fileno=fd), api_key
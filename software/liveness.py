@@ -0,0 +1,179 @@
+import time
+import socket
+import logging
+import selectors
+import threading
+from collections import deque
+
+# Heartbeat del relay verso un Producer parcheggiato: mai il primo byte di una sessione SOCKS5 (0x05)
+HEARTBEAT = b"\x00"
+
+
+class TimerWheel:
+    """Ruota temporizzata (hashed timing wheel): schedule, cancel e scadenza in O(1).
+
+    Ogni slot copre tick secondi e contiene i timer che scadono in quel giro o in un
+    giro successivo (il numero di giri restanti e' salvato con il timer). advance()
+    restituisce gli elementi scaduti. Non e' thread-safe: il chiamante tiene il lock.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]  # elemento -> giri restanti
+        self.timers = {}  # elemento -> indice dello slot
+        self.current = 0
+        self.last = time.monotonic()
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, item):
+        return item in self.timers
+
+    def schedule(self, item, delay):
+        self.cancel(item)
+        ticks = max(1, -int(-delay // self.tick))
+        index = (self.current + ticks) % len(self.slots)
+        self.slots[index][item] = (ticks - 1) // len(self.slots)
+        self.timers[item] = index
+
+    def cancel(self, item):
+        index = self.timers.pop(item, None)
+        if index is not None:
+            del self.slots[index][item]
+
+    def next_timeout(self):
+        return max(0, self.last + self.tick - time.monotonic())
+
+    def advance(self, now=None):
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self.last + self.tick <= now:
+            self.last += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            for item, rounds in list(slot.items()):
+                if rounds:
+                    slot[item] = rounds - 1
+                else:
+                    del slot[item]
+                    del self.timers[item]
+                    expired.append(item)
+        return expired
+
+
+class HeartbeatMonitor(threading.Thread):
+    """Controlla i Producer parcheggiati sul relay e segnala quelli morti con on_dead.
+
+    I socket singoli sono sorvegliati in lettura (un Producer parcheggiato non invia
+    nulla: EOF, errore o dati inattesi vogliono dire che e' morto) e ricevono un
+    HEARTBEAT ogni interval secondi. Con TCP_USER_TIMEOUT impostato a timeout, un
+    heartbeat non confermato entro timeout secondi (NAT scaduto, telefono sospeso)
+    fa fallire il socket e lo rende leggibile. Le MuxSession ricevono un frame PING
+    e sono morte se non arriva nulla per timeout secondi. add() si limita ad
+    accodare: il thread del monitor registra i nuovi Producer a blocchi.
+    """
+
+    def __init__(self, on_dead, interval=15, timeout=45, tick=1.0):
+        super().__init__(name="HeartbeatMonitor", daemon=True)
+        self.on_dead = on_dead
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+        self.selector = selectors.DefaultSelector()
+        self.sockets = set()
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.wheel) + len(self.pending)
+
+    def add(self, producer):
+        self.pending.append(producer)
+
+    def drain(self):
+        # Con il lock
+        while self.pending:
+            producer = self.pending.popleft()
+            if isinstance(producer, socket.socket):
+                try:
+                    self.selector.register(producer, selectors.EVENT_READ)
+                except (ValueError, OSError):
+                    continue  # gia' chiuso prima di essere registrato
+                self.set_user_timeout(producer, self.timeout)
+                self.sockets.add(producer)
+            self.wheel.schedule(producer, self.interval)
+
+    def remove(self, producer):
+        # Da chiamare prima di cedere il Producer a un Client o di chiudere il socket
+        with self.lock:
+            self.drain()
+            return self.discard(producer)
+
+    def discard(self, producer):
+        if producer not in self.wheel:
+            return False
+        self.wheel.cancel(producer)
+        if producer in self.sockets:
+            self.sockets.remove(producer)
+            self.selector.unregister(producer)
+            self.set_user_timeout(producer, 0)
+        return True
+
+    @staticmethod
+    def set_user_timeout(sock, timeout):
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(timeout * 1000))
+        except (AttributeError, OSError):
+            pass  # non Linux o socket gia' chiuso: restano il controllo in lettura e i PING
+
+    def run(self):
+        while True:
+            events = self.selector.select(self.wheel.next_timeout())
+            dead = []
+            with self.lock:
+                self.drain()
+                for key, _ in events:
+                    sock = key.fileobj
+                    # L'evento puo' riferirsi a un socket appena ceduto a un Client
+                    if sock in self.sockets and not self.parked_alive(sock):
+                        self.discard(sock)
+                        dead.append(sock)
+
+                for producer in self.wheel.advance():
+                    if self.heartbeat(producer):
+                        self.wheel.schedule(producer, self.interval)
+                    else:
+                        self.discard(producer)
+                        dead.append(producer)
+
+            for producer in dead:
+                try:
+                    self.on_dead(producer)
+                except Exception as e:
+                    logging.warning("Error evicting dead Producer: %s", e)
+
+    @staticmethod
+    def parked_alive(sock):
+        try:
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return True  # evento spurio
+        except OSError:
+            return False
+        return False  # EOF o byte inattesi
+
+    def heartbeat(self, producer):
+        if not isinstance(producer, socket.socket):
+            if time.monotonic() - producer.last_seen > self.timeout:
+                return False
+            producer.ping()
+            return True
+        try:
+            producer.send(HEARTBEAT, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            pass  # buffer di invio pieno: ci pensa TCP_USER_TIMEOUT
+        except OSError:
+            return False
+        return True
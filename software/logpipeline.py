@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+# Attributi standard di LogRecord: tutto il resto arriva da extra={...} e finisce nel JSON
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Un record per riga in JSON, con gli eventuali campi passati con extra={...}."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Campionamento degli eventi ripetuti (uno per connessione) durante i picchi.
+
+    Ogni messaggio (il template, non il testo formattato) ha un budget di burst
+    record al secondo; oltre il budget passa un record ogni rate e il record porta
+    il campo "sampled" con il fattore, per poter ricostruire i conteggi. Errori e
+    livelli superiori passano sempre.
+    """
+
+    def __init__(self, burst=50, rate=100):
+        super().__init__()
+        self.burst = burst
+        self.rate = rate
+        self.windows = {}  # template -> [inizio della finestra, record visti]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        now = int(time.monotonic())
+        with self.lock:
+            window = self.windows.get(record.msg)
+            if window is None or window[0] != now:
+                if len(self.windows) > 10000:
+                    self.windows.clear()  # messaggi costruiti con f-string: un template per record
+                window = self.windows[record.msg] = [now, 0]
+            window[1] += 1
+            seen = window[1]
+        if seen <= self.burst:
+            return True
+        if (seen - self.burst) % self.rate:
+            return False
+        record.sampled = self.rate
+        return True
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler che non formatta nel thread chiamante e non si blocca mai.
+
+    La coda e' nello stesso processo, quindi il record passa cosi' com'e' e la
+    formattazione avviene nel thread di scrittura. A coda piena il record viene
+    scartato e contato.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging(path, level=logging.INFO, max_bytes=50 * 1024 * 1024, backup_count=5,
+                  sample_burst=50, sample_rate=100, queue_size=100000):
+    """Configura il root logger: coda in memoria, un thread di scrittura, JSON e rotazione.
+
+    Come logging.basicConfig non fa nulla se il root logger ha gia' un handler, cosi'
+    piu' componenti avviati nello stesso processo scrivono sul primo file configurato.
+    Il thread di scrittura non sopravvive al fork: i worker ne avviano uno proprio.
+    """
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    file_handler = logging.handlers.RotatingFileHandler(os.path.abspath(path), maxBytes=max_bytes,
+                                                        backupCount=backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    log_queue = queue.Queue(queue_size)
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+
+    handler = AsyncQueueHandler(log_queue)
+    if sample_burst is not None:
+        handler.addFilter(SamplingFilter(sample_burst, sample_rate))
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    global _listener, _handler
+    _listener = listener
+    _handler = handler
+    listener.start()
+    atexit.register(stop_logging)  # svuota la coda all'uscita
+    return listener
+
+
+def stop_logging():
+    # Da chiamare anche prima di os._exit, che non esegue gli handler di atexit
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+
+
+def _restart_after_fork():
+    # Nel figlio il thread di scrittura non esiste piu' e la coda puo' avere il lock preso
+    # da quel thread: coda nuova e nuovo thread sugli stessi handler di file
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.Queue(_listener.queue.maxsize)
+    _handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_listener.handlers)
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
@@ -0,0 +1,209 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PRUNE_MIN_SHARDS = 64  # sotto questa soglia gli shard morti aspettano la lettura successiva
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class ShardedMetric:
+    """Base per metriche aggregate per thread.
+
+    Ogni thread scrive solo nel proprio shard (una lista), quindi l'aggiornamento non
+    prende lock; il lock serve solo alla creazione dello shard e alla lettura. Gli
+    shard dei thread terminati (un thread per connessione) vengono sommati in base
+    e scartati a ogni lettura e anche alla creazione, quando la lista raddoppia
+    rispetto all'ultima pulizia: senza letture (endpoint non interrogato) resta
+    comunque proporzionale ai thread vivi.
+    """
+
+    size = 1
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.local = threading.local()
+        self.shards = []  # (thread, shard)
+        self.base = [0] * self.size
+        self.prune_at = PRUNE_MIN_SHARDS
+        self.lock = threading.Lock()
+
+    def shard(self):
+        # I loop di inoltro lo prendono una volta e poi aggiornano shard[...] direttamente
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = [0] * self.size
+            with self.lock:
+                self.shards.append((threading.current_thread(), shard))
+                if len(self.shards) >= self.prune_at:
+                    self.fold_dead()
+                    self.prune_at = max(PRUNE_MIN_SHARDS, 2 * len(self.shards))
+            return shard
+
+    def fold_dead(self):
+        # Da chiamare con il lock: un thread terminato non scrive piu' nel suo shard
+        alive = []
+        for thread, shard in self.shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                for index, value in enumerate(shard):
+                    self.base[index] += value
+        self.shards = alive
+
+    def collect(self):
+        with self.lock:
+            self.fold_dead()
+            totals = list(self.base)
+            for _, shard in self.shards:
+                for index, value in enumerate(shard):
+                    totals[index] += value
+        return totals
+
+
+class Counter(ShardedMetric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self.shard()[0] += amount
+
+    def value(self):
+        return self.collect()[0]
+
+    def render(self):
+        return [f"{self.name}{format_labels(self.labels)} {self.value()}"]
+
+
+class Histogram(ShardedMetric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.size = len(self.buckets) + 3  # un contatore per bucket, +Inf, somma, numero di osservazioni
+        super().__init__(name, help_text, labels)
+
+    def observe(self, value):
+        shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-2] += value
+        shard[-1] += 1
+
+    def render(self):
+        totals = self.collect()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), totals):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels)} {totals[-2]}")
+        lines.append(f"{self.name}_count{format_labels(self.labels)} {totals[-1]}")
+        return lines
+
+
+class Gauge:
+    # Valore calcolato al momento della lettura (es. profondita' del pool, tunnel attivi)
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=(), func=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.func = func
+
+    def render(self):
+        try:
+            value = self.func() if self.func else 0
+        except Exception as e:
+            logging.warning("Error reading gauge %s: %s", self.name, e)
+            return []
+        return [f"{self.name}{format_labels(self.labels)} {value}"]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.metrics = {}  # (nome, etichette) -> metrica
+        self.lock = threading.Lock()
+
+    def get(self, cls, name, help_text, labels=None, **kwargs):
+        labels = tuple(sorted((labels or {}).items()))
+        with self.lock:
+            metric = self.metrics.get((name, labels))
+            if metric is None:
+                metric = self.metrics[(name, labels)] = cls(name, help_text, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help_text="", labels=None):
+        return self.get(Counter, name, help_text, labels)
+
+    def histogram(self, name, help_text="", labels=None, buckets=LATENCY_BUCKETS):
+        return self.get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def gauge(self, name, help_text="", func=None, labels=None):
+        gauge = self.get(Gauge, name, help_text, labels)
+        gauge.func = func  # l'ultima registrazione vince: un solo componente per processo
+        return gauge
+
+    def render(self):
+        # Formato testuale di Prometheus
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: (metric.name, metric.labels))
+        lines = []
+        described = set()
+        for metric in metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host="127.0.0.1", registry=REGISTRY):
+    """Espone le metriche su http://host:port/metrics in un thread separato."""
+    handler = type("Handler", (MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="MetricsServer", daemon=True).start()
+    logging.info("Metrics available on http://%s:%d/metrics", host, port)
+    return server
+
+
+# Metriche comuni ai loop di inoltro (socks5.DataExchanger, asyncrelay, multiplexer)
+TUNNEL_BYTES_UP = REGISTRY.counter("tunnel_bytes_total", "Bytes forwarded through tunnels", {"direction": "up"})
+TUNNEL_BYTES_DOWN = REGISTRY.counter("tunnel_bytes_total", "Bytes forwarded through tunnels", {"direction": "down"})
+TUNNELS_OPENED = REGISTRY.counter("tunnels_opened_total", "Tunnels handed to the forwarder")
+TUNNELS_CLOSED = REGISTRY.counter("tunnels_closed_total", "Tunnels closed")
+TUNNELS_IDLE_CLOSED = REGISTRY.counter("tunnels_idle_closed_total", "Tunnels closed after the idle timeout")
+REGISTRY.gauge("tunnels_active", "Tunnels currently forwarding data",
+               lambda: TUNNELS_OPENED.value() - TUNNELS_CLOSED.value())
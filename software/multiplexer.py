@@ -0,0 +1,218 @@
+import os
+import time
+import heapq
+import socket
+import logging
+import selectors
+import threading
+from collections import deque
+from metrics import TUNNEL_BYTES_UP, TUNNEL_BYTES_DOWN, TUNNELS_IDLE_CLOSED
+from liveness import TimerWheel
+
+
+class Tunnel:
+
+    def __init__(self, sock_a, sock_b, on_close=None, meter=None):
+        self.peers = {sock_a: sock_b, sock_b: sock_a}
+        self.pending = {sock_a: b"", sock_b: b""}  # dati in attesa di essere scritti su quel socket
+        self.on_close = on_close
+        self.meter = meter
+        self.upstream = sock_a  # i byte letti da qui contano come upload
+        self.paused_until = 0  # shaping: niente letture fino a questo istante
+        self.last_activity = time.monotonic()
+        self.closed = False
+
+
+class MultiplexerLoop(threading.Thread):
+    """Un thread con un selector (epoll su Linux) che serve tutti i tunnel assegnati.
+
+    Con idle_timeout ogni tunnel ha un timer in una TimerWheel: il traffico aggiorna
+    solo last_activity e alla scadenza il timer viene riprogrammato per il tempo
+    restante, oppure il tunnel viene chiuso.
+    """
+
+    def __init__(self, index, buffer_size=4096, idle_timeout=None):
+        super().__init__(name=f"TunnelMultiplexer_{index}", daemon=True)
+        self.selector = selectors.DefaultSelector()
+        self.buffer = memoryview(bytearray(buffer_size))
+        self.incoming = deque()
+        self.paused = []  # heap (istante di ripresa, id, tunnel) dei tunnel fermati dallo shaping
+        self.tunnels = 0
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel() if idle_timeout else None
+        self.now = time.monotonic()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)  # con il buffer pieno il loop e' gia' sveglio: add() non deve bloccarsi
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+    def add(self, tunnel):
+        self.incoming.append(tunnel)
+        try:
+            self.wakeup_w.send(b"\0")
+        except BlockingIOError:
+            pass  # il loop e' gia' stato svegliato
+
+    def run(self):
+        self.bytes_up, self.bytes_down = TUNNEL_BYTES_UP.shard(), TUNNEL_BYTES_DOWN.shard()
+        while True:
+            # Nessun timeout: un tunnel inattivo non sveglia il thread (salvo pause e timer di inattivita')
+            timeout = max(0, self.paused[0][0] - time.monotonic()) if self.paused else None
+            if self.wheel:
+                timeout = self.wheel.next_timeout() if timeout is None else min(timeout, self.wheel.next_timeout())
+            events = self.selector.select(timeout)
+            self.now = time.monotonic()
+            for key, mask in events:
+                if key.data is None:
+                    self.accept_incoming()
+                    continue
+
+                tunnel = key.data
+                sock = key.fileobj
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush(tunnel, sock)
+                    if mask & selectors.EVENT_READ and not tunnel.closed:
+                        self.read(tunnel, sock)
+                except OSError as e:
+                    logging.warning("Multiplexed tunnel terminated: %s", e)
+                    self.close(tunnel)
+            self.resume_paused()
+            if self.wheel:
+                self.reap_idle()
+
+    def reap_idle(self):
+        for tunnel in self.wheel.advance(self.now):
+            idle = self.now - tunnel.last_activity
+            if idle >= self.idle_timeout:
+                TUNNELS_IDLE_CLOSED.inc()
+                logging.debug("Multiplexed tunnel closed after %d idle seconds", idle)
+                self.close(tunnel)
+            else:
+                self.wheel.schedule(tunnel, self.idle_timeout - idle)
+
+    def resume_paused(self):
+        now = time.monotonic()
+        while self.paused and self.paused[0][0] <= now:
+            _, _, tunnel = heapq.heappop(self.paused)
+            tunnel.paused_until = 0
+            if not tunnel.closed:
+                for sock in tunnel.peers:
+                    self.update(tunnel, sock)
+
+    def throttle(self, tunnel, sock, n):
+        delay = tunnel.meter.account(sock is tunnel.upstream, n)
+        if delay:
+            tunnel.paused_until = time.monotonic() + delay
+            heapq.heappush(self.paused, (tunnel.paused_until, id(tunnel), tunnel))
+            for peer in tunnel.peers:
+                self.update(tunnel, peer)
+
+    def accept_incoming(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.incoming:
+            tunnel = self.incoming.popleft()
+            self.tunnels += 1
+            for sock in tunnel.peers:
+                sock.setblocking(False)
+                self.selector.register(sock, selectors.EVENT_READ, tunnel)
+            if self.wheel is not None:
+                self.wheel.schedule(tunnel, self.idle_timeout)
+
+    def read(self, tunnel, sock):
+        try:
+            n = sock.recv_into(self.buffer)
+        except BlockingIOError:
+            return
+        if n == 0:  # Verifica se la connessione è stata chiusa
+            self.close(tunnel)
+            return
+
+        tunnel.last_activity = self.now
+        peer = tunnel.peers[sock]
+        (self.bytes_up if sock is tunnel.upstream else self.bytes_down)[0] += n
+        if tunnel.meter is not None:
+            self.throttle(tunnel, sock, n)
+        try:
+            sent = peer.send(self.buffer[:n])
+        except BlockingIOError:
+            sent = 0
+
+        if sent < n:
+            # Il peer e' lento: si smette di leggere da sock finche' il residuo non e' scritto
+            tunnel.pending[peer] = bytes(self.buffer[sent:n])
+            self.update(tunnel, peer)
+            self.update(tunnel, sock)
+
+    def flush(self, tunnel, sock):
+        data = tunnel.pending[sock]
+        try:
+            sent = sock.send(data)
+        except BlockingIOError:
+            return
+        tunnel.pending[sock] = data[sent:]
+        if not tunnel.pending[sock]:
+            self.update(tunnel, sock)
+            self.update(tunnel, tunnel.peers[sock])
+
+    def update(self, tunnel, sock):
+        events = 0
+        if not tunnel.pending[tunnel.peers[sock]] and not tunnel.paused_until:
+            events |= selectors.EVENT_READ
+        if tunnel.pending[sock]:
+            events |= selectors.EVENT_WRITE
+
+        registered = sock in self.selector.get_map()
+        if events and registered:
+            self.selector.modify(sock, events, tunnel)
+        elif events:
+            self.selector.register(sock, events, tunnel)
+        elif registered:
+            self.selector.unregister(sock)
+
+    def close(self, tunnel):
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        self.tunnels -= 1
+        if self.wheel is not None:
+            self.wheel.cancel(tunnel)
+        for sock in tunnel.peers:
+            if sock in self.selector.get_map():
+                self.selector.unregister(sock)
+        if tunnel.on_close:
+            try:
+                tunnel.on_close()
+            except Exception as e:
+                logging.warning("Error in tunnel close callback: %s", e)
+
+
+class TunnelMultiplexer:
+    """Distribuisce i tunnel su un MultiplexerLoop per core."""
+
+    def __init__(self, num_loops=None, buffer_size=4096, idle_timeout=None):
+        self.loops = [MultiplexerLoop(i, buffer_size, idle_timeout) for i in range(num_loops or os.cpu_count() or 1)]
+        self.lock = threading.Lock()
+        self.started = False
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            for loop in self.loops:
+                loop.start()
+            self.started = True
+
+    def submit(self, sock_a, sock_b, on_close=None, meter=None):
+        self.start()
+        loop = min(self.loops, key=lambda l: l.tunnels + len(l.incoming))
+        loop.add(Tunnel(sock_a, sock_b, on_close, meter))
+
+    @property
+    def active_tunnels(self):
+        return sum(loop.tunnels for loop in self.loops)
@@ -0,0 +1,308 @@
+import time
+import socket
+import struct
+import logging
+import selectors
+import threading
+from collections import deque
+
+# Tipi di frame
+OPEN = 1
+DATA = 2
+WINDOW = 3
+CLOSE = 4
+PING = 5
+PONG = 6
+GOAWAY = 7  # il mittente non accetta nuovi stream: chi lo riceve chiude la sessione quando non ne ha piu'
+
+HEADER = struct.Struct("!BIH")  # tipo, stream id, lunghezza payload
+WINDOW_UPDATE = struct.Struct("!I")
+MAX_FRAME = 16384
+INITIAL_WINDOW = 131072
+
+# Bit alto del campo lunghezza nell'handshake Producer -> relay: il Producer parla il protocollo mux
+HANDSHAKE_MUX_FLAG = 0x80000000
+
+
+class MuxStream:
+
+    def __init__(self, stream_id, inner):
+        self.id = stream_id
+        self.inner = inner  # estremo del socketpair gestito dalla sessione
+        self.send_window = INITIAL_WINDOW  # byte che possiamo ancora inviare al peer
+        self.unacked = 0  # byte consegnati all'applicazione non ancora notificati con WINDOW
+        self.pending = bytearray()  # dati ricevuti dal peer non ancora scritti su inner
+        self.closing = False
+
+
+class MuxSession:
+    """Trasporta molti stream logici su una sola connessione TCP.
+
+    Ogni stream e' esposto all'applicazione come un normale socket (un estremo di un
+    socketpair), quindi Socks5Server, DataExchanger e i Forwarder funzionano invariati.
+    Il lato initiator usa stream id dispari, l'altro pari. Il controllo di flusso e'
+    per stream: il mittente non invia piu' di INITIAL_WINDOW byte non confermati e il
+    destinatario restituisce credito con frame WINDOW man mano che l'applicazione legge.
+    """
+
+    def __init__(self, sock, initiator, on_stream=None, on_close=None, on_pong=None, max_streams=256,
+                 initial_data=b""):
+        self.sock = sock
+        self.on_stream = on_stream
+        self.on_close = on_close
+        self.on_pong = on_pong
+        self.max_streams = max_streams
+        self.next_id = 1 if initiator else 2
+        self.streams = {}
+        self.commands = deque()
+        self.outbuf = bytearray()
+        self.inbuf = bytearray(initial_data)  # byte gia' letti dall'handshake che lo precede
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.going_away = False
+        self.last_seen = time.monotonic()
+
+    @property
+    def active_streams(self):
+        return len(self.streams) + len(self.commands)
+
+    def has_capacity(self):
+        return not self.closed and not self.going_away and self.active_streams < self.max_streams
+
+    def open_stream(self, metadata=b""):
+        # metadata viaggia nel frame OPEN (es. la chiave di sessione del Client)
+        app, inner = socket.socketpair()
+        with self.lock:
+            if self.closed:
+                app.close()
+                inner.close()
+                raise ConnectionError("Mux session closed")
+            stream_id = self.next_id
+            self.next_id += 2
+            self.commands.append((OPEN, stream_id, (inner, metadata)))
+        self.wakeup()
+        return app
+
+    def ping(self, payload=b""):
+        self.commands.append((PING, 0, payload))
+        self.wakeup()
+
+    def go_away(self):
+        self.commands.append((GOAWAY, 0, None))
+        self.wakeup()
+
+    def close(self):
+        self.commands.append((CLOSE, 0, None))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def run(self):
+        self.sock.setblocking(False)
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.wakeup_r)
+        try:
+            if self.inbuf:
+                self.parse_frames()
+                self.flush_transport()
+            while not self.closed:
+                for key, mask in self.selector.select():
+                    if key.data is self.wakeup_r:
+                        self.run_commands()
+                    elif key.data is None:
+                        if mask & selectors.EVENT_READ:
+                            self.read_transport()
+                    else:
+                        stream = key.data
+                        if stream.id not in self.streams:
+                            continue
+                        if mask & selectors.EVENT_WRITE:
+                            self.flush_stream(stream)
+                        if mask & selectors.EVENT_READ and stream.id in self.streams:
+                            self.read_stream(stream)
+                # Tutti i frame prodotti in questo giro partono con una sola send
+                self.flush_transport()
+                if self.going_away and not self.active_streams:
+                    break
+        except (OSError, ConnectionError) as e:
+            logging.info("Mux session terminated: %s", e)
+        finally:
+            self.shutdown()
+
+    def run_commands(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.commands:
+            frame_type, stream_id, arg = self.commands.popleft()
+            if frame_type == OPEN:
+                inner, metadata = arg
+                self.add_stream(stream_id, inner)
+                self.queue_frame(OPEN, stream_id, metadata)
+            elif frame_type == PING:
+                self.queue_frame(PING, 0, arg)
+            elif frame_type == GOAWAY:
+                self.queue_frame(GOAWAY, 0)
+            elif frame_type == CLOSE:
+                raise ConnectionError("Mux session closed locally")
+
+    def queue_frame(self, frame_type, stream_id, payload=b""):
+        self.outbuf += HEADER.pack(frame_type, stream_id, len(payload))
+        self.outbuf += payload
+
+    def flush_transport(self):
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+                del self.outbuf[:sent]
+            except BlockingIOError:
+                pass
+
+        events = selectors.EVENT_READ
+        if self.outbuf:
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(self.sock).events != events:
+            self.selector.modify(self.sock, events, None)
+
+    def read_transport(self):
+        data = self.sock.recv(262144)
+        if not data:
+            raise ConnectionError("Mux transport closed by peer")
+        self.last_seen = time.monotonic()
+        self.inbuf += data
+        self.parse_frames()
+
+    def parse_frames(self):
+        offset = 0
+        while len(self.inbuf) - offset >= HEADER.size:
+            frame_type, stream_id, length = HEADER.unpack_from(self.inbuf, offset)
+            end = offset + HEADER.size + length
+            if len(self.inbuf) < end:
+                break
+            self.handle_frame(frame_type, stream_id, self.inbuf[offset + HEADER.size:end])
+            offset = end
+        del self.inbuf[:offset]
+
+    def handle_frame(self, frame_type, stream_id, payload):
+        stream = self.streams.get(stream_id)
+
+        if frame_type == OPEN:
+            if stream is not None:
+                return
+            if self.on_stream is None or len(self.streams) >= self.max_streams:
+                self.queue_frame(CLOSE, stream_id)
+                return
+            app, inner = socket.socketpair()
+            self.add_stream(stream_id, inner)
+            self.on_stream(app, bytes(payload))
+        elif frame_type == DATA and stream is not None:
+            stream.pending += payload
+            self.flush_stream(stream)
+        elif frame_type == WINDOW and stream is not None:
+            stream.send_window += WINDOW_UPDATE.unpack(payload)[0]
+            self.update_stream(stream)
+        elif frame_type == CLOSE and stream is not None:
+            stream.closing = True
+            self.flush_stream(stream)
+        elif frame_type == PING:
+            self.queue_frame(PONG, 0, bytes(payload))
+        elif frame_type == PONG and self.on_pong:
+            self.on_pong(self, bytes(payload))
+        elif frame_type == GOAWAY:
+            self.going_away = True
+
+    def add_stream(self, stream_id, inner):
+        inner.setblocking(False)
+        stream = MuxStream(stream_id, inner)
+        self.streams[stream_id] = stream
+        self.selector.register(inner, selectors.EVENT_READ, stream)
+
+    def read_stream(self, stream):
+        try:
+            data = stream.inner.recv(min(MAX_FRAME, stream.send_window))
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:  # l'applicazione ha chiuso lo stream
+            self.close_stream(stream, notify=True)
+            return
+
+        stream.send_window -= len(data)
+        self.queue_frame(DATA, stream.id, data)
+        if stream.send_window <= 0:
+            self.update_stream(stream)
+
+    def flush_stream(self, stream):
+        if stream.pending:
+            try:
+                sent = stream.inner.send(stream.pending)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.close_stream(stream, notify=True)
+                return
+            del stream.pending[:sent]
+            stream.unacked += sent
+            if stream.unacked >= INITIAL_WINDOW // 2:
+                self.queue_frame(WINDOW, stream.id, WINDOW_UPDATE.pack(stream.unacked))
+                stream.unacked = 0
+
+        if stream.closing and not stream.pending:
+            self.close_stream(stream, notify=False)
+            return
+        self.update_stream(stream)
+
+    def update_stream(self, stream):
+        events = 0
+        if stream.send_window > 0 and not stream.closing:
+            events |= selectors.EVENT_READ
+        if stream.pending:
+            events |= selectors.EVENT_WRITE
+
+        registered = stream.inner in self.selector.get_map()
+        if events and registered:
+            self.selector.modify(stream.inner, events, stream)
+        elif events:
+            self.selector.register(stream.inner, events, stream)
+        elif registered:
+            self.selector.unregister(stream.inner)
+
+    def close_stream(self, stream, notify):
+        if stream.inner in self.selector.get_map():
+            self.selector.unregister(stream.inner)
+        stream.inner.close()
+        del self.streams[stream.id]
+        if notify:
+            self.queue_frame(CLOSE, stream.id)
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+        for stream in list(self.streams.values()):
+            stream.inner.close()
+        self.streams.clear()
+        while self.commands:
+            frame_type, _, arg = self.commands.popleft()
+            if frame_type == OPEN:
+                arg[0].close()
+        self.selector.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        self.sock.close()
+        if self.on_close:
+            try:
+                self.on_close(self)
+            except Exception as e:
+                logging.warning("Error in mux session close callback: %s", e)
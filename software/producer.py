@@ -3,85 +3,432 @@ import threading
 import logging
 import struct
 import select
-import sys
 import time
+import json
+import random
+from functools import partial
 from socks5 import Socks5Server,DataExchanger
+from forwarding import Forwarder
+from mux import MuxSession, HANDSHAKE_MUX_FLAG
+from metrics import REGISTRY, start_http_server
+from logpipeline import setup_logging
+from connector import Connector
+from liveness import HEARTBEAT
+from udprelay import CMD_UDP_ASSOCIATE, RemoteUdpAssociation
 
-def setup_logger(name, log_file, level=logging.INFO):
-    """Funzione per configurare e ottenere un logger."""
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    handler = logging.FileHandler(log_file, mode='w')
-    handler.setFormatter(formatter)
+SESSIONS = REGISTRY.counter("producer_sessions_total", "SOCKS5 sessions started by relay Clients")
+HANDSHAKE_FAILURES = REGISTRY.counter("producer_handshake_failures_total", "SOCKS5 sessions that failed before forwarding")
+PHASE_LATENCY = {phase: REGISTRY.histogram("producer_handshake_seconds", "SOCKS5 handshake latency per phase",
+                                           {"phase": phase})
+                 for phase in ("method", "auth", "request", "connect")}
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level)
-    logger.addHandler(handler)
-
-    return logger
+# Un solo file per processo, scritto da un thread dedicato; i thread si distinguono dal nome del logger
+setup_logging('producer.log')
 
 class Producer(threading.Thread):
-    def __init__(self, server_host, server_port, thread_id):
+    def __init__(self, server_host, server_port, thread_id, forwarder=None, pool=None, transport="tcp",
+                 connector=None, parked_timeout=None, reconnect_base=1, reconnect_cap=60):
         super().__init__()
         self.server_host = server_host
         self.server_port = server_port
         self.api_key = "API_KEY"
-        self.logger = setup_logger(f'SocksProducer_{thread_id}', f'socks_producer_{thread_id}.log')
+        self.logger = logging.getLogger(f'SocksProducer.{thread_id}')
+        self.forwarder = forwarder or Forwarder()
+        self.pool = pool
+        self.connector = connector  # condiviso dal pool: la cache delle destinazioni irraggiungibili vale per tutti
+        self.parked_timeout = parked_timeout  # senza heartbeat del relay per questi secondi ci si riconnette
+        self.reconnect_base = reconnect_base  # secondi: la finestra dell'attesa raddoppia a ogni tentativo fallito
+        self.reconnect_cap = reconnect_cap
+        self.failures = 0
+        self.sock = None
+        self.retired = False
+        self.rejected = False  # API key rifiutata dal relay: inutile riprovare
+        self.transport = transport  # "tcp": una sessione per connessione, "mux": molti stream per connessione
 
     def run(self):
-        while True:
+        try:
+            if self.transport == "mux":
+                self.run_mux()
+            else:
+                self.run_tcp()
+        finally:
+            # Qualunque sia il motivo dell'uscita il thread non deve restare contato nel pool
+            if self.pool:
+                self.pool.discard(self)
+        self.logger.info("SocksProducer terminato")
+
+    def run_tcp(self):
+        while not self.retired:
+            if self.pool:
+                self.pool.wait_connect_slot()
+                if not self.pool.set_state(self, "connecting"):
+                    break
             self.logger.info("Tentativo di connessione a C")
+            self.sock = None
+            remote = None
+            served = False
             try:
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.sock.connect((self.server_host, self.server_port))
                 self.logger.info("SocksProducer connesso a C")
                 self.relay_handshake()
 
-                self.socks5server = Socks5Server(self.sock)
-                self.socks5server.auth_handshake()
-                self.socks5server.complete_auth_handshake()
-                cmd, address, port = self.socks5server.get_request()
-                remote = self.socks5server.send_reply(cmd, address, port)
+                self.claim("parked")
+                self.wait_for_client()
+                served = True
+                # Se il pool lo ha appena ritirato il socket e' gia' chiuso: la sessione si scarta
+                self.claim("busy")
+
+                remote = self.socks_handshake(self.sock)
 
                 self.logger.info("SocksProducer in attesa di dati da C")
 
-                DataExchanger(self.sock, remote).exchange_data()
-                
             except Exception as e:
-                self.logger.error("Errore di connessione a C: %s", e)
+                if not self.retired:
+                    self.logger.error("Errore di connessione a C: %s", e)
+                self.close_session(self.sock, remote)
+                if not served and not self.retired:
+                    self.wait_before_reconnect()
+                continue
+
+            if isinstance(remote, RemoteUdpAssociation):
+                self.relay_udp(self.sock, remote)
+            else:
+                # In modalita' asyncio la sessione viene ceduta all'engine e il thread torna subito a connettersi
+                self.forwarder.forward(self.sock, remote, on_close=partial(self.close_session, self.sock, remote))
+
+            if self.pool and self.pool.should_retire(self):
+                self.retired = True
+
+    def claim(self, state):
+        if self.pool and not self.pool.set_state(self, state):
+            raise Exception("SocksProducer ritirato dal pool")
+
+    def run_mux(self):
+        while not self.retired:
+            if self.pool:
+                self.pool.wait_connect_slot()
+                if not self.pool.set_state(self, "connecting"):
+                    break
+            self.logger.info("Tentativo di connessione multiplexata a C")
+            self.sock = None
+            try:
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.sock.connect((self.server_host, self.server_port))
+                self.relay_handshake(mux=True)
+                self.claim("parked")
+                self.logger.info("SocksProducer connesso a C in modalita' mux")
+                MuxSession(self.sock, initiator=False, on_stream=self.serve_stream).run()
+            except Exception as e:
+                if not self.retired:
+                    self.logger.error("Errore di connessione a C: %s", e)
             finally:
                 self.logger.info("SocksProducer disconnesso da C")
-                self.sock.close()
+                if self.sock is not None:
+                    self.sock.close()
+            if not self.retired:
+                self.wait_before_reconnect()
+
+    def serve_stream(self, stream_socket, metadata=b""):
+        # Chiamato dal thread della MuxSession: l'handshake SOCKS5 non deve bloccarlo
+        threading.Thread(target=self.serve_socks_session, args=(stream_socket,), daemon=True).start()
+
+    def serve_socks_session(self, stream_socket):
+        remote = None
+        try:
+            remote = self.socks_handshake(stream_socket)
+        except Exception as e:
+            self.logger.error("Errore durante l'handshake SOCKS5 sullo stream: %s", e)
+            self.close_session(stream_socket, remote)
+            return
+        if isinstance(remote, RemoteUdpAssociation):
+            self.relay_udp(stream_socket, remote)
+            return
+        self.forwarder.forward(stream_socket, remote, on_close=partial(self.close_session, stream_socket, remote))
+
+    def relay_udp(self, sock, association):
+        # Le associazioni UDP restano nel thread della sessione in tutte le modalita' di inoltro
+        try:
+            association.run()
+        except Exception as e:
+            self.logger.warning("Associazione UDP terminata: %s", e)
+        finally:
+            self.close_session(sock, association)
+
+    def socks_handshake(self, sock):
+        SESSIONS.inc()
+        started = time.monotonic()
+        try:
+            socks5server = Socks5Server(sock, connector=self.connector)
+            socks5server.auth_handshake()
+            authenticated = time.monotonic()
+            socks5server.complete_auth_handshake()
+            request = socks5server.get_request()
+            if request is None:
+                raise Exception("Richiesta SOCKS5 non valida")
+            cmd, address, port = request
+            requested = time.monotonic()
+            if cmd == CMD_UDP_ASSOCIATE:
+                # I datagrammi viaggiano nel tunnel: l'indirizzo UDP lo annuncia il Gateway al Client
+                socks5server.send_status(0)
+                remote = RemoteUdpAssociation(sock, resolver=socks5server.resolver,
+                                              initial_data=socks5server.take_buffered())
+            else:
+                remote = socks5server.send_reply(cmd, address, port)
+            if remote is None:
+                raise Exception("Comando SOCKS5 non supportato")
+        except Exception:
+            HANDSHAKE_FAILURES.inc()
+            raise
+
+        PHASE_LATENCY["method"].observe(socks5server.greeted_at - started)
+        PHASE_LATENCY["auth"].observe(authenticated - socks5server.greeted_at)
+        PHASE_LATENCY["request"].observe(requested - authenticated)
+        PHASE_LATENCY["connect"].observe(time.monotonic() - requested)
+        return remote
+
+    def wait_for_client(self):
+        # Tunnel autenticato e parcheggiato sul relay: si scartano gli heartbeat fino al primo byte del Client
+        self.sock.settimeout(self.parked_timeout)
+        while True:
+            first = self.sock.recv(1, socket.MSG_PEEK)
+            if not first:
+                raise Exception("Tunnel inattivo chiuso")
+            if first != HEARTBEAT:
+                break
+            self.sock.recv(1)
+        self.sock.settimeout(None)
+
+    def retire(self):
+        # Chiamato dal pool per chiudere un tunnel parcheggiato in eccesso
+        self.retired = True
+        sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def wait_before_reconnect(self):
+        # Backoff esponenziale con jitter completo: dopo un riavvio del relay i Producer non si riconnettono tutti insieme
+        delay = random.uniform(0, min(self.reconnect_cap, self.reconnect_base * 2 ** self.failures))
+        self.failures = min(self.failures + 1, 32)
+        self.logger.info(f"Nuovo tentativo di connessione a C tra {delay:.1f} secondi")
+        time.sleep(delay)
 
-    def relay_handshake(self):
-        packet = struct.pack(f"!I{len(self.api_key)}s", len(self.api_key), self.api_key.encode('utf-8'))
+    def close_session(self, sock, remote):
+        self.logger.info("SocksProducer disconnesso da C")
+        for s in (sock, remote):
+            if s is not None:
+                s.close()
+
+    def relay_handshake(self, mux=False):
+        length = len(self.api_key) | (HANDSHAKE_MUX_FLAG if mux else 0)
+        packet = struct.pack(f"!I{len(self.api_key)}s", length, self.api_key.encode('utf-8'))
         self.sock.sendall(packet)
 
-        packet_data = self.sock.recv(4)
+        packet_data = self.sock.recv(1)  # solo lo stato: i byte successivi sono gia' del Client
         status = struct.unpack("!B", packet_data)[0]
 
         if status == 0:
             self.logger.error("Errore di autenticazione")
-            self.sock.close()
-            sys.exit(1)
+            self.rejected = True
+            self.retired = True
+            raise Exception("API key rifiutata dal relay")
+        self.failures = 0
+
+def discover_relay(gateway_host, gateway_port, timeout=10):
+    """(host, porta) del relay a cui il ProducerGateway assegna questo dispositivo."""
+    with socket.create_connection((gateway_host, gateway_port), timeout=timeout) as sock:
+        data = b""
+        while not data.endswith(b"\n"):
+            chunk = sock.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+    try:
+        assignment = json.loads(data)
+    except ValueError:
+        raise ConnectionError(f"Invalid answer from producer gateway: {data!r}")
+    if "error" in assignment:
+        raise ConnectionError(assignment["error"])
+    return assignment["host"], assignment["port"]
+
 
 class ConnectionPool:
-    def __init__(self, server_host, server_port, pool_size):
+    """Mantiene parcheggiati sul relay un numero adattivo di tunnel gia' autenticati.
+
+    Quando un Client consuma un tunnel ne viene aperto subito un altro; se i Client
+    arrivano a raffica il numero di tunnel inattivi cresce fino a max_idle, e torna
+    verso pool_size quando per idle_timeout secondi nessun tunnel viene usato.
+    Le riconnessioni sono limitate a connect_rate al secondo.
+    """
+
+    def __init__(self, server_host, server_port, pool_size, exchange_mode="thread", buffer_size=4096,
+                 max_idle=None, max_size=1024, idle_timeout=30, connect_rate=20, transport="tcp",
+                 connector=None, parked_timeout=60, reconnect_base=1, reconnect_cap=60):
         self.server_host = server_host
         self.server_port = server_port
         self.pool_size = pool_size
-        self.logger = setup_logger('ConnectionPool', 'connection_pool.log')
+        self.max_idle = max_idle or pool_size * 4
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_rate = connect_rate
+        self.logger = logging.getLogger('ConnectionPool')
+        self.forwarder = Forwarder(exchange_mode, buffer_size)
+        self.transport = transport
+        self.connector = connector or Connector()
+        self.parked_timeout = parked_timeout
+        self.reconnect_base = reconnect_base
+        self.reconnect_cap = reconnect_cap
+
+        self.target_idle = pool_size
+        self.rejected = False  # il relay ha rifiutato l'API key: non si aprono altri tunnel
+        self.states = {}  # Producer -> "connecting" | "parked" | "busy"
+        self.parked_since = {}
+        self.last_claim = time.monotonic()
+        self.next_id = 0
+        self.lock = threading.Lock()
+
+        self.tokens = float(connect_rate)
+        self.tokens_updated = time.monotonic()
+        self.tokens_lock = threading.Lock()
+
+        REGISTRY.gauge("producer_pool_idle", "Tunnels connecting or parked on the relay", self.idle_tunnels)
+        REGISTRY.gauge("producer_pool_size", "Producer threads in the pool", lambda: len(self.states))
+        REGISTRY.gauge("producer_pool_target_idle", "Adaptive target of idle tunnels", lambda: self.target_idle)
 
     def start(self):
         self.logger.info("Avvio della Connection Pool")
-        for i in range(self.pool_size):
-            producer = Producer(self.server_host, self.server_port, i)
-            producer.start()
-            self.logger.info(f"SocksProducer {i} avviato")
+        self.ensure_idle()
+        threading.Thread(target=self.maintenance, daemon=True).start()
+
+    def spawn(self):
+        with self.lock:
+            thread_id = self.next_id
+            self.next_id += 1
+            producer = Producer(self.server_host, self.server_port, thread_id, self.forwarder, pool=self,
+                                transport=self.transport, connector=self.connector,
+                                parked_timeout=self.parked_timeout, reconnect_base=self.reconnect_base,
+                                reconnect_cap=self.reconnect_cap)
+            self.states[producer] = "connecting"
+        producer.start()
+        self.logger.info(f"SocksProducer {thread_id} avviato")
+
+    def idle_count(self, exclude=None):
+        return sum(1 for p, state in self.states.items() if state != "busy" and p is not exclude)
+
+    def idle_tunnels(self):
+        with self.lock:
+            return self.idle_count()
+
+    def ensure_idle(self):
+        with self.lock:
+            if self.rejected:
+                return
+            missing = self.target_idle - self.idle_count()
+            missing = min(missing, self.max_size - len(self.states))
+        for _ in range(missing):
+            self.spawn()
+
+    def set_state(self, producer, state):
+        # False se il Producer e' stato ritirato (o tolto dal pool): il chiamante deve fermarsi
+        now = time.monotonic()
+        with self.lock:
+            if producer.retired or producer not in self.states:
+                return False
+            self.states[producer] = state
+            if state == "parked":
+                self.parked_since[producer] = now
+                return True
+            self.parked_since.pop(producer, None)
+            if state != "busy":
+                return True
+            # Tunnel consumato a meno di un secondo dal precedente: traffico a raffica, si alza il target
+            if now - self.last_claim < 1 and self.target_idle < self.max_idle:
+                self.target_idle += 1
+            self.last_claim = now
+        self.ensure_idle()
+        return True
+
+    def discard(self, producer):
+        with self.lock:
+            self.states.pop(producer, None)
+            self.parked_since.pop(producer, None)
+            if producer.rejected and not self.rejected:
+                self.rejected = True
+                self.logger.error("API key rifiutata dal relay: il pool non apre altri tunnel")
+        self.ensure_idle()
+
+    def should_retire(self, producer):
+        with self.lock:
+            if self.idle_count(exclude=producer) >= self.target_idle:
+                self.states.pop(producer, None)
+                return True
+            self.states[producer] = "connecting"
+            return False
+
+    def wait_connect_slot(self):
+        # Token bucket: al massimo connect_rate riconnessioni al secondo per tutto il pool
+        while True:
+            with self.tokens_lock:
+                now = time.monotonic()
+                self.tokens = min(self.connect_rate, self.tokens + (now - self.tokens_updated) * self.connect_rate)
+                self.tokens_updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.connect_rate
+            time.sleep(wait)
+
+    def maintenance(self):
+        while True:
+            time.sleep(1)
+            self.maintain(time.monotonic())
+
+    def maintain(self, now):
+        with self.lock:
+            if now - self.last_claim > self.idle_timeout and self.target_idle > self.pool_size:
+                self.target_idle -= 1
+                self.last_claim = now
+            extra = self.idle_count() - self.target_idle
+            if extra > 0:
+                # Si chiudono per primi i tunnel parcheggiati da piu' tempo
+                oldest = sorted(self.parked_since.items(), key=lambda item: item[1])
+                for producer, since in oldest[:extra]:
+                    if now - since > self.idle_timeout:
+                        # Con il lock: un Client arrivato nel frattempo non puo' piu' passare a "busy"
+                        self.states.pop(producer, None)
+                        self.parked_since.pop(producer, None)
+                        producer.retire()
+                        self.logger.info("Chiusura di un tunnel inattivo in eccesso")
+        self.ensure_idle()
 
 if __name__ == "__main__":
     SERVER_HOST = '127.0.0.1'  # Indirizzo IP del server C
     SERVER_PORT = 30000  # Porta su cui i dispositivi B si connettono a C
-    POOL_SIZE = 1  # Numero di connessioni da stabilire con C
+    PRODUCER_GATEWAY = None  # (host, porta) del ProducerGateway che sceglie il relay del paese; None usa SERVER_HOST
+    POOL_SIZE = 1  # Numero minimo di tunnel inattivi da tenere parcheggiati su C
+    EXCHANGE_MODE = "thread"  # "thread", "splice", "buffered", "asyncio" oppure "epoll"
+    BUFFER_SIZE = 4096
+    TRANSPORT = "tcp"  # "tcp" oppure "mux" (molti stream SOCKS5 su una connessione)
+    METRICS_PORT = 9102  # endpoint HTTP locale delle metriche
+    CONNECT_TIMEOUT = 10  # secondi concessi alla connessione verso la destinazione richiesta dal Client
+    UNREACHABLE_TTL = 30  # secondi per cui una destinazione irraggiungibile viene rifiutata subito
+    PARKED_TIMEOUT = 60  # secondi senza heartbeat del relay (HEARTBEAT_INTERVAL) prima di riconnettersi
+    RECONNECT_BASE = 1  # secondi: attesa massima dopo il primo errore, raddoppiata a ogni errore successivo
+    RECONNECT_CAP = 60  # secondi: limite dell'attesa tra due tentativi di connessione al relay
+
+    if PRODUCER_GATEWAY:
+        try:
+            SERVER_HOST, SERVER_PORT = discover_relay(*PRODUCER_GATEWAY)
+            logging.info(f"Relay assegnato dal gateway: {SERVER_HOST}:{SERVER_PORT}")
+        except OSError as e:
+            logging.warning(f"Gateway dei Producer non disponibile, uso {SERVER_HOST}:{SERVER_PORT}: {e}")
 
-    pool = ConnectionPool(SERVER_HOST, SERVER_PORT, POOL_SIZE)
+    connector = Connector(timeout=CONNECT_TIMEOUT, unreachable_ttl=UNREACHABLE_TTL)
+    pool = ConnectionPool(SERVER_HOST, SERVER_PORT, POOL_SIZE, EXCHANGE_MODE, BUFFER_SIZE, transport=TRANSPORT,
+                          connector=connector, parked_timeout=PARKED_TIMEOUT, reconnect_base=RECONNECT_BASE,
+                          reconnect_cap=RECONNECT_CAP)
+    start_http_server(METRICS_PORT)
     pool.start()
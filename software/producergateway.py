@@ -1 +1,116 @@
-# in base alla geolocalizzazione dell'utente, ip analysis ecc, si decide a quale server far iscrivere il producer
\ No newline at end of file
+import json
+import socket
+import logging
+import argparse
+from geoindex import load_index
+from relaydirectory import RelayDirectory
+from metrics import REGISTRY, start_http_server
+from logpipeline import setup_logging
+
+# In base alla geolocalizzazione dell'utente (indice GeoIP dei prefissi) si decide a quale relay far iscrivere il Producer
+
+# Configurazione del logging: JSON su file scritto da un thread dedicato
+setup_logging('producergateway.log')
+
+ASSIGNED = REGISTRY.counter("producer_gateway_assignments_total", "Producers redirected to a relay", {"match": "country"})
+FALLBACK = REGISTRY.counter("producer_gateway_assignments_total", "Producers redirected to a relay", {"match": "default"})
+UNAVAILABLE = REGISTRY.counter("producer_gateway_unavailable_total", "Producers turned away because no relay was healthy")
+
+
+class ProducerGateway:
+    """Primo contatto dei Producer: risponde con il relay del paese del loro IP pubblico.
+
+    Il Producer si connette e riceve una riga JSON {"host", "port", "country", "asn"}
+    (oppure {"error"} se nessun relay e' disponibile), poi la connessione viene chiusa.
+    Lookup e scelta del relay sono in memoria, quindi la risposta parte dal thread che
+    accetta senza crearne altri. Gli indirizzi senza prefisso nell'indice, o di un paese
+    senza relay, vanno al paese di default.
+    """
+
+    def __init__(self, index, relay_directory, producer_port=30000, backlog=128, reuse_port=False):
+        self.index = index
+        self.relay_directory = relay_directory
+        self.producer_port = producer_port
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+
+    def start_server(self, host, port):
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server_socket.bind((host, port))
+        server_socket.listen(self.backlog)
+        logging.info("Producer gateway listening on port %d", port)
+
+        while True:
+            producer_socket, addr = server_socket.accept()
+            self.handle_producer(producer_socket, addr[0])
+
+    def assign(self, address):
+        match = self.index.lookup(address)
+        country, asn = match if match else (None, None)
+        host = self.relay_directory.select_for_producer(country) if country else None
+        if host is not None:
+            ASSIGNED.inc()
+        else:
+            host = self.relay_directory.select_for_producer()
+            if host is None:
+                UNAVAILABLE.inc()
+                return None
+            FALLBACK.inc()
+        return {"host": host, "port": self.producer_port, "country": country, "asn": asn}
+
+    def handle_producer(self, producer_socket, address):
+        try:
+            assignment = self.assign(address)
+            if assignment is None:
+                logging.warning("No healthy relay for Producer %s", address)
+                assignment = {"error": "no relay available"}
+            else:
+                logging.info("Producer %s assigned to %s", address, assignment["host"],
+                             extra={"country": assignment["country"], "asn": assignment["asn"]})
+            # Risposta piccola su un socket appena accettato: entra nel buffer di invio senza bloccare
+            producer_socket.sendall(json.dumps(assignment).encode('utf-8') + b"\n")
+        except OSError as e:
+            logging.warning("Error answering Producer %s: %s", address, e)
+        finally:
+            producer_socket.close()
+
+
+if __name__ == "__main__":
+    HOST = "0.0.0.0"
+    PORT = 20000  # Porta su cui i Producer chiedono il relay a cui iscriversi
+    GEOIP_CSV = "geoip.csv"  # dataset "rete,paese,asn"; l'indice viene ricostruito se il CSV e' piu' recente
+    GEOIP_INDEX = "geoip.idx"  # indice dei prefissi mappato in memoria
+    RELAYS = [("it", "it.skynetproxy.com"), ("us", "us.skynetproxy.com"), ("de", "de.skynetproxy.com")]
+    RELAY_STATUS_PORT = 60002
+    RELAY_PRODUCER_PORT = 30000  # porta dei relay su cui si connettono i Producer
+    DEFAULT_COUNTRY = "it"
+    METRICS_PORT = 9103  # endpoint HTTP locale delle metriche (un worker per porta a partire da questa)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=1, help="numero di processi che condividono la porta")
+    parser.add_argument("--backlog", type=int, default=128, help="backlog del socket in ascolto")
+    args = parser.parse_args()
+
+    # L'indice si costruisce una volta nel padre; i worker mappano lo stesso file
+    load_index(GEOIP_CSV, GEOIP_INDEX).close()
+
+    def create_gateway(reuse_port=False):
+        relay_directory = RelayDirectory(RELAYS, RELAY_STATUS_PORT, DEFAULT_COUNTRY)
+        relay_directory.start()
+        return ProducerGateway(load_index(None, GEOIP_INDEX), relay_directory, RELAY_PRODUCER_PORT, args.backlog,
+                               reuse_port=reuse_port)
+
+    if args.workers > 1:
+        from workers import run_workers
+
+        def start_worker(index):
+            start_http_server(METRICS_PORT + index)
+            create_gateway(reuse_port=True).start_server(HOST, PORT)
+
+        run_workers(args.workers, start_worker)
+    else:
+        start_http_server(METRICS_PORT)
+        create_gateway().start_server(HOST, PORT)
@@ -0,0 +1,129 @@
+import os
+import socket
+import struct
+import logging
+import threading
+from collections import deque
+from liveness import HeartbeatMonitor
+
+
+class ProducerRegistryServer:
+    """Registro dei Producer condiviso tra i worker di GeoTcpRelay.
+
+    Vive nel processo padre: i worker gli passano i socket dei Producer autenticati
+    (SCM_RIGHTS su unix socket) e gliene chiedono uno quando arriva un Client. Finche'
+    restano qui i Producer ricevono gli heartbeat dal registro, come quelli parcheggiati
+    su un relay a processo singolo, e quelli morti vengono scartati.
+    """
+
+    def __init__(self, path, heartbeat_interval=15, heartbeat_timeout=45):
+        self.path = path
+        self.producers = deque()
+        self.lock = threading.Lock()
+        self.liveness = HeartbeatMonitor(self.evict, heartbeat_interval, heartbeat_timeout)
+
+        if os.path.exists(path):
+            os.unlink(path)
+        # Il socket viene creato prima del fork, cosi' i worker possono connettersi subito
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen(64)
+
+    def start(self):
+        self.liveness.start()
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+        logging.info("Producer registry listening on %s", self.path)
+
+    def accept_workers(self):
+        while True:
+            worker_socket, _ = self.server_socket.accept()
+            threading.Thread(target=self.handle_worker, args=(worker_socket,), daemon=True).start()
+
+    def handle_worker(self, worker_socket):
+        try:
+            while True:
+                op, fds, _, _ = socket.recv_fds(worker_socket, 1, 1)
+                if not op:
+                    return
+                if op == b"P":
+                    for fd in fds:
+                        self.put(socket.socket(fileno=fd))
+                elif op == b"T":
+                    producer_socket = self.take()
+                    if producer_socket is None:
+                        worker_socket.sendall(b"0")
+                        continue
+                    socket.send_fds(worker_socket, [b"1"], [producer_socket.fileno()])
+                    producer_socket.close()
+                elif op == b"N":
+                    worker_socket.sendall(struct.pack("!I", len(self.producers)))
+        except OSError as e:
+            logging.warning("Producer registry lost a worker: %s", e)
+        finally:
+            worker_socket.close()
+
+    def put(self, producer_socket):
+        with self.lock:
+            self.producers.append(producer_socket)
+        self.liveness.add(producer_socket)
+
+    def take(self):
+        with self.lock:
+            while self.producers:
+                producer_socket = self.producers.popleft()
+                # remove() falso: il monitor lo ha gia' dichiarato morto
+                if self.liveness.remove(producer_socket) and self.is_alive(producer_socket):
+                    return producer_socket
+                producer_socket.close()
+        return None
+
+    def evict(self, producer_socket):
+        with self.lock:
+            try:
+                self.producers.remove(producer_socket)
+            except ValueError:
+                return  # preso da take() nel frattempo, che lo ha gia' chiuso
+        producer_socket.close()
+        logging.info("Dead Producer evicted from the shared registry")
+
+    def is_alive(self, producer_socket):
+        try:
+            return producer_socket.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+
+class ProducerRegistryClient:
+    """Lato worker del ProducerRegistryServer: una connessione per processo."""
+
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.path)
+        return self.sock
+
+    def put(self, producer_socket):
+        with self.lock:
+            socket.send_fds(self.connect(), [b"P"], [producer_socket.fileno()])
+
+    def take(self):
+        with self.lock:
+            sock = self.connect()
+            sock.sendall(b"T")
+            status, fds, _, _ = socket.recv_fds(sock, 1, 1)
+            if status != b"1" or not fds:
+                return None
+            return socket.socket(fileno=fds[0])
+
+    def count(self):
+        with self.lock:
+            sock = self.connect()
+            sock.sendall(b"N")
+            return struct.unpack("!I", sock.recv(4))[0]
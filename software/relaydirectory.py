@@ -0,0 +1,120 @@
+import time
+import json
+import socket
+import logging
+import threading
+
+COUNTRY_SEPARATOR = "-country-"
+
+
+def parse_username(username):
+    """Separa il paese richiesto dallo username SOCKS5: "mario-country-us" -> ("mario", "us")."""
+    if COUNTRY_SEPARATOR in username:
+        base, country = username.rsplit(COUNTRY_SEPARATOR, 1)
+        return base, country.lower()
+    return username, None
+
+
+class RelayInfo:
+
+    def __init__(self, country, host, status_port):
+        self.country = country
+        self.host = host
+        self.status_port = status_port
+        self.healthy = True  # ottimista finche' il primo probe non dice il contrario
+        self.rtt = None
+        self.free_producers = None
+        self.producers = None
+        self.failures = 0
+        self.last_probe = 0
+
+
+class RelayDirectory:
+    """Stato dei relay di paese aggiornato da probe periodici in background.
+
+    select() legge solo lo stato in memoria, quindi non blocca mai il thread che
+    accetta i Client. Ogni relay espone la porta di stato di GeoTcpRelay, che
+    risponde con una riga JSON contenente i Producer liberi.
+    """
+
+    def __init__(self, relays, status_port=60002, default_country="it", probe_interval=5,
+                 probe_timeout=2, rtt_alpha=0.3):
+        self.relays = [RelayInfo(country.lower(), host, status_port) for country, host in relays]
+        self.default_country = default_country
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.rtt_alpha = rtt_alpha
+        self.lock = threading.Lock()
+
+    def start(self):
+        for relay in self.relays:
+            threading.Thread(target=self.probe_loop, args=(relay,), daemon=True).start()
+
+    def hosts(self):
+        return [relay.host for relay in self.relays]
+
+    def probe_loop(self, relay):
+        while True:
+            self.probe(relay)
+            time.sleep(self.probe_interval)
+
+    def probe(self, relay):
+        started = time.monotonic()
+        try:
+            with socket.create_connection((relay.host, relay.status_port), timeout=self.probe_timeout) as sock:
+                rtt = time.monotonic() - started
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = sock.recv(1024)
+                    if not chunk:
+                        break
+                    data += chunk
+            status = json.loads(data)
+        except (OSError, ValueError) as e:
+            with self.lock:
+                relay.failures += 1
+                relay.healthy = False
+                relay.last_probe = time.monotonic()
+            logging.warning("Relay %s failed health probe: %s", relay.host, e)
+            return
+
+        with self.lock:
+            # Media mobile esponenziale per non inseguire i picchi di un singolo probe
+            relay.rtt = rtt if relay.rtt is None else relay.rtt + self.rtt_alpha * (rtt - relay.rtt)
+            relay.free_producers = status.get("free_producers")
+            relay.producers = status.get("producers")
+            relay.failures = 0
+            relay.healthy = True
+            relay.last_probe = time.monotonic()
+
+    def report_failure(self, host):
+        # Errore visto da un Client: il relay viene escluso subito, il prossimo probe lo puo' riabilitare
+        with self.lock:
+            for relay in self.relays:
+                if relay.host == host:
+                    relay.healthy = False
+                    relay.failures += 1
+
+    def select(self, country=None, exclude=()):
+        country = (country or self.default_country).lower()
+        with self.lock:
+            candidates = [relay for relay in self.relays
+                          if relay.country == country and relay.healthy and relay.host not in exclude]
+        if not candidates:
+            return None
+
+        # Prima i relay con Producer liberi (o non ancora misurati), poi il piu' veloce
+        with_capacity = [relay for relay in candidates if relay.free_producers is None or relay.free_producers > 0]
+        pool = with_capacity or candidates
+        best = min(pool, key=lambda relay: relay.rtt if relay.rtt is not None else float("inf"))
+        return best.host
+
+    def select_for_producer(self, country=None):
+        # Un nuovo Producer va al relay del paese che ne ha meno, a parita' quello con meno Producer liberi
+        country = (country or self.default_country).lower()
+        with self.lock:
+            candidates = [relay for relay in self.relays if relay.country == country and relay.healthy]
+        if not candidates:
+            return None
+        best = min(candidates, key=lambda relay: (relay.producers or 0, relay.free_producers or 0))
+        return best.host
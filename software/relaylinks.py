@@ -0,0 +1,116 @@
+import time
+import socket
+import logging
+import threading
+from socks5 import Socks5Client
+from mux import MuxSession
+
+
+class RelayLinkPool:
+    """Link persistenti ClientGateway -> relay di paese, gia' autenticati e multiplexati.
+
+    Ogni link fa una sola volta l'handshake SOCKS5 (metodo + auth "gateway") verso
+    la porta link del relay; poi ogni Client diventa uno stream mux che parte
+    direttamente dalla fase CONNECT.
+    """
+
+    def __init__(self, port, links_per_relay=2, username="gateway", password="gateway",
+                 max_streams=256, keepalive=15, link_timeout=45):
+        self.port = port
+        self.links_per_relay = links_per_relay
+        self.username = username
+        self.password = password
+        self.max_streams = max_streams
+        self.keepalive = keepalive
+        self.link_timeout = link_timeout  # secondi senza frame dal relay (PONG compresi) dopo i quali il link e' morto
+        self.links = {}  # relay -> [MuxSession]
+        self.relays = set()
+        self.lock = threading.Lock()
+
+    def start(self, relays=()):
+        # Prepara i link verso i relay noti e li tiene vivi in background
+        self.relays.update(relays)
+        threading.Thread(target=self.maintain, daemon=True).start()
+
+    def open_stream(self, relay, session_key=None):
+        metadata = session_key.encode('utf-8') if session_key else b""
+        return self.get_link(relay).open_stream(metadata)
+
+    def get_link(self, relay):
+        with self.lock:
+            self.relays.add(relay)
+            links = [link for link in self.links.get(relay, []) if link.has_capacity() and self.alive(link)]
+        # Si apre un nuovo link solo se quelli esistenti sono pieni o non bastano ancora
+        if links and (len(links) >= self.links_per_relay or min(link.active_streams for link in links) == 0):
+            return min(links, key=lambda link: link.active_streams)
+        try:
+            return self.connect(relay)
+        except OSError:
+            if links:
+                return min(links, key=lambda link: link.active_streams)
+            raise
+
+    def connect(self, relay):
+        link_socket = socket.create_connection((relay, self.port), timeout=10)
+        try:
+            link_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = Socks5Client(link_socket)
+            # Metodo e credenziali in un solo round trip
+            client.send_version_nmethods_methods()
+            client.send_auth(self.username, self.password)
+            if not client.get_version_method_response() or not client.get_auth_response():
+                raise ConnectionError("Relay link authentication failed")
+            link_socket.settimeout(None)
+        except Exception:
+            link_socket.close()
+            raise
+
+        link = MuxSession(link_socket, initiator=True, on_close=self.remove_link, max_streams=self.max_streams,
+                          initial_data=client.take_buffered())
+        link.relay = relay
+        with self.lock:
+            self.links.setdefault(relay, []).append(link)
+        threading.Thread(target=link.run, daemon=True).start()
+        logging.info("Opened relay link to %s", relay)
+        return link
+
+    def remove_link(self, link):
+        with self.lock:
+            links = self.links.get(link.relay, [])
+            if link in links:
+                links.remove(link)
+        logging.info("Relay link to %s closed", link.relay)
+
+    def alive(self, link):
+        return time.monotonic() - link.last_seen <= self.link_timeout
+
+    def close_dead_links(self, relay):
+        # Link che non rispondono ai ping: fuori dal pool subito, poi chiusi; maintain() li sostituisce
+        with self.lock:
+            links = self.links.get(relay, [])
+            dead = [link for link in links if not self.alive(link)]
+            for link in dead:
+                links.remove(link)
+        for link in dead:
+            logging.warning("Relay link to %s silent for %s seconds, closing it", relay, self.link_timeout)
+            link.close()
+
+    def link_count(self, relay):
+        with self.lock:
+            # I link in GOAWAY (relay in hot restart) finiscono i loro stream ma non contano piu'
+            return sum(1 for link in self.links.get(relay, []) if not link.going_away)
+
+    def maintain(self):
+        while True:
+            for relay in list(self.relays):
+                self.close_dead_links(relay)
+                try:
+                    while self.link_count(relay) < self.links_per_relay:
+                        self.connect(relay)
+                except OSError as e:
+                    logging.warning("Cannot open relay link to %s: %s", relay, e)
+                with self.lock:
+                    links = list(self.links.get(relay, []))
+                for link in links:
+                    link.ping()
+            time.sleep(self.keepalive)
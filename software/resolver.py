@@ -0,0 +1,292 @@
+import time
+import random
+import socket
+import struct
+import asyncio
+import logging
+import ipaddress
+import threading
+from collections import OrderedDict
+
+TYPE_A = 1
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_AAAA = 28
+CLASS_IN = 1
+
+RCODE_OK = 0
+RCODE_NXDOMAIN = 3
+
+FLAG_TC = 0x0200  # risposta troncata: va ripetuta via TCP (RFC 7766)
+
+DNS_HEADER = struct.Struct("!HHHHHH")
+DNS_RR = struct.Struct("!HHIH")
+
+
+class ResolveError(Exception):
+    pass
+
+
+def read_nameservers(path="/etc/resolv.conf"):
+    nameservers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    nameservers.append((parts[1], 53))
+    except OSError:
+        pass
+    return nameservers or [("127.0.0.1", 53)]
+
+
+def read_hosts(path="/etc/hosts"):
+    hosts = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split("#", 1)[0].split()
+                for name in parts[1:]:
+                    hosts.setdefault(name.lower(), []).append(parts[0])
+    except OSError:
+        pass
+    return hosts
+
+
+def build_query(query_id, name, qtype):
+    packet = DNS_HEADER.pack(query_id, 0x0100, 1, 0, 0, 0)  # RD=1, una domanda
+    for label in name.rstrip(".").split("."):
+        encoded = label.encode("idna")
+        packet += struct.pack("!B", len(encoded)) + encoded
+    return packet + struct.pack("!BHH", 0, qtype, CLASS_IN)
+
+
+def skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:  # puntatore di compressione
+            return offset + 2
+        offset += 1
+        if length == 0:
+            return offset
+        offset += length
+
+
+def parse_response(data, query_id, qtype):
+    """Restituisce (rcode, indirizzi, ttl) per una risposta DNS."""
+    ident, flags, qdcount, ancount, nscount, _ = DNS_HEADER.unpack_from(data)
+    if ident != query_id or not flags & 0x8000:
+        raise ResolveError("Unexpected DNS response")
+
+    offset = DNS_HEADER.size
+    for _ in range(qdcount):
+        offset = skip_name(data, offset) + 4
+
+    addresses = []
+    ttl = None
+    for index in range(ancount + nscount):
+        offset = skip_name(data, offset)
+        rtype, rclass, rttl, rdlength = DNS_RR.unpack_from(data, offset)
+        offset += DNS_RR.size
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+
+        if index < ancount and rtype == qtype == TYPE_A and rdlength == 4:
+            addresses.append(socket.inet_ntop(socket.AF_INET, rdata))
+        elif index < ancount and rtype == qtype == TYPE_AAAA and rdlength == 16:
+            addresses.append(socket.inet_ntop(socket.AF_INET6, rdata))
+        elif index >= ancount and rtype == TYPE_SOA and not addresses:
+            # Caching negativo (RFC 2308): min(TTL del SOA, campo MINIMUM)
+            rttl = min(rttl, struct.unpack("!I", rdata[-4:])[0])
+        else:
+            continue
+        ttl = rttl if ttl is None else min(ttl, rttl)
+
+    return flags & 0x000F, addresses, ttl
+
+
+class Resolver:
+    """Risoluzione DNS con cache LRU che rispetta i TTL, caching negativo e coalescing.
+
+    Interroga direttamente i nameserver via UDP (quelli di /etc/resolv.conf o quelli
+    passati, per esempio un server DNS di test in locale), chiedendo A e AAAA in
+    parallelo; le risposte troncate (TC) si ripetono via TCP. Richieste concorrenti
+    per lo stesso nome aspettano la stessa query.
+    """
+
+    def __init__(self, nameservers=None, timeout=2.0, attempts=2, max_entries=10000,
+                 min_ttl=5, max_ttl=3600, negative_ttl=30, hosts=None):
+        self.nameservers = nameservers or read_nameservers()
+        self.timeout = timeout
+        self.attempts = attempts
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.hosts = read_hosts() if hosts is None else hosts
+        self.cache = OrderedDict()  # nome -> (scadenza, indirizzi); lista vuota = risposta negativa
+        self.inflight = {}  # nome -> (Event, risultato)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, name):
+        """Lista di indirizzi IPv4 e IPv6 per name; ResolveError se il nome non esiste."""
+        name = name.lower().rstrip(".")
+        try:
+            return [str(ipaddress.ip_address(name))]
+        except ValueError:
+            pass
+        if name in self.hosts:
+            return list(self.hosts[name])
+
+        with self.lock:
+            cached = self.cache.get(name)
+            if cached is not None and cached[0] > time.monotonic():
+                self.cache.move_to_end(name)
+                self.hits += 1
+                return self.cached_result(name, cached[1])
+            self.misses += 1
+
+            inflight = self.inflight.get(name)
+            leader = inflight is None
+            if leader:
+                inflight = (threading.Event(), [])
+                self.inflight[name] = inflight
+
+        event, result = inflight
+        if not leader:
+            # Qualcun altro sta gia' risolvendo questo nome
+            event.wait(self.timeout * self.attempts + 1)
+            if not result:
+                raise ResolveError(f"Resolution of {name} failed")
+            return self.cached_result(name, result[0])
+
+        try:
+            addresses, ttl = self.query(name)
+            with self.lock:
+                ttl = self.negative_ttl if not addresses and ttl is None else ttl
+                ttl = max(self.min_ttl, min(self.max_ttl, ttl if ttl is not None else self.min_ttl))
+                self.cache[name] = (time.monotonic() + ttl, addresses)
+                self.cache.move_to_end(name)
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+            result.append(addresses)
+        finally:
+            with self.lock:
+                del self.inflight[name]
+            event.set()
+
+        return self.cached_result(name, addresses)
+
+    def resolve_cached(self, name):
+        """Come resolve ma senza interrogare i nameserver: None se il nome non e' in cache.
+
+        Una lista vuota e' una risposta negativa in cache.
+        """
+        name = name.lower().rstrip(".")
+        try:
+            return [str(ipaddress.ip_address(name))]
+        except ValueError:
+            pass
+        if name in self.hosts:
+            return list(self.hosts[name])
+        with self.lock:
+            cached = self.cache.get(name)
+            if cached is None or cached[0] <= time.monotonic():
+                return None
+            self.cache.move_to_end(name)
+            self.hits += 1
+            return list(cached[1])
+
+    async def resolve_async(self, name):
+        return await asyncio.get_running_loop().run_in_executor(None, self.resolve, name)
+
+    def cached_result(self, name, addresses):
+        if not addresses:
+            raise ResolveError(f"Name {name} does not resolve")
+        return list(addresses)
+
+    def query(self, name):
+        last_error = None
+        for attempt in range(self.attempts):
+            for nameserver in self.nameservers:
+                try:
+                    return self.query_nameserver(name, nameserver)
+                except (OSError, ResolveError, struct.error, IndexError) as e:
+                    last_error = e
+        logging.warning("DNS resolution of %s failed: %s", name, last_error)
+        raise ResolveError(f"Resolution of {name} failed: {last_error}")
+
+    def query_nameserver(self, name, nameserver):
+        family = socket.AF_INET6 if ":" in nameserver[0] else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.connect(nameserver)
+            # A e AAAA partono insieme: una sola attesa per entrambe le famiglie
+            base_id = random.getrandbits(16)
+            queries = {}
+            for query_id, qtype in ((base_id, TYPE_A), (base_id ^ 1, TYPE_AAAA)):
+                queries[query_id] = qtype
+                sock.send(build_query(query_id, name, qtype))
+
+            deadline = time.monotonic() + self.timeout
+            results = {}
+            while len(results) < len(queries):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ResolveError("DNS query timed out")
+                sock.settimeout(remaining)
+                data = sock.recv(4096)
+                query_id, flags = struct.unpack_from("!HH", data)
+                if query_id in queries and query_id not in results:
+                    if flags & FLAG_TC:
+                        results[query_id] = self.query_tcp(name, nameserver, query_id, queries[query_id])
+                    else:
+                        results[query_id] = parse_response(data, query_id, queries[query_id])
+
+        addresses = []
+        ttls = []
+        nxdomain = False
+        for query_id in sorted(results, key=lambda query_id: queries[query_id]):
+            rcode, found, ttl = results[query_id]
+            if rcode == RCODE_NXDOMAIN:
+                nxdomain = True
+            elif rcode != RCODE_OK:
+                raise ResolveError(f"DNS server answered with rcode {rcode}")
+            addresses.extend(found)
+            if ttl is not None:
+                ttls.append(ttl)
+        if nxdomain and not addresses:
+            return [], min(ttls) if ttls else None
+        return addresses, min(ttls) if ttls else None
+
+    def query_tcp(self, name, nameserver, query_id, qtype):
+        # Ogni messaggio e' preceduto dalla sua lunghezza su due byte
+        query = build_query(query_id, name, qtype)
+        with socket.create_connection(nameserver, timeout=self.timeout) as sock:
+            sock.sendall(struct.pack("!H", len(query)) + query)
+            data = b""
+            length = None
+            while length is None or len(data) < 2 + length:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ResolveError("DNS server closed the TCP connection")
+                data += chunk
+                if length is None and len(data) >= 2:
+                    length = struct.unpack_from("!H", data)[0]
+        data = data[2:2 + length]
+        if struct.unpack_from("!H", data, 2)[0] & FLAG_TC:
+            raise ResolveError("Truncated DNS response over TCP")
+        return parse_response(data, query_id, qtype)
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_default_resolver():
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = Resolver()
+        return _default_resolver
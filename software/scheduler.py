@@ -0,0 +1,469 @@
+import os
+import socket
+import random
+import struct
+import itertools
+import threading
+from collections import OrderedDict, deque
+
+TCP_INFO_FORMAT = "=8B24I"
+TCP_INFO_RTT = 8 + 15  # tcpi_rtt, in microsecondi
+
+
+def measure_rtt(sock):
+    """RTT stimato dal kernel per una connessione TCP (Linux, TCP_INFO), in secondi."""
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, struct.calcsize(TCP_INFO_FORMAT))
+        return struct.unpack(TCP_INFO_FORMAT, info)[TCP_INFO_RTT] / 1e6
+    except (OSError, AttributeError, struct.error):
+        return None
+
+
+class ProducerEntry:
+    __slots__ = ("endpoint", "capacity", "load", "rtt", "order", "available", "heap_index", "set_index")
+
+    def __init__(self, endpoint, capacity, rtt, order):
+        self.endpoint = endpoint
+        self.capacity = capacity
+        self.load = 0
+        self.rtt = rtt
+        self.order = order
+        self.available = False
+        self.heap_index = None
+        self.set_index = None
+
+    def utilization(self):
+        return self.load / self.capacity
+
+
+class IndexedHeap:
+    """Min-heap che conosce la posizione di ogni elemento: update e remove in O(log n)."""
+
+    def __init__(self, key):
+        self.key = key
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, entry):
+        entry.heap_index = len(self.items)
+        self.items.append(entry)
+        self.sift_up(entry.heap_index)
+
+    def peek(self):
+        return self.items[0] if self.items else None
+
+    def remove(self, entry):
+        index = entry.heap_index
+        last = self.items.pop()
+        entry.heap_index = None
+        if last is not entry:
+            self.items[index] = last
+            last.heap_index = index
+            self.update(last)
+
+    def update(self, entry):
+        self.sift_up(entry.heap_index)
+        self.sift_down(entry.heap_index)
+
+    def sift_up(self, index):
+        items, key = self.items, self.key
+        entry = items[index]
+        while index > 0:
+            parent = (index - 1) >> 1
+            if key(items[parent]) <= key(entry):
+                break
+            items[index] = items[parent]
+            items[index].heap_index = index
+            index = parent
+        items[index] = entry
+        entry.heap_index = index
+
+    def sift_down(self, index):
+        items, key = self.items, self.key
+        size = len(items)
+        entry = items[index]
+        while True:
+            child = 2 * index + 1
+            if child >= size:
+                break
+            if child + 1 < size and key(items[child + 1]) < key(items[child]):
+                child += 1
+            if key(entry) <= key(items[child]):
+                break
+            items[index] = items[child]
+            items[index].heap_index = index
+            index = child
+        items[index] = entry
+        entry.heap_index = index
+
+
+class IndexedSet:
+    """Array con rimozione per scambio con l'ultimo elemento: add, remove e scelta casuale in O(1)."""
+
+    def __init__(self):
+        self.items = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, entry):
+        entry.set_index = len(self.items)
+        self.items.append(entry)
+
+    def remove(self, entry):
+        index = entry.set_index
+        last = self.items.pop()
+        entry.set_index = None
+        if last is not entry:
+            self.items[index] = last
+            last.set_index = index
+
+    def sample(self):
+        return self.items[random.randrange(len(self.items))] if self.items else None
+
+
+class RandomPolicy:
+    # Stesso comportamento del vecchio random.choice, ma con rimozione in O(1)
+
+    def __init__(self):
+        self.entries = IndexedSet()
+
+    def add(self, entry):
+        self.entries.add(entry)
+
+    def remove(self, entry):
+        self.entries.remove(entry)
+
+    def update(self, entry):
+        pass
+
+    def pick(self):
+        return self.entries.sample()
+
+
+class PowerOfTwoPolicy(RandomPolicy):
+
+    def pick(self):
+        first = self.entries.sample()
+        second = self.entries.sample()
+        if first is None or second is None:
+            return first
+        return first if first.utilization() <= second.utilization() else second
+
+
+class LeastLoadedPolicy:
+
+    def __init__(self):
+        self.heap = IndexedHeap(self.score)
+
+    def score(self, entry):
+        return (entry.utilization(), entry.order)
+
+    def add(self, entry):
+        self.heap.push(entry)
+
+    def remove(self, entry):
+        self.heap.remove(entry)
+
+    def update(self, entry):
+        self.heap.update(entry)
+
+    def pick(self):
+        return self.heap.peek()
+
+
+class LowestRttPolicy(LeastLoadedPolicy):
+
+    def score(self, entry):
+        rtt = entry.rtt if entry.rtt is not None else float("inf")
+        return (rtt, entry.utilization(), entry.order)
+
+
+POLICIES = {
+    "random": RandomPolicy,
+    "least_loaded": LeastLoadedPolicy,
+    "lowest_rtt": LowestRttPolicy,
+    "power_of_two": PowerOfTwoPolicy,
+}
+
+
+class ProducerScheduler:
+    """Sceglie il Producer (socket singolo o MuxSession) a cui affidare un Client.
+
+    Solo i Producer con capacita' libera stanno nella struttura della policy, per cui
+    scelta, registrazione e rimozione restano O(1) o O(log n) anche con decine di
+    migliaia di Producer. Con sticky=True lo stesso session_key (es. lo username)
+    torna sullo stesso Producer finche' questo ha capacita'. Non e' thread-safe:
+    il chiamante tiene il proprio lock.
+    """
+
+    def __init__(self, policy="random", sticky=False, max_sticky=100000):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown scheduling policy: {policy}")
+        self.policy = POLICIES[policy]()
+        self.entries = {}
+        self.sticky = OrderedDict() if sticky else None
+        self.max_sticky = max_sticky
+        self.counter = itertools.count()
+        self.available_count = 0
+        self.free_slots = 0  # somma della capacita' libera di tutti i Producer
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, endpoint):
+        return endpoint in self.entries
+
+    def add(self, endpoint, capacity=1, rtt=None):
+        entry = ProducerEntry(endpoint, capacity, rtt, next(self.counter))
+        self.entries[endpoint] = entry
+        self.free_slots += capacity
+        self.set_available(entry, True)
+        return entry
+
+    def remove(self, endpoint):
+        entry = self.entries.pop(endpoint, None)
+        if entry is None:
+            return False
+        self.free_slots -= entry.capacity - entry.load
+        self.set_available(entry, False)
+        return True
+
+    def remove_idle(self, endpoint):
+        # Rimuove il Producer solo se non sta servendo nessun Client (eviction dei Producer morti)
+        entry = self.entries.get(endpoint)
+        if entry is None or entry.load:
+            return False
+        return self.remove(endpoint)
+
+    def take_idle(self):
+        # Toglie e restituisce tutti i Producer che non servono nessun Client (hot restart)
+        idle = [endpoint for endpoint, entry in self.entries.items() if not entry.load]
+        for endpoint in idle:
+            self.remove(endpoint)
+        return idle
+
+    def acquire(self, session_key=None):
+        entry = None
+        if self.sticky is not None and session_key is not None:
+            entry = self.sticky.get(session_key)
+            if entry is not None and not entry.available:
+                entry = None
+        if entry is None:
+            entry = self.policy.pick()
+        if entry is None:
+            return None
+
+        self.assign(entry)
+        if self.sticky is not None and session_key is not None:
+            self.sticky[session_key] = entry
+            self.sticky.move_to_end(session_key)
+            if len(self.sticky) > self.max_sticky:
+                self.sticky.popitem(last=False)
+        return entry.endpoint
+
+    def acquire_endpoint(self, endpoint):
+        # Un Producer scelto dal chiamante, se e' ancora registrato e ha capacita' libera
+        entry = self.entries.get(endpoint)
+        if entry is None or not entry.available:
+            return None
+        self.assign(entry)
+        return endpoint
+
+    def assign(self, entry):
+        entry.load += 1
+        self.free_slots -= 1
+        if entry.load >= entry.capacity:
+            self.set_available(entry, False)
+        else:
+            self.policy.update(entry)
+
+    def release(self, endpoint, rtt=None):
+        entry = self.entries.get(endpoint)
+        if entry is None:
+            return
+        if entry.load > 0:
+            entry.load -= 1
+            self.free_slots += 1
+        if rtt is not None:
+            entry.rtt = rtt
+        if entry.available:
+            self.policy.update(entry)
+        else:
+            self.set_available(entry, True)
+
+    def update_rtt(self, endpoint, rtt):
+        entry = self.entries.get(endpoint)
+        if entry is not None and rtt is not None:
+            entry.rtt = rtt
+            if entry.available:
+                self.policy.update(entry)
+
+    def set_available(self, entry, available):
+        if entry.available == available:
+            return
+        entry.available = available
+        if available:
+            self.policy.add(entry)
+            self.available_count += 1
+        else:
+            self.policy.remove(entry)
+            self.available_count -= 1
+
+
+class SchedulerShard:
+
+    def __init__(self, policy):
+        self.scheduler = ProducerScheduler(policy)
+        self.pending = deque()  # (endpoint, capacita', rtt) in attesa di registrazione
+        self.lock = threading.Lock()
+
+    def drain(self):
+        # Con il lock: registra in un colpo solo tutti i Producer accodati dagli altri thread
+        pending = self.pending
+        while pending:
+            self.scheduler.add(*pending.popleft())
+
+
+class ShardedScheduler:
+    """ProducerScheduler diviso in shard, ognuno con il proprio lock e la propria free list.
+
+    Un Producer vive sempre nello stesso shard (scelto dall'hash dell'oggetto, stabile
+    anche dopo la chiusura del socket), quindi add, remove e release toccano un solo
+    lock. La scelta resta globale: per least_loaded e lowest_rtt acquire legge senza
+    lock il migliore di ogni shard e prende il lock solo di quello vincente, per
+    power_of_two estrae i due candidati tra tutti i Producer disponibili. La mappa
+    delle sessioni sticky e' unica, quindi uno username resta sul suo Producer
+    qualunque shard sia pieno. Se un altro thread ha gia' preso il candidato, o con
+    la policy random, acquire parte da uno shard casuale e passa al successivo solo
+    se e' pieno. Le registrazioni vengono accodate senza lock e applicate a blocchi
+    da chi trova il lock dello shard libero: migliaia di Producer che si riconnettono
+    insieme non si mettono in fila. E' thread-safe.
+    """
+
+    def __init__(self, policy="random", sticky=False, max_sticky=100000, shards=None):
+        count = shards or 4 * (os.cpu_count() or 1)
+        self.shards = [SchedulerShard(policy) for _ in range(count)]
+        self.sticky = OrderedDict() if sticky else None  # session_key -> endpoint
+        self.max_sticky = max_sticky
+        self.sticky_lock = threading.Lock()
+        self.pick = {"least_loaded": self.pick_best, "lowest_rtt": self.pick_best,
+                     "power_of_two": self.pick_two}.get(policy)
+
+    def __len__(self):
+        return sum(len(shard.scheduler) + len(shard.pending) for shard in self.shards)
+
+    def __contains__(self, endpoint):
+        return self.run(self.shard(endpoint), ProducerScheduler.__contains__, endpoint)
+
+    @property
+    def free_slots(self):
+        # Lettura senza lock: serve a metriche e probe
+        return sum(shard.scheduler.free_slots + sum(item[1] for item in list(shard.pending))
+                   for shard in self.shards)
+
+    def shard(self, endpoint):
+        return self.shards[hash(endpoint) % len(self.shards)]
+
+    def run(self, shard, operation, *args):
+        with shard.lock:
+            shard.drain()
+            result = operation(shard.scheduler, *args)
+        self.combine(shard)
+        return result
+
+    def combine(self, shard):
+        # Chi rilascia il lock ricontrolla la coda: un add arrivato mentre era occupato non resta indietro
+        while shard.pending and shard.lock.acquire(blocking=False):
+            try:
+                shard.drain()
+            finally:
+                shard.lock.release()
+
+    def add(self, endpoint, capacity=1, rtt=None):
+        shard = self.shard(endpoint)
+        shard.pending.append((endpoint, capacity, rtt))
+        self.combine(shard)
+
+    def remove(self, endpoint):
+        return self.run(self.shard(endpoint), ProducerScheduler.remove, endpoint)
+
+    def remove_idle(self, endpoint):
+        return self.run(self.shard(endpoint), ProducerScheduler.remove_idle, endpoint)
+
+    def take_idle(self):
+        return [endpoint for shard in self.shards for endpoint in self.run(shard, ProducerScheduler.take_idle)]
+
+    def release(self, endpoint, rtt=None):
+        self.run(self.shard(endpoint), ProducerScheduler.release, endpoint, rtt)
+
+    def update_rtt(self, endpoint, rtt):
+        self.run(self.shard(endpoint), ProducerScheduler.update_rtt, endpoint, rtt)
+
+    def acquire(self, session_key=None):
+        sticky = self.sticky is not None and session_key is not None
+        endpoint = None
+        if sticky:
+            with self.sticky_lock:
+                endpoint = self.sticky.get(session_key)
+            if endpoint is not None:
+                endpoint = self.run(self.shard(endpoint), ProducerScheduler.acquire_endpoint, endpoint)
+        if endpoint is None and self.pick is not None:
+            endpoint = self.pick()
+        if endpoint is None:
+            endpoint = self.scan()
+        if endpoint is not None and sticky:
+            with self.sticky_lock:
+                self.sticky[session_key] = endpoint
+                self.sticky.move_to_end(session_key)
+                if len(self.sticky) > self.max_sticky:
+                    self.sticky.popitem(last=False)
+        return endpoint
+
+    def pick_best(self):
+        # Il primo dell'heap di ogni shard letto senza lock: basta a scegliere quale lock prendere
+        best = best_score = None
+        for shard in self.shards:
+            policy = shard.scheduler.policy
+            try:
+                entry = policy.pick()
+                score = policy.score(entry) if entry is not None else None
+            except (IndexError, ZeroDivisionError):
+                continue  # heap modificato da un altro thread durante la lettura
+            if score is not None and (best is None or score < best_score):
+                best, best_score = shard, score
+        if best is None:
+            return None
+        return self.run(best, ProducerScheduler.acquire)
+
+    def pick_two(self):
+        # Shard pesati per Producer disponibili: i due candidati sono uniformi su tutto il relay
+        sizes = [len(shard.scheduler.policy.entries) for shard in self.shards]
+        if not any(sizes):
+            return None
+        candidates = []
+        for shard in random.choices(self.shards, weights=sizes, k=2):
+            try:
+                entry = shard.scheduler.policy.entries.sample()
+            except (IndexError, ValueError):
+                continue
+            if entry is not None:
+                candidates.append((entry.utilization(), shard, entry.endpoint))
+        if not candidates:
+            return None
+        _, shard, endpoint = min(candidates, key=lambda candidate: candidate[0])
+        return self.run(shard, ProducerScheduler.acquire_endpoint, endpoint)
+
+    def scan(self):
+        count = len(self.shards)
+        start = random.randrange(count)
+        for index in range(count):
+            shard = self.shards[(start + index) % count]
+            if not shard.scheduler.free_slots and not shard.pending:
+                continue  # shard pieno: si evita il lock
+            endpoint = self.run(shard, ProducerScheduler.acquire)
+            if endpoint is not None:
+                return endpoint
+        return None
@@ -2,49 +2,428 @@ import struct
 import socket
 import select
 import io
+import os
+import time
+import fcntl
 import threading
+from resolver import get_default_resolver, ResolveError
+from connector import (get_default_connector, ConnectError, REPLY_HOST_UNREACHABLE,
+                       REPLY_COMMAND_NOT_SUPPORTED, REPLY_ADDRESS_TYPE_NOT_SUPPORTED)
+from metrics import TUNNEL_BYTES_UP, TUNNEL_BYTES_DOWN
+
+class TunnelIdleTimeout(TimeoutError):
+    pass
+
 
 class DataExchanger:
 
-    def __init__(self, dst, src):
+    def __init__(self, dst, src, buffer_size=4096, zero_copy=False, meter=None, high_watermark=None,
+                 low_watermark=None, idle_timeout=None):
         self.dst = dst
         self.src = src
+        self.buffer_size = buffer_size
+        self.zero_copy = zero_copy
+        self.meter = meter  # TunnelMeter: conteggio byte e shaping; dst e' il lato che ha aperto il tunnel
+        self.high_watermark = high_watermark  # se impostato: buffer limitati per direzione e half-close
+        self.low_watermark = low_watermark if low_watermark is not None else (high_watermark or 0) // 4
+        self.idle_timeout = idle_timeout  # secondi senza traffico dopo i quali si solleva TunnelIdleTimeout
+        self.last_activity = time.monotonic()
 
     def exchange_data(self):
+        if self.high_watermark:
+            return self.exchange_data_buffered()
+        if self.zero_copy:
+            if hasattr(os, "splice"):
+                return self.splice_data()
+            return self.exchange_data_into()
+
+        # Shard per thread dei contatori: l'aggiornamento e' una somma su una lista
+        up, down = TUNNEL_BYTES_UP.shard(), TUNNEL_BYTES_DOWN.shard()
+        poller = self.poller()
         while True:
             # wait until client or remote is available for read
-            read_sockets, _, _ = select.select([self.dst, self.src], [], [], 0.1)
+            read_sockets = self.wait_readable(poller)
 
             for socks in read_sockets:
                 if socks == self.dst:
-                    data = self.dst.recv(4096)
+                    data = self.dst.recv(self.buffer_size)
                     if len(data) == 0:  # Verifica se la connessione è stata chiusa
                         return
                     self.src.sendall(data)
                 elif socks == self.src:
-                    data = self.src.recv(4096)
+                    data = self.src.recv(self.buffer_size)
                     if len(data) == 0:  # Verifica se la connessione è stata chiusa
                         return
                     self.dst.sendall(data)
-        
-        
+                (up if socks is self.dst else down)[0] += len(data)
+                if self.meter is not None:
+                    self.throttle(socks, len(data))
+
+    def exchange_data_into(self):
+        # Buffer preallocati: nessun nuovo oggetto bytes per ogni recv
+        peers = {self.dst: self.src, self.src: self.dst}
+        buffers = {self.dst: memoryview(bytearray(self.buffer_size)),
+                   self.src: memoryview(bytearray(self.buffer_size))}
+        up, down = TUNNEL_BYTES_UP.shard(), TUNNEL_BYTES_DOWN.shard()
+        poller = self.poller()
+
+        while True:
+            read_sockets = self.wait_readable(poller)
 
+            for socks in read_sockets:
+                buffer = buffers[socks]
+                n = socks.recv_into(buffer)
+                if n == 0:  # Verifica se la connessione è stata chiusa
+                    return
+                peers[socks].sendall(buffer[:n])
+                (up if socks is self.dst else down)[0] += n
+                if self.meter is not None:
+                    self.throttle(socks, n)
+
+    def splice_data(self):
+        # Linux: i dati passano socket -> pipe -> socket senza essere copiati in user space
+        peers = {self.dst: self.src, self.src: self.dst}
+        pipes = {}
+        try:
+            for socks in peers:
+                pipes[socks] = os.pipe()
+            chunk = self.resize_pipes(pipes.values())
+            up, down = TUNNEL_BYTES_UP.shard(), TUNNEL_BYTES_DOWN.shard()
+            poller = self.poller()
+
+            while True:
+                read_sockets = self.wait_readable(poller)
+
+                for socks in read_sockets:
+                    pipe_r, pipe_w = pipes[socks]
+                    try:
+                        n = os.splice(socks.fileno(), pipe_w, chunk)
+                    except BlockingIOError:
+                        continue
+                    if n == 0:  # Verifica se la connessione è stata chiusa
+                        return
+                    self.splice_out(pipe_r, peers[socks], n)
+                    (up if socks is self.dst else down)[0] += n
+                    if self.meter is not None:
+                        self.throttle(socks, n)
+        finally:
+            for pipe_r, pipe_w in pipes.values():
+                os.close(pipe_r)
+                os.close(pipe_w)
+
+    def exchange_data_buffered(self):
+        """Inoltro con socket non bloccanti e un buffer limitato per direzione.
+
+        Un lato lento non ferma l'altra direzione: si smette di leggere dalla sorgente
+        quando il suo buffer raggiunge high_watermark e si riprende sotto low_watermark,
+        quindi la memoria per tunnel resta al massimo 2 * high_watermark. L'EOF di un
+        lato diventa shutdown(SHUT_WR) sull'altro dopo aver scritto il residuo; il
+        tunnel termina quando entrambe le direzioni sono chiuse.
+        """
+        peers = {self.dst: self.src, self.src: self.dst}
+        buffers = {sock: bytearray() for sock in peers}  # dati letti da sock, da scrivere sul peer
+        reading = {sock: True for sock in peers}
+        eof = {sock: False for sock in peers}
+        registered = {}  # fd -> eventi
+        by_fd = {sock.fileno(): sock for sock in peers}
+        up, down = TUNNEL_BYTES_UP.shard(), TUNNEL_BYTES_DOWN.shard()
+        paused_until = 0
+        poller = select.poll()
+        for sock in peers:
+            sock.setblocking(False)
+
+        while not (eof[self.dst] and eof[self.src] and not buffers[self.dst] and not buffers[self.src]):
+            now = time.monotonic()
+            for sock, peer in peers.items():
+                # Isteresi tra le due soglie: niente letture da un byte appena il peer scrive qualcosa
+                if len(buffers[sock]) >= self.high_watermark:
+                    reading[sock] = False
+                elif len(buffers[sock]) <= self.low_watermark:
+                    reading[sock] = True
+                events = 0
+                if reading[sock] and not eof[sock] and paused_until <= now:
+                    events |= select.POLLIN
+                if buffers[peer]:
+                    events |= select.POLLOUT
+                # Un socket senza eventi va tolto: poll riporta comunque POLLHUP e il loop girerebbe a vuoto
+                fd = sock.fileno()
+                if events != registered.get(fd, 0):
+                    if not events:
+                        poller.unregister(fd)
+                        del registered[fd]
+                    else:
+                        (poller.modify if fd in registered else poller.register)(fd, events)
+                        registered[fd] = events
+
+            timeout = max(0, paused_until - now) if paused_until > now else None
+            if self.idle_timeout:
+                idle = max(0, self.last_activity + self.idle_timeout - now)
+                timeout = idle if timeout is None else min(timeout, idle)
+            ready = poller.poll(None if timeout is None else timeout * 1000)
+            if self.idle_timeout:
+                self.check_idle(bool(ready))
+            for fd, mask in ready:
+                sock = by_fd[fd]
+                peer = peers[sock]
+                interest = registered.get(fd, 0)
+                # POLLHUP/POLLERR: si ritenta l'operazione in corso, che restituisce EOF o solleva l'errore
+                if mask & (select.POLLOUT | select.POLLHUP | select.POLLERR) and interest & select.POLLOUT:
+                    self.send_buffered(sock, buffers[peer], eof[peer])
+                if mask & (select.POLLIN | select.POLLHUP | select.POLLERR) and interest & select.POLLIN:
+                    try:
+                        data = sock.recv(min(self.buffer_size, self.high_watermark - len(buffers[sock])))
+                    except BlockingIOError:
+                        continue
+                    if not data:
+                        eof[sock] = True
+                        if not buffers[sock]:
+                            peer.shutdown(socket.SHUT_WR)
+                        continue
+                    (up if sock is self.dst else down)[0] += len(data)
+                    buffers[sock] += data
+                    # Scrittura ottimistica: di solito il peer e' pronto e si evita un giro di poll
+                    self.send_buffered(peer, buffers[sock], False)
+                    if self.meter is not None:
+                        delay = self.meter.account(sock is self.dst, len(data))
+                        if delay:
+                            paused_until = time.monotonic() + delay
+
+    @staticmethod
+    def send_buffered(sock, buffer, source_eof):
+        try:
+            sent = sock.send(buffer)
+        except BlockingIOError:
+            return
+        del buffer[:sent]
+        if not buffer and source_eof:
+            sock.shutdown(socket.SHUT_WR)
+
+    def poller(self):
+        # poll e non select: select rifiuta i file descriptor oltre FD_SETSIZE (1024)
+        poller = select.poll()
+        for sock in (self.dst, self.src):
+            poller.register(sock, select.POLLIN)
+        self.by_fd = {self.dst.fileno(): self.dst, self.src.fileno(): self.src}
+        return poller
+
+    def wait_readable(self, poller):
+        ready = [self.by_fd[fd] for fd, _ in poller.poll(100)]
+        if self.idle_timeout:
+            self.check_idle(bool(ready))
+        return ready
+
+    def check_idle(self, active):
+        now = time.monotonic()
+        if active:
+            self.last_activity = now
+        elif now - self.last_activity >= self.idle_timeout:
+            raise TunnelIdleTimeout("Tunnel idle")
+
+    def throttle(self, socks, n):
+        # Sopra la banda concessa il thread si ferma: smette di leggere da entrambi i lati
+        delay = self.meter.account(socks is self.dst, n)
+        if delay:
+            time.sleep(delay)
+
+    def resize_pipes(self, pipes):
+        chunk = min(self.buffer_size, 65536)
+        if self.buffer_size > 65536 and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                for _, pipe_w in pipes:
+                    fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, self.buffer_size)
+                chunk = self.buffer_size
+            except OSError:
+                pass
+        return chunk
+
+    def splice_out(self, pipe_r, sock, n):
+        while n > 0:
+            try:
+                n -= os.splice(pipe_r, sock.fileno(), n)
+            except BlockingIOError:
+                # socket con timeout (non bloccante a livello di fd): aspetta che sia scrivibile
+                poller = select.poll()
+                poller.register(sock, select.POLLOUT)
+                timeout = sock.gettimeout()
+                poller.poll(None if timeout is None else timeout * 1000)
+
+
+def parse_greeting(buffer):
+    """Parser incrementali: (byte consumati, campi...) oppure None se il messaggio non e' completo."""
+    if len(buffer) < 2:
+        return None
+    version, nmethods = buffer[0], buffer[1]
+    end = 2 + nmethods
+    if len(buffer) < end:
+        return None
+    return end, version, list(buffer[2:end])
+
+
+def parse_credentials(buffer):
+    if len(buffer) < 2:
+        return None
+    version, username_len = buffer[0], buffer[1]
+    if len(buffer) < 3 + username_len:
+        return None
+    password_len = buffer[2 + username_len]
+    end = 3 + username_len + password_len
+    if len(buffer) < end:
+        return None
+    username = bytes(buffer[2:2 + username_len]).decode('utf-8')
+    password = bytes(buffer[3 + username_len:end]).decode('utf-8')
+    return end, version, username, password
+
+
+def parse_status(buffer):
+    # Risposta a due byte: scelta del metodo o esito dell'autenticazione
+    if len(buffer) < 2:
+        return None
+    return 2, buffer[0], buffer[1]
+
+
+def parse_request(buffer):
+    # Stesso formato per la richiesta del Client e per la risposta del server (cmd -> status)
+    if len(buffer) < 5:
+        return None
+    version, cmd, _, address_type = buffer[0], buffer[1], buffer[2], buffer[3]
+    if address_type == 1:  # IPv4
+        start, address_len = 4, 4
+    elif address_type == 3:  # Domain name
+        start, address_len = 5, buffer[4]
+    elif address_type == 4:  # IPv6
+        start, address_len = 4, 16
+    else:
+        return 4, version, cmd, address_type, None, None
+
+    end = start + address_len + 2
+    if len(buffer) < end:
+        return None
+    raw_address = bytes(buffer[start:start + address_len])
+    if address_type == 1:
+        address = socket.inet_ntop(socket.AF_INET, raw_address)
+    elif address_type == 4:
+        address = socket.inet_ntop(socket.AF_INET6, raw_address)
+    else:
+        address = raw_address.decode('utf-8')
+    port = struct.unpack_from("!H", buffer, start + address_len)[0]
+    return end, version, cmd, address_type, address, port
+
+
+def build_credentials(username, password):
+    username = username.encode('utf-8')
+    password = password.encode('utf-8')
+    return struct.pack(f"!BB{len(username)}sB{len(password)}s", 1, len(username), username, len(password), password)
+
+
+def build_request(cmd, address_type, address, port):
+    if address_type == 1:
+        packed_address = socket.inet_aton(address)
+    elif address_type == 3:
+        encoded = address.encode('utf-8')
+        packed_address = struct.pack("!B", len(encoded)) + encoded
+    else:
+        packed_address = socket.inet_pton(socket.AF_INET6, address)
+    return struct.pack("!BBBB", 5, cmd, 0, address_type) + packed_address + struct.pack("!H", port)
+
+
+def build_reply(status, bind_address=None):
+    host, port = bind_address[:2] if bind_address else ("0.0.0.0", 0)
+    if ":" in host:
+        return build_request(status, 4, host, port)
+    return build_request(status, 1, host, port)
+
+
+class Socks5Parser:
+    """Buffer di ingresso e di uscita dell'handshake SOCKS5, senza I/O.
+
+    I byte arrivano con feed() in pezzi di qualsiasi dimensione; next() estrae il
+    prossimo messaggio completo lasciando nel buffer quelli inviati in pipeline.
+    Le risposte si accumulano con write() e partono insieme alla prima occasione,
+    cosi' un Client che invia tutto in una volta riceve tutto in una sola send.
+    Lo usano sia le classi sincrone su socket sia quelle asyncio.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.outbuf = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next(self, parse):
+        result = parse(self.buffer)
+        if result is None:
+            return None
+        del self.buffer[:result[0]]
+        return result[1:]
+
+    def write(self, data):
+        self.outbuf += data
+
+    def pending_output(self):
+        data = bytes(self.outbuf)
+        self.outbuf.clear()
+        return data
+
+    def take_buffered(self):
+        # Byte arrivati dopo l'handshake (es. il primo payload del Client): vanno inoltrati
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+class Socks5Connection:
 
-class Socks5Client:
     def __init__(self, sock):
         self.sock = sock
-        self.auth = False
+        self.parser = Socks5Parser()
+
+    def read(self, parse):
+        while True:
+            result = self.parser.next(parse)
+            if result is not None:
+                return result
+            self.receive()
+
+    def peek(self, parse):
+        # Come read, ma il messaggio resta nel buffer per essere inoltrato cosi' com'e'
+        while True:
+            result = parse(self.parser.buffer)
+            if result is not None:
+                return result[1:]
+            self.receive()
+
+    def receive(self):
+        # Prima di bloccarsi in attesa del peer, le risposte in coda partono con una sola send
+        self.flush()
+        data = self.sock.recv(4096)
+        if not data:
+            raise ConnectionError("Connection closed during SOCKS5 handshake")
+        self.parser.feed(data)
+
+    def write(self, data):
+        self.parser.write(data)
+
+    def flush(self):
+        data = self.parser.pending_output()
+        if data:
+            self.sock.sendall(data)
 
+    def take_buffered(self):
+        return self.parser.take_buffered()
 
 
+class Socks5Client(Socks5Connection):
+
+    def __init__(self, sock):
+        super().__init__(sock)
+        self.auth = False
+
     def send_version_nmethods_methods(self):
-        packet = struct.pack("!BBB", 5, 1, 2)
-        self.sock.sendall(packet)
+        self.write(struct.pack("!BBB", 5, 1, 2))
 
     def get_version_method_response(self):
-
-        header = self.sock.recv(2)
-        version, method = struct.unpack("!BB", header)
+        version, method = self.read(parse_status)
         if version != 5:
             # close connection
             return False
@@ -54,73 +433,57 @@ class Socks5Client:
             return False
 
         return True
-    
-    def send_auth(self,username,password):
-        packet = struct.pack("!BB", 1, len(username))
-        self.sock.sendall(packet)
-        self.sock.sendall(username.encode('utf-8'))
-        packet = struct.pack("!B", len(password))
-        self.sock.sendall(packet)
-        self.sock.sendall(password.encode('utf-8'))
 
+    def send_auth(self, username, password):
+        self.write(build_credentials(username, password))
 
     def get_auth_response(self):
-            
-            header = self.sock.recv(2)
-            version, status = struct.unpack("!BB", header)
-            if version != 1:
-                # close connection
-                return False
-    
-            if status != 0:
-                # close connection
-                return False
-    
-            return True
-    
+        version, status = self.read(parse_status)
+        if version != 1:
+            # close connection
+            return False
 
-    def send_request(self, cmd, address_type, address, port):
-        packet = struct.pack("!BBBB", 5, cmd, 0, address_type)
-        self.sock.sendall(packet)
-        if address_type == 1:
-            packet = struct.pack("!I", socket.inet_aton(address))
-            self.sock.sendall(packet)
-        elif address_type == 3:
-            packet = struct.pack("!B", len(address))
-            self.sock.sendall(packet)
-            self.sock.sendall(address.encode('utf-8'))
-        packet = struct.pack("!H", port)
-        self.sock.sendall(packet)
+        if status != 0:
+            # close connection
+            return False
 
+        self.auth = True
+        return True
 
+    def send_request(self, cmd, address_type, address, port):
+        self.write(build_request(cmd, address_type, address, port))
 
     def get_response(self):
-        header = self.sock.recv(4)
-        version, status, _, address_type = struct.unpack("!BBBB", header)
+        version, status, _, address, port = self.read(parse_request)
         if version != 5:
             # close connection
-            return False , None , None
-        
+            return False, None, None
+
         if status != 0:
             # close connection
-            return False , None , None
+            return False, None, None
 
-        if address_type == 1:
-            pass
+        return True, address, port
 
 
+class Socks5Server(Socks5Connection):
 
-
-class Socks5Server:
-
-    def __init__(self, sock):
-        self.sock = sock
+    def __init__(self, sock, resolver=None, connector=None):
+        super().__init__(sock)
         self.auth = False
+        self.resolver = resolver or get_default_resolver()
+        self.connector = connector or get_default_connector()
+        self.addresses = []  # tutti gli indirizzi risolti per l'ultima richiesta
+        self.greeted_at = None  # istante in cui e' arrivata la scelta del metodo (metriche per fase)
 
     def exchange_data(self, remote):
+        poller = select.poll()
+        poller.register(self.sock, select.POLLIN)
+        poller.register(remote, select.POLLIN)
+        sockets = {self.sock.fileno(): self.sock, remote.fileno(): remote}
         while True:
             # wait until client or remote is available for read
-            read_sockets, _, _ = select.select([self.sock, remote], [], [], 0.1)
+            read_sockets = [sockets[fd] for fd, _ in poller.poll(100)]
 
             for socks in read_sockets:
                 if socks == remote:
@@ -136,89 +499,170 @@ class Socks5Server:
 
     def send_reply(self, cmd, address, port):
 
-        if cmd == 1:  # CONNECT
-            remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            remote.connect((address, port))
-            bind_address = remote.getsockname()
-        else:
+        if cmd != 1:  # solo CONNECT
+            self.send_status(REPLY_COMMAND_NOT_SUPPORTED)
             return
 
-        addr = struct.unpack("!I", socket.inet_aton(bind_address[0]))[0]
-        port = bind_address[1]
-        reply = struct.pack("!BBBBIH", 5, 0, 0, 1,
-                            addr, port)
-        
+        # Tutti gli indirizzi risolti per la richiesta corrono insieme (Happy Eyeballs)
+        addresses = self.addresses if address in self.addresses else [address]
+        try:
+            remote = self.connector.connect(addresses, port)
+        except ConnectError as e:
+            self.send_status(e.reply)
+            raise
+        bind_address = remote.getsockname()
 
-        self.sock.sendall(reply)
+        self.send_status(0, bind_address)
+
+        # Payload inviato dal Client in pipeline con la richiesta
+        pipelined = self.take_buffered()
+        if pipelined:
+            remote.sendall(pipelined)
 
         return remote
 
+    def send_status(self, status, bind_address=None):
+        self.write(build_reply(status, bind_address))
+        self.flush()
+
     def get_request(self):
 
-        version, cmd, _, address_type = struct.unpack("!BBBB", self.sock.recv(4))
+        version, cmd, address_type, address, port = self.read(parse_request)
         if version != 5:
             # close connection
             return
-
-        if address_type == 1:  # IPv4
-            address = socket.inet_ntoa(self.sock.recv(4))
-        elif address_type == 3:  # Domain name
-            domain_length = self.sock.recv(1)[0]
-            address = self.sock.recv(domain_length)
-            address = socket.gethostbyname(address)
-        else:
+        if address is None:
+            self.send_status(REPLY_ADDRESS_TYPE_NOT_SUPPORTED)
             return
 
-        port = struct.unpack('!H', self.sock.recv(2))[0]
+        if address_type == 3:
+            # Cache con TTL e coalescing: i domini piu' richiesti non vengono risolti a ogni sessione
+            try:
+                self.addresses = self.resolver.resolve(address)
+            except ResolveError as e:
+                self.send_status(REPLY_HOST_UNREACHABLE)
+                raise ConnectError(REPLY_HOST_UNREACHABLE, str(e)) from e
+            ipv4 = [a for a in self.addresses if ":" not in a]
+            address = ipv4[0] if ipv4 else self.addresses[0]
+        else:
+            self.addresses = [address]
 
         return cmd, address, port
 
     def auth_handshake(self):
-        
-        header = self.sock.recv(2)
-        version, nmethods = struct.unpack("!BB", header)
+
+        version, methods = self.read(parse_greeting)
+        self.greeted_at = time.monotonic()
         if version != 5:
             # close connection
             return False , None , None
-        
-        if nmethods < 1:
+
+        if not methods:
             # close connection
             return False , None , None
 
-        methods = self.get_available_methods(nmethods)
         if 2 not in set(methods):
             # close connection
             return False , None , None
 
-        self.sock.sendall(struct.pack("!BB", 5, 2))
+        # Resta in coda: se le credenziali sono gia' arrivate parte insieme all'esito dell'auth
+        self.write(struct.pack("!BB", 5, 2))
 
         status , username , password = self.get_credentials()
 
         return status , username , password
-    
+
     def complete_auth_handshake(self):
-        response = struct.pack("!BB", 1, 0)
-        self.sock.sendall(response)
+        # La risposta parte con la prossima read o con flush(): chi cede il socket deve chiamare flush()
+        self.write(struct.pack("!BB", 1, 0))
 
         self.auth = True
-    
-    def get_available_methods(self, n):
-        methods = []
-        for i in range(n):
-            methods.append(ord(self.sock.recv(1)))
-        return methods
-    
+
     def get_credentials(self):
-        version = ord(self.sock.recv(1))
-        
+        version, username, password = self.read(parse_credentials)
+
         if version != 1:
             # close connection
             return False , None , None
 
-        username_len = ord(self.sock.recv(1))
-        username = self.sock.recv(username_len).decode('utf-8')
+        return True , username , password
+
+
+class AsyncSocks5Connection:
+    # Stesso parser delle classi sincrone, sopra uno StreamReader/StreamWriter
 
-        password_len = ord(self.sock.recv(1))
-        password = self.sock.recv(password_len).decode('utf-8')
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.parser = Socks5Parser()
+
+    async def read(self, parse):
+        while True:
+            result = self.parser.next(parse)
+            if result is not None:
+                return result
+            await self.flush()
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError("Connection closed during SOCKS5 handshake")
+            self.parser.feed(data)
+
+    def write(self, data):
+        self.parser.write(data)
+
+    async def flush(self):
+        data = self.parser.pending_output()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    def take_buffered(self):
+        return self.parser.take_buffered()
+
+
+class AsyncSocks5Client(AsyncSocks5Connection):
+
+    async def connect(self, username, password, cmd, address_type, address, port, payload=b""):
+        """Metodo, credenziali, richiesta ed eventuale payload in una sola scrittura."""
+        self.write(struct.pack("!BBB", 5, 1, 2))
+        self.write(build_credentials(username, password))
+        self.write(build_request(cmd, address_type, address, port))
+        self.write(payload)
+
+        version, method = await self.read(parse_status)
+        if version != 5 or method != 2:
+            return False, None, None
+        version, status = await self.read(parse_status)
+        if version != 1 or status != 0:
+            return False, None, None
+        version, status, _, bind_address, bind_port = await self.read(parse_request)
+        if version != 5 or status != 0:
+            return False, None, None
+        return True, bind_address, bind_port
+
+
+class AsyncSocks5Server(AsyncSocks5Connection):
+
+    async def auth_handshake(self):
+        version, methods = await self.read(parse_greeting)
+        if version != 5 or 2 not in methods:
+            return False, None, None
+        self.write(struct.pack("!BB", 5, 2))
+
+        version, username, password = await self.read(parse_credentials)
+        if version != 1:
+            return False, None, None
+        return True, username, password
+
+    def complete_auth_handshake(self):
+        self.write(struct.pack("!BB", 1, 0))
+
+    async def get_request(self):
+        version, cmd, address_type, address, port = await self.read(parse_request)
+        if version != 5 or address is None:
+            return
+        return cmd, address_type, address, port
 
-        return True , username , password
\ No newline at end of file
+    async def send_status(self, status, bind_address=None):
+        self.write(build_reply(status, bind_address))
+        await self.flush()
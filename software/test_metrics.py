@@ -0,0 +1,40 @@
+import threading
+from metrics import Counter, Histogram, PRUNE_MIN_SHARDS
+
+
+def run_threads(target, count):
+    for _ in range(count):
+        thread = threading.Thread(target=target)
+        thread.start()
+        thread.join()
+
+
+def test_dead_shards_folded_without_reads():
+    counter = Counter("test_total", "test")
+    run_threads(counter.inc, 10 * PRUNE_MIN_SHARDS)
+    # Nessuna collect(): la pulizia avviene alla creazione degli shard
+    assert len(counter.shards) < PRUNE_MIN_SHARDS
+    assert counter.value() == 10 * PRUNE_MIN_SHARDS
+    assert counter.shards == []
+
+
+def test_live_shards_are_kept():
+    histogram = Histogram("test_seconds", "test", buckets=(1,))
+    release = threading.Event()
+    started = threading.Barrier(PRUNE_MIN_SHARDS + 1)
+
+    def observe():
+        histogram.observe(0.5)
+        started.wait()
+        release.wait()
+
+    threads = [threading.Thread(target=observe) for _ in range(PRUNE_MIN_SHARDS)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    run_threads(lambda: histogram.observe(2), PRUNE_MIN_SHARDS)
+    assert len(histogram.shards) >= PRUNE_MIN_SHARDS
+    assert histogram.collect() == [PRUNE_MIN_SHARDS, PRUNE_MIN_SHARDS, PRUNE_MIN_SHARDS * 2.5, 2 * PRUNE_MIN_SHARDS]
+    release.set()
+    for thread in threads:
+        thread.join()
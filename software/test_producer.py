@@ -0,0 +1,78 @@
+import time
+import socket
+import logging
+import threading
+# Un handler sul root logger prima dell'import: setup_logging non crea producer.log durante i test
+logging.getLogger().addHandler(logging.NullHandler())
+from producer import Producer, ConnectionPool
+
+
+def stub_relay(status):
+    # Relay minimo: risponde all'handshake del Producer con status e tiene aperta la connessione
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(64)
+    connections = []
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+            conn.recv(128)
+            conn.sendall(bytes([status]))
+            connections.append(conn)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server, connections
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_retired_producer_cannot_be_claimed():
+    pool = ConnectionPool("127.0.0.1", 9, 0, idle_timeout=0)
+    producer = Producer("127.0.0.1", 9, 0, pool=pool)
+    producer.sock, peer = socket.socketpair()
+    pool.states[producer] = "parked"
+    pool.parked_since[producer] = time.monotonic() - 10
+
+    pool.maintain(time.monotonic())
+    assert producer.retired
+    assert producer not in pool.states
+    # Il Client arrivato durante il ritiro non riporta il Producer nel pool
+    assert not pool.set_state(producer, "busy")
+    assert producer not in pool.states
+    assert peer.recv(1) == b""
+
+
+def test_surplus_producer_retired_and_forgotten():
+    server, connections = stub_relay(1)
+    pool = ConnectionPool("127.0.0.1", server.getsockname()[1], 2, idle_timeout=0, connect_rate=100)
+    pool.start()
+    wait_for(lambda: list(pool.states.values()).count("parked") == 2)
+    pool.target_idle = 1
+    pool.maintain(time.monotonic())
+    wait_for(lambda: len(pool.states) == 1 and not [p for p in threading.enumerate()
+                                                    if isinstance(p, Producer) and p.retired])
+    assert pool.idle_tunnels() == 1
+    pool.target_idle = 0
+    pool.maintain(time.monotonic())  # ferma anche l'ultimo: i thread dei Producer non sono daemon
+    wait_for(lambda: not pool.states)
+    server.close()
+
+
+def test_rejected_api_key_stops_the_pool():
+    server, connections = stub_relay(0)
+    pool = ConnectionPool("127.0.0.1", server.getsockname()[1], 3, connect_rate=100)
+    pool.start()
+    wait_for(lambda: pool.rejected and not pool.states)
+    time.sleep(0.3)
+    assert not pool.states  # nessun nuovo tunnel dopo il rifiuto
+    assert len(connections) == 3
+    server.close()
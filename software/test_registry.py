@@ -0,0 +1,65 @@
+import os
+import time
+import socket
+import tempfile
+import pytest
+from liveness import HEARTBEAT
+from producerregistry import ProducerRegistryServer, ProducerRegistryClient
+
+
+@pytest.fixture
+def registry():
+    path = os.path.join(tempfile.mkdtemp(), "registry.sock")
+    server = ProducerRegistryServer(path, heartbeat_interval=1, heartbeat_timeout=3)
+    server.start()
+    yield server, ProducerRegistryClient(path)
+    server.server_socket.close()
+
+
+def park(client):
+    # Il worker passa il socket al registro e chiude la sua copia, come handle_producer
+    relay_end, producer_end = socket.socketpair()
+    client.put(relay_end)
+    relay_end.close()
+    return producer_end
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+def test_parked_producer_receives_heartbeats(registry):
+    server, client = registry
+    producer = park(client)
+    producer.settimeout(3)
+    assert producer.recv(1) == HEARTBEAT
+    assert producer.recv(1) == HEARTBEAT
+    assert client.count() == 1
+
+
+def test_taken_producer_stops_receiving_heartbeats(registry):
+    server, client = registry
+    producer = park(client)
+    wait_for(lambda: len(server.liveness) == 1)
+    taken = client.take()
+    assert taken is not None
+    assert len(server.liveness) == 0
+    try:
+        producer.recv(64, socket.MSG_DONTWAIT)  # heartbeat partito prima di take()
+    except BlockingIOError:
+        pass
+    producer.settimeout(2.5)
+    with pytest.raises(socket.timeout):
+        producer.recv(1)
+    taken.sendall(b"\x05")
+    assert producer.recv(1) == b"\x05"
+
+
+def test_dead_producer_is_evicted(registry):
+    server, client = registry
+    park(client).close()
+    wait_for(lambda: client.count() == 0)
+    assert client.take() is None
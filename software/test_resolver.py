@@ -0,0 +1,137 @@
+import socket
+import struct
+import threading
+import pytest
+from resolver import Resolver, ResolveError, DNS_HEADER, DNS_RR, TYPE_A, TYPE_AAAA, TYPE_SOA, CLASS_IN
+
+
+class StubDnsServer:
+    """Server DNS di test su 127.0.0.1, UDP e TCP sulla stessa porta.
+
+    records: nome -> {qtype: [indirizzi]}; i nomi assenti ricevono NXDOMAIN con un SOA.
+    Con silent non risponde mai via UDP, con truncate via UDP risponde solo con TC=1.
+    """
+
+    def __init__(self, records, silent=False, truncate=False, ttl=300):
+        self.records = records
+        self.silent = silent
+        self.truncate = truncate
+        self.ttl = ttl
+        self.udp_queries = 0
+        self.tcp_queries = 0
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(("127.0.0.1", 0))
+        self.address = self.udp.getsockname()
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.bind(self.address)
+        self.tcp.listen(8)
+        threading.Thread(target=self.serve_udp, daemon=True).start()
+        threading.Thread(target=self.serve_tcp, daemon=True).start()
+
+    def close(self):
+        self.udp.close()
+        self.tcp.close()
+
+    def answer(self, query, truncated=False):
+        query_id = struct.unpack_from("!H", query)[0]
+        offset = DNS_HEADER.size
+        labels = []
+        while query[offset]:
+            length = query[offset]
+            labels.append(query[offset + 1:offset + 1 + length].decode())
+            offset += 1 + length
+        qtype = struct.unpack_from("!H", query, offset + 1)[0]
+        question = query[DNS_HEADER.size:offset + 5]
+        name = ".".join(labels)
+
+        if truncated:
+            return DNS_HEADER.pack(query_id, 0x8380, 1, 0, 0, 0) + question
+        if name not in self.records:
+            soa = b"\x00\x00" + struct.pack("!IIIII", 1, 2, 3, 4, 7)
+            authority = b"\xc0\x0c" + DNS_RR.pack(TYPE_SOA, CLASS_IN, 60, len(soa)) + soa
+            return DNS_HEADER.pack(query_id, 0x8183, 1, 0, 1, 0) + question + authority
+        answers = b""
+        addresses = self.records[name].get(qtype, [])
+        for address in addresses:
+            family = socket.AF_INET if qtype == TYPE_A else socket.AF_INET6
+            rdata = socket.inet_pton(family, address)
+            answers += b"\xc0\x0c" + DNS_RR.pack(qtype, CLASS_IN, self.ttl, len(rdata)) + rdata
+        return DNS_HEADER.pack(query_id, 0x8180, 1, len(addresses), 0, 0) + question + answers
+
+    def serve_udp(self):
+        while True:
+            try:
+                query, peer = self.udp.recvfrom(512)
+            except OSError:
+                return
+            self.udp_queries += 1
+            if not self.silent:
+                self.udp.sendto(self.answer(query, truncated=self.truncate), peer)
+
+    def serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            with conn:
+                length = struct.unpack("!H", conn.recv(2))[0]
+                query = b""
+                while len(query) < length:
+                    query += conn.recv(length - len(query))
+                self.tcp_queries += 1
+                response = self.answer(query)
+                conn.sendall(struct.pack("!H", len(response)) + response)
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(**kwargs):
+        records = {"example.test": {TYPE_A: ["192.0.2.1"], TYPE_AAAA: ["2001:db8::1"]}}
+        server = StubDnsServer(records, **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_resolves_a_and_aaaa(stub):
+    server = stub()
+    resolver = Resolver([server.address], hosts={})
+    assert resolver.resolve("Example.Test.") == ["192.0.2.1", "2001:db8::1"]
+    # Seconda richiesta dalla cache
+    assert resolver.resolve("example.test") == ["192.0.2.1", "2001:db8::1"]
+    assert server.udp_queries == 2
+    assert resolver.hits == 1
+
+
+def test_nxdomain_is_cached(stub):
+    server = stub()
+    resolver = Resolver([server.address], hosts={})
+    with pytest.raises(ResolveError):
+        resolver.resolve("missing.test")
+    with pytest.raises(ResolveError):
+        resolver.resolve("missing.test")
+    assert server.udp_queries == 2  # A e AAAA una volta sola
+    _, addresses = resolver.cache["missing.test"]
+    assert addresses == []
+
+
+def test_timeout(stub):
+    server = stub(silent=True)
+    resolver = Resolver([server.address], timeout=0.2, attempts=2, hosts={})
+    with pytest.raises(ResolveError):
+        resolver.resolve("example.test")
+    assert server.udp_queries == 4
+    assert "example.test" not in resolver.cache
+
+
+def test_truncated_response_retried_over_tcp(stub):
+    server = stub(truncate=True)
+    resolver = Resolver([server.address], hosts={})
+    assert resolver.resolve("example.test") == ["192.0.2.1", "2001:db8::1"]
+    assert server.tcp_queries == 2
@@ -0,0 +1,103 @@
+import threading
+from scheduler import ShardedScheduler
+
+
+class Endpoint:
+    # Hash fissato: il test decide in quale shard finisce ogni Producer
+
+    def __init__(self, name, shard):
+        self.name = name
+        self.shard = shard
+
+    def __hash__(self):
+        return self.shard
+
+    def __repr__(self):
+        return self.name
+
+
+def make_scheduler(policy, producers, shards=8, sticky=False):
+    scheduler = ShardedScheduler(policy, sticky, shards=shards)
+    for endpoint, capacity, rtt in producers:
+        scheduler.add(endpoint, capacity, rtt)
+    return scheduler
+
+
+def test_least_loaded_is_global():
+    endpoints = [Endpoint(f"p{index}", index % 8) for index in range(16)]
+    scheduler = make_scheduler("least_loaded", [(endpoint, 10, None) for endpoint in endpoints])
+    loads = {endpoint: 0 for endpoint in endpoints}
+    for _ in range(80):
+        loads[scheduler.acquire()] += 1
+    assert set(loads.values()) == {5}
+
+
+def test_lowest_rtt_is_global():
+    fast = Endpoint("fast", 5)
+    producers = [(Endpoint(f"p{index}", index % 8), 1, 0.050) for index in range(16)] + [(fast, 3, 0.001)]
+    scheduler = make_scheduler("lowest_rtt", producers)
+    assert [scheduler.acquire() for _ in range(3)] == [fast, fast, fast]
+    assert scheduler.acquire() is not fast
+
+
+def test_power_of_two_reaches_every_shard():
+    # Un solo Producer libero in uno shard su 64
+    only = Endpoint("only", 63)
+    scheduler = make_scheduler("power_of_two", [(only, 100, None)], shards=64)
+    assert all(scheduler.acquire() is only for _ in range(100))
+    assert scheduler.acquire() is None
+
+
+def test_power_of_two_balances_across_shards():
+    endpoints = [Endpoint(f"p{index}", index % 4) for index in range(32)]
+    scheduler = make_scheduler("power_of_two", [(endpoint, 1000, None) for endpoint in endpoints])
+    loads = {endpoint: 0 for endpoint in endpoints}
+    for _ in range(3200):
+        loads[scheduler.acquire()] += 1
+    assert max(loads.values()) - min(loads.values()) < 30
+
+
+def test_sticky_survives_full_shards():
+    home = Endpoint("home", 0)
+    others = [Endpoint(f"p{index}", index % 8) for index in range(1, 16)]
+    scheduler = make_scheduler("least_loaded", [(home, 10, None)] + [(endpoint, 1, None) for endpoint in others],
+                               sticky=True)
+    first = scheduler.acquire("alice")
+    # Si riempiono tutti gli altri Producer, qualunque sia lo shard di "alice"
+    while scheduler.acquire() not in (None, first):
+        pass
+    assert all(scheduler.acquire("alice") is first for _ in range(3))
+
+
+def test_sticky_moves_when_producer_is_full():
+    producers = [(Endpoint(f"p{index}", index), 1, None) for index in range(4)]
+    scheduler = make_scheduler("random", producers, shards=4, sticky=True)
+    first = scheduler.acquire("alice")
+    second = scheduler.acquire("alice")
+    assert second is not None and second is not first
+    scheduler.release(first)
+    scheduler.release(second)
+    assert scheduler.acquire("alice") is second
+
+
+def test_concurrent_acquire_and_release():
+    endpoints = [Endpoint(f"p{index}", index) for index in range(64)]
+    scheduler = make_scheduler("least_loaded", [(endpoint, 4, None) for endpoint in endpoints])
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(2000):
+                endpoint = scheduler.acquire()
+                assert endpoint is not None
+                scheduler.release(endpoint)
+        except AssertionError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert scheduler.free_slots == 64 * 4
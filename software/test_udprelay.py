@@ -0,0 +1,63 @@
+import time
+import socket
+import threading
+from udprelay import RemoteUdpAssociation, FRAME_HEADER, parse_datagram
+from socks5 import build_request
+
+
+class SlowResolver:
+    # Nessun nome in cache: ogni risoluzione passa dall'executor e dura delay secondi
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.queries = []
+
+    def resolve_cached(self, name):
+        return None
+
+    def resolve(self, name):
+        self.queries.append(name)
+        time.sleep(self.delay)
+        return ["127.0.0.1"]
+
+
+def frame(address_type, address, port, data):
+    header = b"\x00\x00\x00" + build_request(0, address_type, address, port)[3:]
+    return FRAME_HEADER.pack(len(header) + len(data)) + header + data
+
+
+def read_frame(sock):
+    length = FRAME_HEADER.unpack(sock.recv(FRAME_HEADER.size))[0]
+    datagram = sock.recv(length)
+    return datagram[parse_datagram(datagram)[4]:]
+
+
+def test_slow_resolution_does_not_stall_other_destinations():
+    echo = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    echo.bind(("127.0.0.1", 0))
+    port = echo.getsockname()[1]
+
+    def serve():
+        while True:
+            data, source = echo.recvfrom(65535)
+            echo.sendto(data, source)
+
+    threading.Thread(target=serve, daemon=True).start()
+
+    client, tunnel = socket.socketpair()
+    resolver = SlowResolver(1.0)
+    association = RemoteUdpAssociation(tunnel, resolver=resolver, idle_timeout=5)
+    threading.Thread(target=association.run, daemon=True).start()
+
+    client.settimeout(3)
+    started = time.monotonic()
+    client.sendall(frame(3, "slow.test", port, b"named") + frame(1, "127.0.0.1", port, b"literal"))
+    # L'IP letterale passa mentre il nome e' ancora in risoluzione
+    assert read_frame(client) == b"literal"
+    assert time.monotonic() - started < 0.5
+    client.sendall(frame(3, "slow.test", port, b"named again"))
+    assert read_frame(client) == b"named"
+    assert read_frame(client) == b"named again"
+    assert resolver.queries == ["slow.test"]  # una sola risoluzione per i datagrammi in attesa
+    client.close()
+    echo.close()
@@ -0,0 +1,378 @@
+import time
+import socket
+import struct
+import logging
+import selectors
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from socks5 import build_request, parse_request
+from resolver import get_default_resolver, ResolveError
+from metrics import REGISTRY
+
+CMD_UDP_ASSOCIATE = 3
+
+# Ogni datagramma nel tunnel: lunghezza + intestazione UDP SOCKS5 (RFC 1928, sezione 7) + dati
+FRAME_HEADER = struct.Struct("!H")
+MAX_FRAME = 0xFFFF
+MAX_PENDING_DATAGRAMS = 16  # per nome in corso di risoluzione; oltre si scartano
+
+UDP_ASSOCIATIONS = REGISTRY.counter("udp_associations_total", "UDP ASSOCIATE sessions started")
+UDP_DATAGRAMS_UP = REGISTRY.counter("udp_datagrams_total", "Datagrams relayed for UDP ASSOCIATE", {"direction": "up"})
+UDP_DATAGRAMS_DOWN = REGISTRY.counter("udp_datagrams_total", "Datagrams relayed for UDP ASSOCIATE", {"direction": "down"})
+UDP_DATAGRAMS_DROPPED = REGISTRY.counter("udp_datagrams_dropped_total",
+                                         "Datagrams dropped (foreign source, fragments, full buffers, bandwidth limit)")
+
+
+def parse_datagram(datagram):
+    """(frag, address_type, address, port, inizio dei dati); None se l'intestazione non e' valida."""
+    # RSV RSV FRAG ATYP occupano le posizioni di VER CMD RSV ATYP di una richiesta
+    result = parse_request(datagram)
+    if result is None or result[4] is None:
+        return None
+    end, _, _, address_type, address, port = result
+    return datagram[2], address_type, address, port, end
+
+
+def build_datagram_header(address, port):
+    # Verso il Client DST.ADDR/DST.PORT sono la sorgente del datagramma
+    return b"\x00\x00\x00" + build_request(0, 4 if ":" in address else 1, address, port)[3:]
+
+
+class UdpAssociation:
+    """Loop di un'associazione UDP ASSOCIATE: socket UDP da un lato, frame nel tunnel TCP dall'altro.
+
+    Il modulo socket non espone recvmmsg/sendmmsg: a ogni risveglio si leggono fino a
+    batch datagrammi da un socket UDP non bloccante e i frame risultanti partono con una
+    sola send, mentre una recv dal tunnel porta di solito molti frame. Il traffico UDP
+    non si accoda: oltre max_pending byte in attesa verso il tunnel, con il buffer del
+    socket UDP pieno o oltre il limite di banda del meter i datagrammi vengono scartati.
+    L'associazione termina con il tunnel o dopo idle_timeout secondi senza datagrammi.
+    """
+
+    def __init__(self, tunnel, idle_timeout=120, batch=64, max_pending=256 * 1024, meter=None, initial_data=b""):
+        self.tunnel = tunnel
+        self.idle_timeout = idle_timeout
+        self.batch = batch
+        self.max_pending = max_pending
+        self.meter = meter  # TunnelMeter: conteggio dei byte e limite di banda (qui i datagrammi oltre il limite si scartano)
+        self.selector = selectors.DefaultSelector()
+        self.inbuf = bytearray(initial_data)
+        self.outbuf = bytearray()
+        self.tunnel_events = selectors.EVENT_READ
+        self.paused_until = 0
+        self.last_activity = time.monotonic()
+        self.closed = False
+
+    def run(self):
+        UDP_ASSOCIATIONS.inc()
+        self.tunnel.setblocking(False)
+        self.selector.register(self.tunnel, selectors.EVENT_READ, self.read_tunnel)
+        self.setup()
+        self.read_frames()
+        while not self.closed:
+            now = time.monotonic()
+            if now - self.last_activity > self.idle_timeout:
+                logging.debug("UDP association closed after %s idle seconds", self.idle_timeout)
+                return
+            self.expire(now)
+            # Risveglio almeno ogni secondo per le scadenze della tabella NAT
+            for key, mask in self.selector.select(min(1, self.last_activity + self.idle_timeout - now)):
+                if mask & selectors.EVENT_READ:
+                    key.data(key.fileobj)
+                if self.closed:
+                    break
+            self.flush()
+
+    def setup(self):
+        pass
+
+    def expire(self, now):
+        pass
+
+    def close(self):
+        self.closed = True
+        self.selector.close()
+
+    def read_tunnel(self, sock):
+        try:
+            data = sock.recv(262144)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.closed = True
+            return
+        self.inbuf += data
+        self.read_frames()
+
+    def read_frames(self):
+        buffer = self.inbuf
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            length = FRAME_HEADER.unpack_from(buffer, offset)[0]
+            end = offset + FRAME_HEADER.size + length
+            if len(buffer) < end:
+                break
+            self.last_activity = time.monotonic()
+            self.on_frame(bytes(buffer[offset + FRAME_HEADER.size:end]))
+            offset = end
+        del buffer[:offset]
+
+    def read_udp(self, sock):
+        for _ in range(self.batch):
+            try:
+                data, source = sock.recvfrom(65535)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                logging.debug("UDP receive error: %s", e)
+                return
+            self.last_activity = time.monotonic()
+            self.on_datagram(sock, data, source)
+
+    def queue_frame(self, datagram):
+        if len(datagram) > MAX_FRAME or len(self.outbuf) >= self.max_pending:
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        self.outbuf += FRAME_HEADER.pack(len(datagram))
+        self.outbuf += datagram
+
+    def flush(self):
+        if self.outbuf and not self.closed:
+            try:
+                sent = self.tunnel.send(self.outbuf)
+            except BlockingIOError:
+                sent = 0
+            except OSError:
+                self.closed = True
+                return
+            del self.outbuf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if self.outbuf else 0)
+        if events != self.tunnel_events and not self.closed:
+            self.selector.modify(self.tunnel, events, self.read_tunnel)
+            self.tunnel_events = events
+
+    def send_datagram(self, sock, data, address):
+        try:
+            sock.sendto(data, address)
+        except OSError as e:
+            # Buffer di invio pieno o destinazione rifiutata dal kernel: come una perdita in rete
+            UDP_DATAGRAMS_DROPPED.inc()
+            logging.debug("UDP send to %s failed: %s", address, e)
+
+    def admit(self, upstream, n):
+        if self.meter is None:
+            return True
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        delay = self.meter.account(upstream, n)
+        if delay:
+            self.paused_until = now + delay
+        return True
+
+
+class ClientUdpAssociation(UdpAssociation):
+    """Lato ClientGateway: il socket UDP annunciato al Client nella risposta ad ASSOCIATE.
+
+    Si accettano solo datagrammi dall'IP della connessione di controllo (e dalla porta
+    dichiarata nella richiesta, se diversa da 0); il primo fissa la porta del Client.
+    I datagrammi passano nel tunnel senza essere riscritti. L'associazione termina
+    quando il Client chiude la connessione di controllo.
+    """
+
+    def __init__(self, control, tunnel, udp_socket, client_address, **kwargs):
+        super().__init__(tunnel, **kwargs)
+        self.control = control
+        self.udp_socket = udp_socket
+        self.client_ip, self.client_port = client_address
+        self.client_address = None
+
+    def setup(self):
+        self.control.setblocking(False)
+        self.selector.register(self.control, selectors.EVENT_READ, self.read_control)
+        self.udp_socket.setblocking(False)
+        self.selector.register(self.udp_socket, selectors.EVENT_READ, self.read_udp)
+
+    def close(self):
+        super().close()
+        self.udp_socket.close()
+
+    def read_control(self, sock):
+        try:
+            if sock.recv(4096):
+                return  # nessun dato previsto dopo la richiesta: si ignora
+        except BlockingIOError:
+            return
+        except OSError:
+            pass
+        self.closed = True
+
+    def on_datagram(self, sock, data, source):
+        if source[0] != self.client_ip or (self.client_port and source[1] != self.client_port):
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        # Frammentazione (FRAG != 0) non supportata: la RFC consente di scartare
+        if len(data) < 4 or data[2] != 0 or not self.admit(True, len(data)):
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        self.client_port = source[1]
+        self.client_address = source
+        UDP_DATAGRAMS_UP.inc()
+        self.queue_frame(data)
+
+    def on_frame(self, datagram):
+        if self.client_address is None or not self.admit(False, len(datagram)):
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        UDP_DATAGRAMS_DOWN.inc()
+        self.send_datagram(self.udp_socket, datagram, self.client_address)
+
+
+class RemoteUdpAssociation(UdpAssociation):
+    """Lato Producer: invia i datagrammi alle destinazioni e riporta nel tunnel le risposte.
+
+    La tabella NAT ricorda le destinazioni contattate per nat_timeout secondi (rinnovati
+    dal traffico in entrambe le direzioni, al massimo max_mappings voci): arrivano al
+    Client solo i datagrammi di una destinazione presente e non scaduta. Un socket UDP
+    per famiglia di indirizzi, creato al primo datagramma. I nomi gia' in cache si
+    risolvono nel loop; gli altri in un executor condiviso, mentre i datagrammi per
+    quel nome aspettano (al massimo MAX_PENDING_DATAGRAMS) e il resto del traffico
+    continua.
+    """
+
+    def __init__(self, tunnel, resolver=None, nat_timeout=60, max_mappings=1024, executor=None, **kwargs):
+        super().__init__(tunnel, **kwargs)
+        self.resolver = resolver or get_default_resolver()
+        self.executor = executor or get_resolve_executor()
+        self.nat_timeout = nat_timeout
+        self.max_mappings = max_mappings
+        self.nat = OrderedDict()  # (indirizzo, porta) -> scadenza, in ordine di scadenza
+        self.sockets = {}  # famiglia -> socket UDP
+        self.resolving = {}  # nome -> [(porta, dati)] in attesa della risoluzione
+        self.resolved = deque()  # (nome, indirizzi) completati dall'executor
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+
+    def setup(self):
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, self.read_resolved)
+
+    def close(self):
+        super().close()
+        for sock in self.sockets.values():
+            sock.close()
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def udp_socket(self, family):
+        sock = self.sockets.get(family)
+        if sock is None:
+            sock = self.sockets[family] = socket.socket(family, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, self.read_udp)
+        return sock
+
+    def refresh(self, destination):
+        self.nat[destination] = time.monotonic() + self.nat_timeout
+        self.nat.move_to_end(destination)
+        if len(self.nat) > self.max_mappings:
+            self.nat.popitem(last=False)
+
+    def expire(self, now):
+        while self.nat:
+            destination, expiry = next(iter(self.nat.items()))
+            if expiry > now:
+                break
+            del self.nat[destination]
+
+    def on_frame(self, datagram):
+        header = parse_datagram(datagram)
+        if header is None or header[0] != 0:
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        _, address_type, address, port, offset = header
+        data = memoryview(datagram)[offset:]
+        if address_type != 3:
+            self.forward([address], port, data)
+            return
+
+        waiting = self.resolving.get(address)
+        if waiting is not None:
+            if len(waiting) >= MAX_PENDING_DATAGRAMS:
+                UDP_DATAGRAMS_DROPPED.inc()
+            else:
+                waiting.append((port, data))
+            return
+        addresses = self.resolver.resolve_cached(address)
+        if addresses is not None:
+            self.forward(addresses, port, data)
+            return
+        self.resolving[address] = [(port, data)]
+        self.executor.submit(self.resolve, address)
+
+    def resolve(self, name):
+        # Nel thread dell'executor: il risultato torna al loop tramite la coda e il socketpair
+        try:
+            addresses = self.resolver.resolve(name)
+        except ResolveError:
+            addresses = []
+        except Exception as e:
+            logging.warning("UDP resolution of %s failed: %s", name, e)
+            addresses = []
+        self.resolved.append((name, addresses))
+        try:
+            self.wakeup_w.send(b"\0")
+        except OSError:
+            pass  # loop gia' svegliato, o associazione chiusa nel frattempo
+
+    def read_resolved(self, sock):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.resolved:
+            name, addresses = self.resolved.popleft()
+            for port, data in self.resolving.pop(name, ()):
+                self.forward(addresses, port, data)
+
+    def forward(self, addresses, port, data):
+        if not addresses:
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        ipv4 = [a for a in addresses if ":" not in a]
+        address = ipv4[0] if ipv4 else addresses[0]
+        try:
+            sock = self.udp_socket(socket.AF_INET6 if ":" in address else socket.AF_INET)
+        except OSError:
+            UDP_DATAGRAMS_DROPPED.inc()  # famiglia non supportata dall'host
+            return
+        self.refresh((address, port))
+        UDP_DATAGRAMS_UP.inc()
+        self.send_datagram(sock, data, (address, port))
+
+    def on_datagram(self, sock, data, source):
+        destination = source[:2]
+        expiry = self.nat.get(destination)
+        if expiry is None or expiry < time.monotonic():
+            UDP_DATAGRAMS_DROPPED.inc()
+            return
+        self.refresh(destination)
+        UDP_DATAGRAMS_DOWN.inc()
+        self.queue_frame(build_datagram_header(*destination) + data)
+
+
+_resolve_executor = None
+_resolve_executor_lock = threading.Lock()
+
+
+def get_resolve_executor():
+    # Condiviso da tutte le associazioni del processo: i nomi nuovi non occupano un thread ciascuno
+    global _resolve_executor
+    with _resolve_executor_lock:
+        if _resolve_executor is None:
+            _resolve_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="UdpResolver")
+        return _resolve_executor
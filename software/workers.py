@@ -0,0 +1,58 @@
+import os
+import sys
+import signal
+import logging
+import threading
+
+
+def run_worker(index, target):
+    # Nel figlio: avvia il server e resta vivo finche' i suoi thread sono attivi
+    try:
+        target(index)
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join()
+    except Exception as e:
+        logging.error("Worker %d crashed: %s", index, e)
+    finally:
+        os._exit(0)
+
+
+def run_workers(num_workers, target, on_started=None):
+    """Esegue target(index) in num_workers processi figli e li riavvia se terminano.
+
+    I figli condividono le porte di ascolto tramite SO_REUSEPORT, per cui target
+    deve creare i propri socket dopo il fork.
+    """
+    children = {}
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            run_worker(index, target)
+        children[pid] = index
+        logging.info("Worker %d started with pid %d", index, pid)
+
+    def shutdown(signum, frame):
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    for index in range(num_workers):
+        spawn(index)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    if on_started:
+        on_started()
+
+    while True:
+        pid, status = os.wait()
+        index = children.pop(pid, None)
+        if index is not None:
+            logging.warning("Worker %d (pid %d) exited with status %d, restarting", index, pid, status)
+            spawn(index)